@@ -46,7 +46,9 @@ async def main():
 
     while True:
         # centralからの接続を待機
-        connection = await aioble.advertise(100, name=DEVICE_NAME)  # 広告感覚(ms)
+        connection = await aioble.advertise(
+            100, name=DEVICE_NAME, services=[SERVICE_UUID]
+        )  # 広告感覚(ms)
         print("接続されました")
 
         # 操作を受け付ける
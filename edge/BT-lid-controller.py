@@ -1,69 +1,25 @@
 # BT-lid-controller
-# TODO 開けている途中に閉じろと言われた時にすぐ閉じるようにする
-# 現状では開き切ってから閉じる
+# 蓋の目標位置を持ち、新しい命令が来たら実行中の回転を減速して止め、今の位置から目標へ向かう
+# 開けている途中に閉じろと言われたら、止まりきったところから閉じ始める
+# いきなり逆転させると脱調して位置がずれるので、必ず減速してから向きを変える
 
 import asyncio
 import bluetooth
-import time
-from machine import Pin
 from common import BenTechResponsiveDeviceServer
-
-
-class MotorController:
-    """ステッピングモーター制御クラス"""
-
-    # モーターのピン定義
-    MOTOR_PINS = {
-        "IN1": 16,
-        "IN2": 17,
-        "IN3": 18,
-        "IN4": 19,
-    }
-
-    SEQUENCE = [
-        [1, 0, 0, 0],
-        [1, 1, 0, 0],
-        [0, 1, 0, 0],
-        [0, 1, 1, 0],
-        [0, 0, 1, 0],
-        [0, 0, 1, 1],
-        [0, 0, 0, 1],
-        [1, 0, 0, 1],
-    ]
-
-    STEPS_PER_ROTATION = 512
-    DEFAULT_DELAY = 0.001
-    DEFAULT_TURNS = 2.7  # デフォルトの回転数
-
-    def __init__(self):
-        self.pins = [
-            Pin(__class__.MOTOR_PINS["IN1"], Pin.OUT),
-            Pin(__class__.MOTOR_PINS["IN2"], Pin.OUT),
-            Pin(__class__.MOTOR_PINS["IN3"], Pin.OUT),
-            Pin(__class__.MOTOR_PINS["IN4"], Pin.OUT),
-        ]
-
-    def rotate(self, turns, clockwise=True, delay=DEFAULT_DELAY):
-        steps = int(self.STEPS_PER_ROTATION * turns)
-        sequence = self.SEQUENCE if clockwise else self.SEQUENCE[::-1]
-
-        try:
-            for _ in range(steps):
-                for step in sequence:
-                    for pin, value in zip(self.pins, step):
-                        pin.value(value)
-                    time.sleep(delay)
-        finally:
-            self.cleanup()
-
-    def cleanup(self):
-        for pin in self.pins:
-            pin.value(0)
+from stepper import HALF_STEPS_PER_ROTATION
+from stepper_pio import PIOStepperMotor
 
 
 class BenTechLidController(BenTechResponsiveDeviceServer):
     """Bentech 蓋開閉機"""
 
+    # 蓋を開け閉めするのに必要な回転数
+    LID_TURNS = 2.7
+
+    # 蓋の位置(ハーフステップ 時計回りが正) 起動時は閉じているものとする
+    CLOSED_POSITION = 0
+    OPEN_POSITION = -int(HALF_STEPS_PER_ROTATION * LID_TURNS)
+
     # コマンド定義
     COMMANDS = {
         "LID_CLOSE": b"\x02",  # LIDを閉じる
@@ -78,25 +34,64 @@ class BenTechLidController(BenTechResponsiveDeviceServer):
             control_char_id=bluetooth.UUID("74779bc7-1e28-4cb1-8dd7-3a3f2a9259ab"),
             response_char_id=bluetooth.UUID("82bdb1a9-4ffd-4a97-8b5f-af7e84655133"),
         )
-        self.motor = MotorController()
+        # タイマー駆動のstepper.StepperMotorに差し替えても動く
+        self.motor = PIOStepperMotor()
+        self.target_position = __class__.CLOSED_POSITION
+        self._target_changed = asyncio.Event()
+
+    def _set_target(self, position):
+        if position == self.target_position:
+            return
+        self.target_position = position
+        # 逆向きに回っている途中なら減速して止め、止まった位置から向かい直す
+        # 減速の分だけ元の向きに進むが、motor.positionはそれも数えている
+        self.motor.stop()
+        self._target_changed.set()
+
+    async def _drive_lid(self):
+        # 目標位置に着くまで回し続けるタスク
+        while True:
+            await self._target_changed.wait()
+            self._target_changed.clear()
+
+            while self.motor.position != self.target_position:
+                target = self.target_position
+                delta = target - self.motor.position
+                await self.motor.move(abs(delta), clockwise=delta > 0)
+            # 回っている途中に変わった目標は上のループで追いかけ終えているので、
+            # 残ったフラグでもう一度起きて完了を二重に通知しないようにする
+            self._target_changed.clear()
+
+            if self.target_position == __class__.CLOSED_POSITION:
+                # close完了時のみ通知
+                print("Sending close completion notification...")
+                self._notify_response(__class__.COMMANDS["COMPLETE"])
+                print("Close notification sent")
+            else:
+                print("Open operation completed")
 
     async def _handle_control(self, command):
+        # 回転の完了は待たずに戻るので、次の命令をすぐに受け付けられる
         if command == __class__.COMMANDS["LID_CLOSE"]:
             print("Closing lid...")
-            # LIDを閉じる（時計回り）
-            self.motor.rotate(turns=self.motor.DEFAULT_TURNS, clockwise=True)
-            # close完了時のみ通知
-            print("Sending close completion notification...")
-            self._notify_response(__class__.COMMANDS["COMPLETE"])
-            print("Close notification sent")
+            if (
+                self.target_position == __class__.CLOSED_POSITION
+                and self.motor.position == __class__.CLOSED_POSITION
+            ):
+                # 既に閉まっているので完了だけ伝える
+                self._notify_response(__class__.COMMANDS["COMPLETE"])
+                return
+            self._set_target(__class__.CLOSED_POSITION)
         elif command == __class__.COMMANDS["LID_OPEN"]:
             print("Opening lid...")
-            # LIDを開く（反時計回り）
-            self.motor.rotate(turns=self.motor.DEFAULT_TURNS, clockwise=False)
-            print("Open operation completed")
+            self._set_target(__class__.OPEN_POSITION)
         else:
             print(f"Unknown command: {command}")
 
+    async def run(self):
+        asyncio.create_task(self._drive_lid())
+        await super().run()
+
 
 async def main():
     controller = BenTechLidController()
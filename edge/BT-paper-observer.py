@@ -3,86 +3,154 @@
 import asyncio
 import aioble
 import bluetooth
-from machine import ADC, Pin
+from array import array
+from machine import ADC, Pin, Timer
+from micropython import const
+import log
 from common import BenTechResponsiveDeviceServer
+from paper_detector import make_detector, feed_block, COEFF_U16, COEFF_12BIT
 
+# 検出器に渡すサンプルの周期 (DMAの時は間引いた後の周期)
+SAMPLE_RATE_HZ = const(100)
+# タイマー割り込みから処理タスクへ受け渡すサンプルのリングバッファ
+SAMPLE_RING_SIZE = const(32)
 
-class FixedList:
-    def __init__(self, size):
-        self.size = size
-        self.data = []
+# サンプリングの方式
+SAMPLING_POLL = const(0)  # asyncio.sleepで周期を作ってread_u16()
+SAMPLING_TIMER = const(1)  # タイマー割り込みでread_u16()
+SAMPLING_DMA = const(2)  # ADCのFIFOをDMAで高いレートで取り込み、ブロックごとに間引いて処理
+SAMPLING_MODE = const(SAMPLING_DMA)
 
-    def add(self, value):
-        # リストの長さが指定されたサイズよりも大きければ、古い要素を削除
-        if len(self.data) >= self.size:
-            self.data.pop(0)
-        self.data.append(value)
-
-    def variance(self):
-        # 要素がない場合、分散はゼロとする
-        if len(self.data) == 0:
-            return 0
-
-        # 平均を計算
-        mean = sum(self.data) / len(self.data)
-
-        # 分散を計算
-        variance = sum((x - mean) ** 2 for x in self.data) / len(self.data)
-        return variance
+# 溢れが続く間も出すのは1秒に1回まで
+_dropped_log = log.RateLimitedLog(1000, log.WARNING)
 
 
 class Counter:
-    def __init__(self):
+    def __init__(self, rate_hz=SAMPLE_RATE_HZ, mode=SAMPLING_MODE):
         # これないとうまく動かない
         Pin(26, Pin.IN)
         self.led = Pin("LED", Pin.OUT)
         self.adc = ADC(0)
-        self.coeff = 3.3 / 65535
+        self.coeff = COEFF_U16
 
+        self.rate_hz = rate_hz
+        self.mode = mode
         self.should_count = False
-        self.current_flag = False
-        self.threshold = 0.005
-        self.interval = 100
-        self.roll = 0
-        self.count = 0
-        self.coef = 3.3 / 65535
+        self.detector = make_detector(rate_hz, on_change=self._on_change)
+
+        if mode == SAMPLING_DMA:
+            from adc_dma import ADCBurstCapture
+
+            self.capture = ADCBurstCapture(0)
+            # 取り込んだ何サンプルを平均して1サンプルにするか
+            self.decimation = max(1, self.capture.rate_hz // rate_hz)
+
+        # タイマー割り込みで読んだ値 (read_u16の生の値)
+        self._timer = Timer()
+        self._samples = array("H", [0] * SAMPLE_RING_SIZE)
+        self._sample_head = 0
+        self._sample_tail = 0
+        self._sample_dropped = 0
+        self._sample_flag = asyncio.ThreadSafeFlag()
+
+    @property
+    def roll(self):
+        return self.detector.roll
+
+    def _on_change(self, flag, voltage, variance):
+        if flag:
+            self.led.on()
+            if __debug__:
+                log.debug(
+                    "V = {:.2f}, roll = {}, variance = {:.3f}",
+                    voltage,
+                    self.detector.roll,
+                    variance,
+                )
+        else:
+            self.led.off()
 
-        self.list = FixedList(5)
+    def _process(self, raw):
+        self.detector.feed(raw * self.coeff)
 
     async def _count_cycle(self):
-        v = self.adc.read_u16() * self.coeff
-
-        self.list.add(v)
-        variance = self.list.variance()
-
-        # print("=" * int(v / 0.03))
-        print("-" * int(variance / 0.001))
-        print("V = {:.2f}, roll = {}, variance = {:.2f}".format(v, self.roll, variance))
-
-        flag = variance >= self.threshold and self.count >= self.interval
+        self._process(self.adc.read_u16())
+        await asyncio.sleep_ms(1000 // self.rate_hz)
+
+    def _on_sample(self, timer):
+        # hard割り込みから呼ばれるのでメモリ確保をしてはいけない
+        head = self._sample_head
+        next_head = (head + 1) % SAMPLE_RING_SIZE
+        if next_head == self._sample_tail:
+            self._sample_dropped += 1
+        else:
+            self._samples[head] = self.adc.read_u16()
+            self._sample_head = next_head
+        self._sample_flag.set()
 
-        if flag != self.current_flag:
-            if flag:
-                self.led.on()
-                self.roll += 1
-                self.count = 0
-            else:
-                self.led.off()
-            self.current_flag = flag
+    def _drain_samples(self):
+        while self._sample_tail != self._sample_head:
+            tail = self._sample_tail
+            self._process(self._samples[tail])
+            self._sample_tail = (tail + 1) % SAMPLE_RING_SIZE
 
-        self.count += 1
-        await asyncio.sleep(0.01)
+        if self._sample_dropped:
+            _dropped_log("サンプルが溢れました dropped={}", self._sample_dropped)
+            self._sample_dropped = 0
 
     def start(self):
-        self.count = 0
-        self.roll = 0
+        self.detector.reset()
         self.should_count = True
+        if self.mode == SAMPLING_TIMER:
+            self._sample_tail = self._sample_head
+            self._timer.init(
+                freq=self.rate_hz, mode=Timer.PERIODIC, callback=self._on_sample
+            )
+        elif self.mode == SAMPLING_DMA:
+            self.capture.start()
 
     def stop(self):
         self.should_count = False
+        if self.mode == SAMPLING_TIMER:
+            self._timer.deinit()
+            # 止める直前までのサンプルも数える
+            self._drain_samples()
+        elif self.mode == SAMPLING_DMA:
+            stopped = self.capture.stop()
+            # まだ処理されていないブロックと、途中まで埋まっていたブロックも数える
+            while True:
+                filled = self.capture.poll_block()
+                if filled is None:
+                    break
+                index, block = filled
+                feed_block(self.detector, block, self.decimation, COEFF_12BIT)
+                self.capture.release(index)
+            partial = self.capture.partial(stopped)
+            if partial is not None:
+                block, length = partial
+                feed_block(self.detector, block, self.decimation, COEFF_12BIT, length)
+            if self.capture.dropped:
+                log.warning("ブロックの処理が間に合いませんでした dropped={}", self.capture.dropped)
+        self.led.off()
         return self.roll
 
+    async def _run_dma(self):
+        # 取り込みが止まっている間はブロックが埋まらないので眠ったまま
+        while True:
+            index, block = await self.capture.next_block()
+            if self.should_count:
+                feed_block(self.detector, block, self.decimation, COEFF_12BIT)
+            self.capture.release(index)
+
     async def run(self):
+        if self.mode == SAMPLING_DMA:
+            await self._run_dma()
+        if self.mode == SAMPLING_TIMER:
+            # タイマーが止まっている間はフラグが立たないので眠ったまま
+            while True:
+                await self._sample_flag.wait()
+                self._drain_samples()
+
         while True:
             if not self.should_count:
                 await asyncio.sleep(0.1)
@@ -106,20 +174,21 @@ class PaperObserver(BenTechResponsiveDeviceServer):
 
     def _notify_count(self, roll):
         value = roll.to_bytes()
-        print(value)
+        if __debug__:
+            log.debug("ロール数を通知します {}", value)
         self._notify_response(value)
 
     async def _handle_control(self, command):
         if command == __class__.COMMANDS["START"]:
-            print("測定開始")
+            log.info("測定開始")
             self.counter.start()
         elif command == __class__.COMMANDS["STOP"]:
-            print("測定終了")
+            log.info("測定終了")
             roll = self.counter.stop()
             await asyncio.sleep(1)
             self._notify_count(roll)
         else:
-            print(f"Unknown Command Received: {command}")
+            log.warning("Unknown Command Received: {}", command)
 
     async def run(self):
         aioble.register_services(self.service)
@@ -140,7 +209,7 @@ class PaperObserver(BenTechResponsiveDeviceServer):
                 await listen_control_task
                 await count_task
             except asyncio.CancelledError:
-                print("キャンセルされました")
+                log.info("キャンセルされました")
 
 
 async def main():
@@ -0,0 +1,177 @@
+import asyncio
+import rp2
+from array import array
+from machine import ADC, mem32
+from micropython import const
+from paper_detector import write_trace_header
+
+# RP2040のADCのレジスタ
+ADC_BASE = const(0x4004C000)
+ADC_CS = const(ADC_BASE + 0x00)
+ADC_FCS = const(ADC_BASE + 0x08)
+ADC_FIFO = const(ADC_BASE + 0x0C)
+ADC_DIV = const(ADC_BASE + 0x10)
+CS_EN = const(1 << 0)
+CS_START_MANY = const(1 << 3)
+CS_AINSEL_SHIFT = const(12)
+FCS_EN = const(1 << 0)
+FCS_DREQ_EN = const(1 << 3)
+FCS_THRESH_1 = const(1 << 24)
+FCS_LEVEL_SHIFT = const(16)
+FCS_LEVEL_MASK = const(0xF)
+DIV_INT_SHIFT = const(8)
+# ADCのクロックと、1変換にかかるクロック数
+ADC_CLOCK_HZ = const(48000000)
+ADC_CONVERSION_CYCLES = const(96)
+# DMAのデータ要求番号 (DREQ_ADC)
+DREQ_ADC = const(36)
+
+# 取り込みの周波数と、1ブロックのサンプル数 (2000Hz x 200 = 100msごとにブロックが埋まる)
+CAPTURE_RATE_HZ = const(2000)
+CAPTURE_BLOCK_SIZE = const(200)
+
+
+class ADCBurstCapture:
+    """
+    ADCのフリーランニング変換をFIFO経由でDMAに取り込む
+    2つのバッファを2つのDMAチャネルで交互に埋め、チャネル同士を連鎖させるので取りこぼしの隙間がない
+    CPUは埋まったブロックをまとめて処理するだけで、取り込みの周期はイベントループの揺れを受けない
+    """
+
+    def __init__(self, channel=0, rate_hz=CAPTURE_RATE_HZ, block_size=CAPTURE_BLOCK_SIZE):
+        # ピンをADC入力に設定する
+        self._adc = ADC(channel)
+        self.channel = channel
+        self.rate_hz = rate_hz
+        self.block_size = block_size
+
+        self._buffers = (array("H", [0] * block_size), array("H", [0] * block_size))
+        self._dmas = (rp2.DMA(), rp2.DMA())
+        self._filled = [False, False]
+        self._filling = 0
+        self._next = 0  # 次に処理するブロック
+        self.dropped = 0
+        self._ready = asyncio.ThreadSafeFlag()
+        self.running = False
+
+    def _drain_fifo(self):
+        while (mem32[ADC_FCS] >> FCS_LEVEL_SHIFT) & FCS_LEVEL_MASK:
+            mem32[ADC_FIFO]
+
+    def _arm(self, index):
+        dma = self._dmas[index]
+        other = self._dmas[index ^ 1]
+        ctrl = dma.pack_ctrl(
+            size=1,  # 16bit
+            inc_read=False,
+            inc_write=True,
+            treq_sel=DREQ_ADC,
+            chain_to=other.channel,
+            # 既定ではチャネルの完了割り込みが上がらないので、ブロックの受け渡しができない
+            irq_quiet=False,
+        )
+        dma.config(
+            read=ADC_FIFO, write=self._buffers[index], count=self.block_size, ctrl=ctrl
+        )
+
+    def _on_block(self, dma):
+        index = 0 if dma is self._dmas[0] else 1
+        if self._filled[index]:
+            # 前のブロックを処理し終わる前に上書きされた
+            self.dropped += 1
+        self._filled[index] = True
+        self._filling = index ^ 1
+        # 連鎖でもう一方が動いている間に、書き込み先を先頭へ戻しておく
+        dma.write = self._buffers[index]
+        dma.count = self.block_size
+        self._ready.set()
+
+    def start(self):
+        if self.running:
+            return
+        self._filled = [False, False]
+        self._filling = 0
+        self._next = 0
+        self.dropped = 0
+
+        mem32[ADC_CS] = CS_EN | (self.channel << CS_AINSEL_SHIFT)
+        div = max(ADC_CONVERSION_CYCLES, ADC_CLOCK_HZ // self.rate_hz) - 1
+        mem32[ADC_DIV] = div << DIV_INT_SHIFT
+        # FCS_ERRは立てない (立てると変換エラーがサンプルのbit15に載り、12bitの値として扱えなくなる)
+        mem32[ADC_FCS] = FCS_EN | FCS_DREQ_EN | FCS_THRESH_1
+        self._drain_fifo()
+
+        for index in (0, 1):
+            self._arm(index)
+            self._dmas[index].irq(self._on_block)
+        self._dmas[0].active(1)
+        mem32[ADC_CS] |= CS_START_MANY
+        self.running = True
+
+    def stop(self):
+        """止めて、途中まで埋まっていたブロックの (インデックス, サンプル数) を返す"""
+        if not self.running:
+            return None
+        mem32[ADC_CS] = CS_EN | (self.channel << CS_AINSEL_SHIFT)
+        for dma in self._dmas:
+            dma.active(0)
+        index = self._filling
+        written = self.block_size - self._dmas[index].count
+        mem32[ADC_FCS] = 0
+        self._drain_fifo()
+        self.running = False
+        return index, written
+
+    def poll_block(self):
+        """
+        埋まったブロックがあれば古い順に (インデックス, array('H')) で返す なければNone
+        処理し終えたらrelease(インデックス)で返却する
+        """
+        index = self._next
+        if not self._filled[index]:
+            return None
+        self._next = index ^ 1
+        return index, self._buffers[index]
+
+    async def next_block(self):
+        """poll_blockの、ブロックが埋まるまで待つ版"""
+        while True:
+            block = self.poll_block()
+            if block is not None:
+                return block
+            await self._ready.wait()
+
+    def release(self, index):
+        self._filled[index] = False
+
+    def partial(self, stopped):
+        """stop()の戻り値から、最後の途中のブロックを (array('H'), サンプル数) で返す"""
+        if stopped is None:
+            return None
+        index, written = stopped
+        return self._buffers[index], written
+
+    async def record(self, path, seconds):
+        """
+        secondsの間取り込んだ生の値をトレースファイルに書く
+        PCへコピーして edge/bench/paper_replay.py で再生できる
+        """
+        total = self.rate_hz * seconds
+        written = 0
+        with open(path, "wb") as file:
+            write_trace_header(file, self.rate_hz)
+            self.start()
+            try:
+                while written < total:
+                    index, block = await self.next_block()
+                    file.write(block)
+                    self.release(index)
+                    written += self.block_size
+            finally:
+                self.stop()
+        print(f"[ADCBurstCapture] {written}サンプルを{path}に記録しました dropped={self.dropped}")
+
+    def close(self):
+        self.stop()
+        for dma in self._dmas:
+            dma.close()
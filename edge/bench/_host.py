@@ -0,0 +1,19 @@
+"""
+ベンチマークをPC(CPython)上で動かすための置き換え
+MicroPython固有のモジュールは edge/sim の偽物を使う
+"""
+
+import os
+import sys
+
+EDGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HUB_DIR = os.path.join(EDGE_DIR, "hub")
+
+
+def install():
+    if EDGE_DIR not in sys.path:
+        sys.path.insert(0, EDGE_DIR)
+
+    import sim
+
+    sim.install()
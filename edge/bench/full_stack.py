@@ -0,0 +1,69 @@
+"""
+ハブと周辺デバイス4台を仮想BLEバス(edge/sim)の上で一緒に動かし、1回の利用を通しで確かめる
+
+  python edge/bench/full_stack.py [--rolls 3] [--latency 15] [--jitter 0] [--loss 0] [--seed 0] [--real-time]
+
+人感センサーが検知 -> ロールを--rolls回回す -> 人がいなくなる、の流れを入れ、
+ペーパーの数、蓋の位置、水洗のステップ数、消臭のPWM、バスの統計を出す
+普段は仮想時計(sim.run)で動かすので、elapsedはシミュレーション上の時間
+"""
+
+import argparse
+import asyncio
+
+import _host
+
+_host.install()
+
+import sim  # noqa: E402
+
+# 検知器は検知開始から1秒はロールを数えないので、それより後に回し始める
+ROLL_DELAY_S = 1.5
+# 人がいなくなってから、蓋が閉まり水洗と消臭が終わるまで待つ時間
+SETTLE_S = 6
+
+
+async def scenario(args):
+    bus = sim.VirtualBLEBus(
+        latency_ms=args.latency, jitter_ms=args.jitter, loss=args.loss, seed=args.seed
+    )
+    async with sim.Simulator(bus=bus, log=args.verbose) as simulator:
+        started = sim.bus.now()
+        await simulator.wait_connected()
+        connected = sim.bus.now() - started
+
+        simulator.motion(1)
+        await asyncio.sleep(ROLL_DELAY_S)
+        simulator.paper_signal.roll(args.rolls)
+        await asyncio.sleep(max(0, simulator.paper_signal.busy_until() - sim.bus.now()) + 1)
+        simulator.motion(0)
+
+        journal = simulator.hub.history_journal
+        while journal.count == 0:
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(SETTLE_S)
+
+        print(f"connected : {connected:.2f}s")
+        print(f"journal   : {journal.peek(1)}")
+        print(f"lid       : position {simulator.servers['lid-controller'].motor.position}")
+        print(f"flusher   : {simulator.devices['auto-flusher'].state_machines[0].steps} steps")
+        print(f"deodorant : {simulator.devices['deodorant'].pwm_log}")
+        print(f"bus       : {bus.stats}")
+        print(f"elapsed   : {sim.bus.now() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rolls", type=int, default=3)
+    parser.add_argument("--latency", type=int, default=15, help="1パケットの遅延(ms)")
+    parser.add_argument("--jitter", type=int, default=0, help="遅延の揺れ(ms)")
+    parser.add_argument("--loss", type=float, default=0.0, help="応答なしで送るパケットを落とす割合")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="各デバイスのprintを出す")
+    parser.add_argument("--real-time", action="store_true", help="仮想時計を使わず実時間で動かす")
+    args = parser.parse_args()
+    (asyncio.run if args.real_time else sim.run)(scenario(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+ハブのセッション制御が待機中(誰もいない時)にイベントループを何回起こしているかを測る
+
+  python edge/bench/idle_wakeups.py [秒数]
+
+polling: 100msポーリングの検知器 + 100msポーリングの_control_devices (従来)
+event  : 割り込み駆動の検知器 + EventBusを待つ_control_devices
+"""
+
+import asyncio
+import sys
+
+import _host
+
+_host.install()
+
+from event_bus import EventBus, SESSION_START, SESSION_END  # noqa: E402
+from motion_sensor import PIRMotionDetector, IRQMotionDetector, EVENT_ENTER  # noqa: E402
+
+wakeups = 0
+
+
+def _count_wakeups(loop):
+    # ループが眠って(timeout付きでselectして)から起きた回数を数える
+    selector = loop._selector
+    original_select = selector.select
+
+    def select(timeout=None):
+        global wakeups
+        if timeout is None or timeout > 0:
+            wakeups += 1
+        return original_select(timeout)
+
+    selector.select = select
+
+
+async def polling_control(detector):
+    # 従来の Hub._control_devices と同じ形のループ
+    while True:
+        detector.is_detection_started()
+        detector.is_detection_ended()
+        await asyncio.sleep(0.1)
+
+
+async def event_control(detector):
+    bus = EventBus()
+    subscription = bus.subscribe(SESSION_START, SESSION_END)
+
+    async def watch_motion():
+        while True:
+            event = await detector.get_event()
+            bus.publish(SESSION_START if event == EVENT_ENTER else SESSION_END)
+
+    asyncio.create_task(watch_motion())
+    while True:
+        await subscription.get()
+
+
+async def measure(detector, control, duration):
+    global wakeups
+    _count_wakeups(asyncio.get_running_loop())
+    detector.monitoring = True
+    tasks = [
+        asyncio.create_task(detector.monitor_presence()),
+        asyncio.create_task(control(detector)),
+    ]
+    # 検知器の初期化待ち(PIRMotionDetectorは起動時に2秒待つ)が終わってから数える
+    await asyncio.sleep(2.5)
+    wakeups = 0
+    await asyncio.sleep(duration)
+    count = wakeups
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return count / duration
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    polling = asyncio.run(measure(PIRMotionDetector(), polling_control, duration))
+    event = asyncio.run(measure(IRQMotionDetector(), event_control, duration))
+
+    print(f"polling: {polling:.1f} wakeups/s")
+    print(f"event  : {event:.1f} wakeups/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+ペーパー観測機の検出器(paper_detector)に、記録した波形(トレース)を流してロール数を数える
+
+  python edge/bench/paper_replay.py トレース... [--expect ロール数]
+  python edge/bench/paper_replay.py --synthetic ロール数
+
+トレースは ADCBurstCapture.record() で実機の生の値を記録したもの
+検出器の変更で数え方が変わっていないかを確かめるのに使う
+--expect を付けると数が合わない時に終了コード1で終わる
+--synthetic は波形を合成して流す (トレースがない時の動作確認用)
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from paper_detector import COEFF_12BIT, feed_block, load_trace, make_detector  # noqa: E402
+
+# 実機と同じく、この周期に間引いてから検出器に渡す
+DETECTOR_RATE_HZ = 100
+# 実機のDMAと同じ大きさのブロックに区切って流す
+BLOCK_SIZE = 200
+
+
+def replay(rate_hz, samples):
+    decimation = max(1, rate_hz // DETECTOR_RATE_HZ)
+    detector = make_detector(rate_hz // decimation)
+    for start in range(0, len(samples), BLOCK_SIZE):
+        block = samples[start : start + BLOCK_SIZE]
+        feed_block(detector, block, decimation, COEFF_12BIT)
+    return detector.roll
+
+
+def synthesize(rolls, rate_hz=2000, seed=0):
+    """静かな区間の合間に、ロールが回る揺れ(10Hz)をrolls回入れた波形を作る"""
+    rng = random.Random(seed)
+    samples = array("H")
+
+    def quiet(seconds):
+        for _ in range(int(rate_hz * seconds)):
+            samples.append(2048 + rng.randint(-3, 3))
+
+    quiet(1.0)
+    for _ in range(rolls):
+        for i in range(int(rate_hz * 0.3)):
+            swing = 370 * math.sin(2 * math.pi * 10 * i / rate_hz)
+            samples.append(int(2048 + swing) + rng.randint(-3, 3))
+        quiet(1.5)
+    return rate_hz, samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("traces", nargs="*")
+    parser.add_argument("--expect", type=int)
+    parser.add_argument("--synthetic", type=int)
+    args = parser.parse_args()
+
+    inputs = [(path, load_trace(path)) for path in args.traces]
+    if args.synthetic is not None:
+        inputs.append((f"synthetic({args.synthetic})", synthesize(args.synthetic)))
+        if args.expect is None:
+            args.expect = args.synthetic
+    if not inputs:
+        parser.error("トレースか --synthetic を指定してください")
+
+    failed = False
+    for name, (rate_hz, samples) in inputs:
+        rolls = replay(rate_hz, samples)
+        seconds = len(samples) / rate_hz
+        result = ""
+        if args.expect is not None:
+            ok = rolls == args.expect
+            failed = failed or not ok
+            result = " OK" if ok else f" NG (expected {args.expect})"
+        print(f"{name}: {rolls} rolls in {seconds:.1f}s @ {rate_hz}Hz{result}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
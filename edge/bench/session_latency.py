@@ -0,0 +1,266 @@
+"""
+ハブの1回の利用(セッション)で、利用者が待つ時間を段階ごとに測る
+
+  python edge/bench/session_latency.py [--sessions 1000] [--update-baseline] [--real-time]
+
+ハブと周辺デバイス4台を仮想BLEバス(edge/sim)で、Cloud Functionsを手元のHTTPサーバーで動かし、
+人感センサーの入室・退室を繰り返して Hub._control_devices の流れを通す
+仮想時計(sim.run)で動かすので、1000セッション(シミュレーション上で2時間ほど)が数秒で終わり、
+同じ設定なら毎回同じ結果になる
+
+  lid_open   : 入室のエッジ -> 蓋開閉機に開ける指示が届く
+  lid_closed : 退室(SESSION_END) -> 蓋開閉機から閉め終わった通知が届く
+  flush      : 退室 -> 自動水洗に流す指示が届く
+  spray      : 退室 -> 消臭に指示が届く
+  history    : 退室 -> saveHistoryBatchが履歴を受け付ける
+
+段階ごとのp50/p95/p99(ms)を出し、基準値(session_latency_baseline.json)より
+tolerance以上遅くなった段階があるか、最後まで届かなかった段階があるか、
+蓋が閉まる前に水洗・消臭の指示が届いたセッションがあれば終了コード1で終わる
+分布は蓋が閉まり切るかどうかで2つの山になるので、基準値はそれを作った時の設定(セッション数や
+シードなど)と一緒に保存し、設定が同じ時だけ比べる
+退室は不在のタイムアウト(--presence-timeout)の後に判定されるので、その待ち時間は含まない
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+
+import _host
+
+_host.install()
+
+import sim  # noqa: E402
+from sim.bus import now  # noqa: E402
+from event_bus import SESSION_END  # noqa: E402
+
+STAGES = ("lid_open", "lid_closed", "flush", "spray", "history")
+PERCENTILES = (50, 95, 99)
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "session_latency_baseline.json")
+
+# 段階ごとに、どのデバイスのどの出来事で終わったとみなすか
+# (kind, デバイス名またはパス, データ, 起点)
+STAGE_EVENTS = {
+    "lid_open": ("write", "lid-controller", b"\x01", "enter"),
+    "lid_closed": ("notify", "lid-controller", b"\x01", "leave"),
+    "flush": ("write", "auto-flusher", b"\x01", "leave"),
+    "spray": ("write", "deodorant", b"\x01", "leave"),
+    "history": ("http", "/saveHistoryBatch", None, "leave"),
+}
+
+# セッションごとに守られているべき順序 (先の段階, 後の段階)
+# ハブは蓋が閉まり切ってから水洗と消臭を指示するので、これが逆なら古い完了通知などで
+# close()が早く戻っている
+STAGE_ORDER = (("lid_closed", "flush"), ("lid_closed", "spray"))
+
+# 基準値と比べる時に揃っている必要がある設定
+BASELINE_SETTINGS = (
+    "sessions",
+    "stay_min",
+    "stay_max",
+    "gap",
+    "presence_timeout",
+    "latency",
+    "jitter",
+    "loss",
+    "function_ms",
+    "seed",
+    "real_time",
+)
+
+# 全ての段階が揃うまで待つ時間 これを過ぎたら届かなかったとして次のセッションへ進む
+SESSION_TIMEOUT_S = 30
+
+
+class SessionTimer:
+    """bus.observe()とSESSION_ENDの発行を受けて、今のセッションの段階ごとの所要時間を記録する"""
+
+    def __init__(self):
+        self.marks = {}
+        self.latencies = {}
+        self.done = asyncio.Event()
+
+    def begin(self):
+        self.marks = {"enter": now()}
+        self.latencies = {}
+        self.done.clear()
+
+    def mark(self, name):
+        self.marks[name] = now()
+
+    def observe(self, kind, *args):
+        if kind == "http":
+            source, data = args[1], None
+        else:
+            source, data = args[0].name, bytes(args[2])
+        for stage, (stage_kind, stage_source, stage_data, origin) in STAGE_EVENTS.items():
+            if (
+                stage in self.latencies
+                or origin not in self.marks
+                or kind != stage_kind
+                or source != stage_source
+                or (stage_data is not None and data != stage_data)
+            ):
+                continue
+            self.latencies[stage] = (now() - self.marks[origin]) * 1000
+        if len(self.latencies) == len(STAGES):
+            self.done.set()
+
+
+def percentile(values, p):
+    """最近順位法のパーセンタイル"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(samples):
+    return {
+        stage: {f"p{p}": round(percentile(values, p), 1) for p in PERCENTILES}
+        for stage, values in samples.items()
+        if values
+    }
+
+
+async def run_sessions(args):
+    bus = sim.VirtualBLEBus(
+        latency_ms=args.latency, jitter_ms=args.jitter, loss=args.loss, seed=args.seed
+    )
+    rng = random.Random(args.seed)
+    samples = {stage: [] for stage in STAGES}
+    missing = {stage: 0 for stage in STAGES}
+    out_of_order = {pair: 0 for pair in STAGE_ORDER}
+    timer = SessionTimer()
+
+    async with sim.Simulator(bus=bus, log=args.verbose) as simulator:
+        async with sim.CloudFunctionsStub(response_delay_ms=args.function_ms):
+            await simulator.wait_connected()
+            await simulator.connect_wifi()
+            hub = simulator.hub
+            hub.motion_detector.presence_timeout = args.presence_timeout
+
+            # SESSION_ENDが流れた瞬間を退室の時刻にする
+            publish = hub.event_bus.publish
+
+            def publish_and_mark(event, payload=None):
+                if event == SESSION_END:
+                    timer.mark("leave")
+                publish(event, payload)
+
+            hub.event_bus.publish = publish_and_mark
+            bus.observers.append(timer.observe)
+
+            for i in range(args.sessions):
+                timer.begin()
+                simulator.motion(1)
+                await asyncio.sleep(rng.uniform(args.stay_min, args.stay_max))
+                simulator.motion(0)
+                try:
+                    await asyncio.wait_for(timer.done.wait(), SESSION_TIMEOUT_S)
+                except asyncio.TimeoutError:
+                    pass
+                for stage in STAGES:
+                    if stage in timer.latencies:
+                        samples[stage].append(timer.latencies[stage])
+                    else:
+                        missing[stage] += 1
+                for before, after in STAGE_ORDER:
+                    latencies = timer.latencies
+                    if before in latencies and after in latencies and latencies[after] < latencies[before]:
+                        out_of_order[(before, after)] += 1
+                if not args.verbose:
+                    print(f"\rsession {i + 1}/{args.sessions}", end="", file=sys.stderr)
+                await asyncio.sleep(args.gap)
+            if not args.verbose:
+                print(file=sys.stderr)
+
+    return samples, missing, out_of_order, bus.stats
+
+
+def compare(summary, baseline, tolerance, slack_ms):
+    """基準値より遅くなった (段階, パーセンタイル, 今回, 基準) のリスト"""
+    regressions = []
+    for stage, values in summary.items():
+        base = baseline.get(stage)
+        if base is None:
+            continue
+        for key, value in values.items():
+            if key in base and value > base[key] * (1 + tolerance) + slack_ms:
+                regressions.append((stage, key, value, base[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--stay-min", type=float, default=1.0, help="入室から退室までの最短(秒)")
+    parser.add_argument("--stay-max", type=float, default=3.0, help="入室から退室までの最長(秒)")
+    parser.add_argument("--gap", type=float, default=1.0, help="セッションの間隔(秒)")
+    parser.add_argument("--presence-timeout", type=int, default=1, help="不在と判定するまでの秒数")
+    parser.add_argument("--latency", type=int, default=15, help="1パケットの遅延(ms)")
+    parser.add_argument("--jitter", type=int, default=5, help="遅延の揺れ(ms)")
+    parser.add_argument("--loss", type=float, default=0.0, help="応答なしで送るパケットを落とす割合")
+    parser.add_argument("--function-ms", type=int, default=50, help="Cloud Functionsの応答時間(ms)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="基準値から許す遅れの割合")
+    parser.add_argument("--slack-ms", type=float, default=10, help="割合とは別に許す遅れ(ms)")
+    parser.add_argument("--update-baseline", action="store_true", help="今回の結果を基準値として保存する")
+    parser.add_argument("--verbose", action="store_true", help="各デバイスのprintを出す")
+    parser.add_argument("--real-time", action="store_true", help="仮想時計を使わず実時間で動かす")
+    args = parser.parse_args()
+
+    samples, missing, out_of_order, stats = (asyncio.run if args.real_time else sim.run)(run_sessions(args))
+    summary = summarize(samples)
+
+    print(f"{'stage':<11}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'missing':>9}")
+    for stage in STAGES:
+        values = summary.get(stage, {})
+        row = "".join(f"{values.get(f'p{p}', float('nan')):>9.1f}" for p in PERCENTILES)
+        print(f"{stage:<11}{len(samples[stage]):>6}{row}{missing[stage]:>9}")
+    print(f"bus: {stats}")
+
+    failed = False
+    for (before, after), count in out_of_order.items():
+        if count:
+            print(f"{before}より先に{after}が届いたセッションがあります: {count}件")
+            failed = True
+    lost = [stage for stage in STAGES if missing[stage]]
+    if lost:
+        print(f"最後まで届かなかった段階があります: {lost}")
+        failed = True
+
+    settings = {name: getattr(args, name) for name in BASELINE_SETTINGS}
+    if args.update_baseline:
+        # おかしな結果を基準値にしてしまわないよう、順序や欠けに問題がある時は保存しない
+        if failed:
+            print("問題があるので基準値を保存しません")
+            sys.exit(1)
+        with open(args.baseline, "w") as file:
+            json.dump({"settings": settings, "stages": summary}, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"基準値を保存しました: {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"基準値がありません (--update-baseline で作れます): {args.baseline}")
+        sys.exit(1 if failed else 0)
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline["settings"] != settings:
+        print(f"設定が基準値と違うので比べません\n\t基準: {baseline['settings']}\n\t今回: {settings}")
+    else:
+        for stage, key, value, base in compare(
+            summary, baseline["stages"], args.tolerance, args.slack_ms
+        ):
+            print(f"遅くなりました: {stage} {key} {value:.1f}ms (基準 {base:.1f}ms)")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,69 @@
 import asyncio
 import aioble
+import struct
+import time
 from machine import Pin
+from micropython import const
+import log
+from trace_ring import trace, TR_STREAM_RX_BEGIN, TR_STREAM_RX_END, TR_STREAM_ACK
+
+# streamで受け取る1パケットの最大長
+STREAM_PACKET_SIZE = const(20)
+# streamで受け取る1メッセージの最大長
+MAX_STREAM_MESSAGE_SIZE = const(2048)
+# 1メッセージを受け取り切るまでの制限時間
+STREAM_MESSAGE_TIMEOUT_MS = const(5000)
+# start_listenでメッセージを待つ時間
+STREAM_LISTEN_TIMEOUT_MS = const(10000)
+# 待ち受けより先に届いたメッセージを取っておく時間
+STREAM_EARLY_MESSAGE_TTL_MS = const(5000)
+
+# コマンドの2バイト目で相手が伝えてくる対応機能
+CAP_STREAM_V1 = const(0x01)  # MTUに合わせた連番付きのstream(ack付き)
+CAP_BINARY = const(0x02)  # streamの中身をJSONではなくバイナリ(TLV)でやり取りする
+
+# streamの送信(v1)
+# ヘッダー: version(u8) flags(u8) 全体の長さ(u32) 1パケットのデータ長(u16) パケット数(u16) ウィンドウ(u8)
+# データ : 連番(u16) + データ
+# ack    : STREAM_ACK(u8) + 受け取り済みの最後の連番(u16) を相手がstreamに書き込む
+STREAM_VERSION = const(1)
+STREAM_HEADER_FORMAT = ">BBIHHB"
+# ヘッダーのflags
+STREAM_FLAG_BINARY = const(0x01)  # 中身がJSONではなくバイナリ
+STREAM_SEQ_SIZE = const(2)
+STREAM_ACK = const(0xAC)
+STREAM_ACK_SIZE = const(3)
+# 希望するATT MTU (データは最大244バイト)
+STREAM_MTU = const(247)
+DEFAULT_ATT_MTU = const(23)
+# ackを待たずに送ってよいパケット数
+STREAM_WINDOW = const(8)
+STREAM_ACK_TIMEOUT_MS = const(1000)
+STREAM_MAX_RETRIES = const(3)
+
+
+class StreamMessageError(ValueError):
+    """streamのメッセージを受け取り切れなかった (長さが不正・時間切れ・パケットが大きすぎる)"""
+
+
+class StreamMessageFuture:
+    """streamで届くはずのメッセージ1つ分の待ち受け"""
+
+    def __init__(self):
+        self._event = asyncio.Event()
+        self._message = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, message):
+        self._message = message
+        self._event.set()
+
+    async def result(self, timeout_ms):
+        """届くまで待って返す 間に合わなければasyncio.TimeoutError"""
+        await asyncio.wait_for_ms(self._event.wait(), timeout_ms)
+        return self._message
 
 
 class BenTechDeviceServer:
@@ -13,6 +76,7 @@ class BenTechDeviceServer:
 
     def __init__(self, name, service_id, control_char_id):
         self.name = name
+        self.service_id = service_id
         self.service = aioble.Service(service_id)
         self.control_char = aioble.Characteristic(
             self.service,
@@ -25,18 +89,20 @@ class BenTechDeviceServer:
         self.connection = None
 
     async def _wait_to_connect(self):
-        print("接続を待ちます")
+        log.info("接続を待ちます")
         while self.connection is None:
             try:
+                # hubがサービスUUIDで見つけられるように載せる (入りきらない分はスキャン応答に回る)
                 self.connection = await aioble.advertise(
                     100,
                     name=self.name,
+                    services=[self.service_id],
                 )
             except asyncio.TimeoutError:
                 pass
             except Exception as e:
-                print(f"[_do_wait_to_connect] 予期しないエラーが発生\n\t{e}")
-        print("接続されました")
+                log.error("[_do_wait_to_connect] 予期しないエラーが発生\n\t{}", e)
+        log.info("接続されました")
 
     async def _listen_control(self):
         while self.connection is not None and self.connection.is_connected():
@@ -46,12 +112,15 @@ class BenTechDeviceServer:
                 await self._handle_control(command)
             except asyncio.TimeoutError:
                 pass
+            except ValueError as e:
+                # 壊れたメッセージで受付ごと止まらないよう、その命令だけ諦める
+                log.warning("[_listen_control] 命令を処理できませんでした {}", e)
         self.connection = None
-        print("接続が切断されたため操作の受付を終了しました")
+        log.info("接続が切断されたため操作の受付を終了しました")
 
     async def _handle_control(self, command):
-        print(
-            f"commandを受け取りましたが、ハンドラがオーバーライドされていません\n\tcommand:{command}"
+        log.warning(
+            "commandを受け取りましたが、ハンドラがオーバーライドされていません\n\tcommand:{}", command
         )
 
     async def run(self):
@@ -79,7 +148,8 @@ class BenTechResponsiveDeviceServer(BenTechDeviceServer):
 
     def _notify_response(self, data):
         self.response_char.notify(self.connection, data)
-        print(f"レスポンスを通知しました\n\t{data}")
+        if __debug__:
+            log.debug("レスポンスを通知しました\n\t{}", data)
 
 
 class BenTechStreamableDeviceServer(BenTechResponsiveDeviceServer):
@@ -95,64 +165,228 @@ class BenTechStreamableDeviceServer(BenTechResponsiveDeviceServer):
         self.stream_char = aioble.Characteristic(
             self.service, stream_char_id, write=True, notify=True, capture=True
         )
-        self.should_listen = False
-        self.listen_result = ""
+        self._message_future = None
+        # 待ち受けより先に届いたメッセージと、その受信時刻
+        self._early_message = None
+        self._early_message_at = 0
+        self._stream_acked = -1
+        self._stream_ack_event = asyncio.Event()
+        # 相手がMTUの交換を持ちかけてきた時に大きなMTUを受け入れる
+        aioble.config(mtu=STREAM_MTU)
 
-    async def _send_stream(self, msg):
-        byte_array = msg.encode("utf-8")
-        length = len(byte_array)
+    async def _send_stream(self, msg, capabilities=0):
+        # 文字列はJSON、bytes/bytearrayはバイナリとして送る
+        binary = not isinstance(msg, str)
+        data = msg if binary else msg.encode("utf-8")
+        if capabilities & CAP_STREAM_V1:
+            await self._send_stream_v1(data, STREAM_FLAG_BINARY if binary else 0)
+        else:
+            self._send_stream_legacy(data)
 
-        count = (length // 20) + 1
-        print(f"[_send_stream] {msg} を {count} 回に分けて送信することを伝えます")
+    def _send_stream_legacy(self, data):
+        # 20バイト固定で区切る旧形式 (ヘッダーはパケット数のみ)
+        length = len(data)
+        count = (length + STREAM_PACKET_SIZE - 1) // STREAM_PACKET_SIZE
+        if __debug__:
+            log.debug("[_send_stream] {}バイトを {} 回に分けて送信することを伝えます", length, count)
         self.stream_char.notify(self.connection, count.to_bytes(4, "big"))
 
         for i in range(count):
-            start = i * 20
-            end = length if i == (count - 1) else (start + 20)
-            packet = byte_array[start:end]
-            self.stream_char.notify(self.connection, packet)
-        print("[_send_stream] 送信終了")
+            start = i * STREAM_PACKET_SIZE
+            self.stream_char.notify(
+                self.connection, data[start : start + STREAM_PACKET_SIZE]
+            )
+        if __debug__:
+            log.debug("[_send_stream] 送信終了")
+
+    def _stream_payload_size(self):
+        # 交換済みのMTUから1パケットに載せられるデータ長を決める
+        mtu = getattr(self.connection, "mtu", None) or DEFAULT_ATT_MTU
+        return min(STREAM_MTU, mtu) - 3 - STREAM_SEQ_SIZE
+
+    async def _notify_stream_packet(self, packet):
+        # 送信バッファが一杯の時は少し待って送り直す
+        for _ in range(STREAM_MAX_RETRIES):
+            try:
+                self.stream_char.notify(self.connection, packet)
+                return
+            except OSError:
+                await asyncio.sleep_ms(10)
+        self.stream_char.notify(self.connection, packet)
+
+    async def _send_stream_v1(self, data, flags=0):
+        length = len(data)
+        payload_size = self._stream_payload_size()
+        count = (length + payload_size - 1) // payload_size
+        if __debug__:
+            log.debug(
+                "[_send_stream] {}バイトを {}バイトずつ {} 回に分けて送信します",
+                length,
+                payload_size,
+                count,
+            )
+
+        self._stream_acked = -1
+        self._stream_ack_event.clear()
+        header = struct.pack(
+            STREAM_HEADER_FORMAT,
+            STREAM_VERSION,
+            flags,
+            length,
+            payload_size,
+            count,
+            STREAM_WINDOW,
+        )
+        await self._notify_stream_packet(header)
+
+        view = memoryview(data)
+        packet = bytearray(STREAM_SEQ_SIZE + payload_size)
+        packet_view = memoryview(packet)
+        base = 0  # ackされていない最初の連番
+        next_seq = 0
+        retries = 0
+
+        while base < count:
+            # ウィンドウの分だけackを待たずに送る
+            while next_seq < count and next_seq < base + STREAM_WINDOW:
+                start = next_seq * payload_size
+                size = min(payload_size, length - start)
+                struct.pack_into(">H", packet, 0, next_seq)
+                packet_view[STREAM_SEQ_SIZE : STREAM_SEQ_SIZE + size] = view[
+                    start : start + size
+                ]
+                await self._notify_stream_packet(packet_view[: STREAM_SEQ_SIZE + size])
+                next_seq += 1
+
+            try:
+                await asyncio.wait_for_ms(
+                    self._stream_ack_event.wait(), STREAM_ACK_TIMEOUT_MS
+                )
+            except asyncio.TimeoutError:
+                retries += 1
+                if retries > STREAM_MAX_RETRIES:
+                    log.warning("[_send_stream] ackが返ってこないので送信を諦めます")
+                    return
+                # ackされていないところから送り直す
+                next_seq = base
+                continue
+            self._stream_ack_event.clear()
+
+            if self._stream_acked + 1 > base:
+                base = self._stream_acked + 1
+                retries = 0
+        if __debug__:
+            log.debug("[_send_stream] 送信終了")
+
+    def _handle_stream_ack(self, data):
+        acked = struct.unpack_from(">H", data, 1)[0]
+        if acked > self._stream_acked:
+            self._stream_acked = acked
+            self._stream_ack_event.set()
 
     async def _listen_stream(self):
         while self.connection is not None and self.connection.is_connected():
             try:
                 _, data = await self.stream_char.written(timeout_ms=1000)
-                # フラグが立ってない時はブレーク
-                if not self.should_listen:
-                    print("Listenすべき時じゃないのでcontinueします")
+                if len(data) == STREAM_ACK_SIZE and data[0] == STREAM_ACK:
+                    self._handle_stream_ack(data)
+                    trace(TR_STREAM_ACK, self._stream_acked)
                     continue
-
                 # まず送られてくるデータの長さを読む
-                length = int.from_bytes(data)
-                print(
-                    f"[_receive_socker_communication] これから{length}個のデータが送られてきます"
-                )
-
-                # 連結済みのbytes
-                joinned_data = bytes()
-
-                # 受け取り次第連結
-                for _ in range(length):
-                    _, data = await self.stream_char.written()
-                    joinned_data += data
+                length = int.from_bytes(data, "big")
+                trace(TR_STREAM_RX_BEGIN, min(length, 0x7FFFFFFF))
+                if __debug__:
+                    log.debug(
+                        "[_receive_socker_communication] これから{}個のデータが送られてきます", length
+                    )
 
-                msg = joinned_data.decode("utf-8")
-                print(
-                    f"[_receive_socker_communication] メッセージを受け取りました\n\t{msg}"
-                )
-                self.listen_result = msg
-                self.should_listen = False
+                try:
+                    msg = await self._receive_stream_message(length)
+                except StreamMessageError as e:
+                    # 受け取り切れなかったメッセージは捨て、次のメッセージを待つ
+                    trace(TR_STREAM_RX_END, -1)
+                    log.warning("[_receive_stream_message] {}", e)
+                    continue
+                trace(TR_STREAM_RX_END, len(msg))
+                if __debug__:
+                    log.debug(
+                        "[_receive_socker_communication] {}バイトのメッセージを受け取りました", len(msg)
+                    )
+                self._deliver_stream_message(msg)
 
             except asyncio.TimeoutError:
                 pass
         self.connection = None
-        print("接続が切断されたためStreamの受付を終了しました")
+        self._early_message = None
+        log.info("接続が切断されたためStreamの受付を終了しました")
 
-    async def start_listen(self):
-        self.should_listen = True
-        while self.should_listen:
-            await asyncio.sleep(0.1)
-        return self.listen_result
+    async def _receive_stream_message(self, length):
+        """lengthパケット分のメッセージを受け取る 受け取り切れなければStreamMessageError"""
+        # パケット数から大きさを決めたバッファを1度だけ確保し、そこへ直接書き込む
+        capacity = length * STREAM_PACKET_SIZE
+        if length == 0 or capacity > MAX_STREAM_MESSAGE_SIZE:
+            raise StreamMessageError(f"受け取れない長さです length={length}")
+
+        buffer = bytearray(capacity)
+        view = memoryview(buffer)
+        received = 0
+        deadline = time.ticks_add(time.ticks_ms(), STREAM_MESSAGE_TIMEOUT_MS)
+
+        for _ in range(length):
+            remaining_ms = time.ticks_diff(deadline, time.ticks_ms())
+            if remaining_ms <= 0:
+                raise StreamMessageError("時間内に受け取り切れませんでした")
+            try:
+                _, data = await self.stream_char.written(timeout_ms=remaining_ms)
+            except asyncio.TimeoutError:
+                raise StreamMessageError("時間内に受け取り切れませんでした")
+
+            size = len(data)
+            if received + size > capacity:
+                raise StreamMessageError(f"パケットが大きすぎます size={size}")
+            view[received : received + size] = data
+            received += size
+
+        return bytes(view[:received])
+
+    def _deliver_stream_message(self, msg):
+        future = self._message_future
+        if future is not None and not future.done():
+            self._message_future = None
+            future.set_result(msg)
+            return
+        # コマンドの処理が始まる前に届くことがあるので取っておく
+        self._early_message = msg
+        self._early_message_at = time.ticks_ms()
+
+    def _take_early_message(self):
+        msg = self._early_message
+        self._early_message = None
+        if msg is None:
+            return None
+        age = time.ticks_diff(time.ticks_ms(), self._early_message_at)
+        if age > STREAM_EARLY_MESSAGE_TTL_MS:
+            log.info("[start_listen] 古いメッセージを捨てました")
+            return None
+        return msg
+
+    async def start_listen(self, binary=False, timeout_ms=STREAM_LISTEN_TIMEOUT_MS):
+        """
+        streamで送られてくる次のメッセージを待つ binaryでなければ文字列にして返す
+        timeout_ms以内に届かなければasyncio.TimeoutError
+        """
+        msg = self._take_early_message()
+        if msg is None:
+            future = StreamMessageFuture()
+            self._message_future = future
+            try:
+                msg = await future.result(timeout_ms)
+            finally:
+                if self._message_future is future:
+                    self._message_future = None
+        if binary:
+            return msg
+        return str(msg, "utf-8")
 
     async def run(self):
         aioble.register_services(self.service)
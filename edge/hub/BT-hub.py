@@ -4,6 +4,7 @@ import uasyncio
 import aioble
 import bluetooth
 import network
+import rp2
 import ujson
 
 # import urequests
@@ -11,15 +12,59 @@ import ujson
 from micropython import const
 from common import (
     BenTechStreamableDeviceServer,
+    CAP_BINARY,
 )  # pico側では同階層、開発側では違う階層
+from common_hub import (
+    BenTechDeviceManager,
+    ConnectionSupervisor,
+    ControllableDeviceManager,
+    DELIVERY_UNACKED,
+)
+from event_bus import (
+    EventBus,
+    SESSION_START,
+    SESSION_END,
+    DEVICE_CONNECTED,
+    DEVICE_LOST,
+    WIFI_UP,
+    WIFI_DOWN,
+)
 from device_managers import (
     LidControllerManager,
     PaperObserverManager,
     AutoFlusherManager,
     DeodorantManager,
 )
-from motion_sensor import PIRMotionDetector
-from usocket_firebase_test import send_post_request
+from device_registry import DeviceRegistry
+from gatt_cache import GATTCache
+from history_journal import HistoryJournal
+from stream_codec import (
+    decode_subscription,
+    decode_wifi_data,
+    encode_devices,
+    encode_info,
+    encode_trace,
+)
+from trace_ring import (
+    TRACE,
+    trace,
+    TR_SESSION_START,
+    TR_SESSION_OPENED,
+    TR_SESSION_END,
+    TR_SESSION_CLOSED,
+    TR_SESSION_DISPATCHED,
+    TR_SESSION_SAVED,
+)
+from motion_sensor import PIRMotionDetector, IRQMotionDetector, EVENT_ENTER
+from usocket_firebase_test import async_send_post_request
+
+# 1リクエストでまとめて送る履歴の最大件数
+HISTORY_BATCH_SIZE = const(16)
+
+# Falseにするとポーリング方式の検知器にフォールバックする
+USE_IRQ_MOTION_DETECTOR = const(True)
+# Trueにするとブートセルボタンで入退室を模擬できる（ボタンを100msごとにポーリングする）
+USE_MOCK_MOTION_DETECTOR = const(False)
 
 MOCKVAR_is_detection_started = False
 
@@ -76,6 +121,7 @@ class Hub(BenTechStreamableDeviceServer):
         "DISCONNECT_WIFI": b"\x03",
         "SET_SUBSCRIPTION": b"\x04",
         "RE_SCAN": b"\x05",
+        "DUMP_TRACE": b"\x06",
     }
 
     RESPONSES = {
@@ -92,61 +138,94 @@ class Hub(BenTechStreamableDeviceServer):
             stream_char_id=bluetooth.UUID("feb2f5aa-ec75-46ef-8da6-2da832175d8e"),
         )
         self.wlan = network.WLAN(network.STA_IF)
+        # 再起動後も周辺デバイスのハンドルを探し直さずに済むようにする
+        BenTechDeviceManager.gatt_cache = GATTCache()
+        BenTechDeviceManager.device_registry = DeviceRegistry()
         # self.timer = Timer()
         self.lid_controller_manager = LidControllerManager()
         self.paper_observer_manager = PaperObserverManager()
         self.auto_flusher_manager = AutoFlusherManager()
         self.deodorant_manager = DeodorantManager()
-        self.motion_detector = PIRMotionDetector()
+        # 切断されたデバイスへ自動で繋ぎ直す
+        self.connection_supervisor = ConnectionSupervisor(
+            self._device_managers(),
+            on_connected=self._on_device_connected,
+            on_lost=self._on_device_lost,
+        )
+        self.motion_detector = (
+            IRQMotionDetector() if USE_IRQ_MOTION_DETECTOR else PIRMotionDetector()
+        )
         self.mock_motion_detector = MockPIRMotionDetector()
+        self.event_bus = EventBus()
+        self.history_journal = HistoryJournal()
+        self.upload_history_lock = uasyncio.Lock()
         self.subscription = None
 
         # JSONファイルから復元
         with open("subscription.json", "r") as file:
             self.subscription = ujson.load(file)
+        # 以前はJSON文字列のまま保存していた
+        if isinstance(self.subscription, str):
+            self.subscription = ujson.loads(self.subscription)
 
     ###### Firebase関連 ######
     async def _save_history(self, staying_time, used_roll_count):
+        # 送信できるまで失わないよう、まずジャーナルに書く
         print("履歴を保存します")
+        self.history_journal.append(staying_time, used_roll_count)
+
         if not self.wlan.isconnected():
-            print("WiFiにつながっていないので通知できません")
+            print(
+                f"WiFiにつながっていないので後で送信します (未送信{self.history_journal.count}件)"
+            )
             return
 
-        data = {
-            "stayingTime": staying_time,
-            "usedRollCount": used_roll_count,
-            "subscription": self.subscription,
-        }
-
-        """
-        data = ujson.dumps(data).encode("utf-8")
-
-        response = urequests.post(
-            "https://savehistory-t2l7bkkhbq-an.a.run.app",
-            headers={"Content-Type": "application/ujson"},
-            data=data,
-        )
-        print(
-            f"履歴保存をリクエストしました\n\tstatus_code: {response.status_code}\n\ttext: {response.text}"
-        )
-        response.close()
-        """
-
-        send_post_request(
-            "https://asia-northeast1-jphacks-ben-tech.cloudfunctions.net/saveHistory",
-            data,
-        )
-        print(f"履歴保存をリクエストしました")
+        await self._upload_history()
+
+    async def _upload_history(self):
+        # ジャーナルに溜まった履歴をまとめて送信し、成功した分だけ消す
+        async with self.upload_history_lock:
+            while self.history_journal.count > 0:
+                if not self.wlan.isconnected():
+                    return
+
+                sessions = self.history_journal.peek(HISTORY_BATCH_SIZE)
+                data = {
+                    "sessions": sessions,
+                    "subscription": self.subscription,
+                }
+                try:
+                    await async_send_post_request(
+                        "https://asia-northeast1-jphacks-ben-tech.cloudfunctions.net/saveHistoryBatch",
+                        data,
+                    )
+                except Exception as e:
+                    print(f"履歴保存のリクエストに失敗しました {e}")
+                    return
+
+                self.history_journal.drop(len(sessions))
+                print(f"履歴{len(sessions)}件の保存をリクエストしました")
+
+    async def _upload_history_on_wifi_up(self):
+        # 起動時とWiFiにつながるたびに、溜まっている履歴を送信する
+        subscription = self.event_bus.subscribe(WIFI_UP)
+        while True:
+            await self._upload_history()
+            await subscription.get()
 
     async def _update_data(self, params):
         # dev/dataを編集する
         if not self.wlan.isconnected():
             print("WiFiにつながっていないので通知できません")
             return
-        send_post_request(
-            "https://asia-northeast2-jphacks-ben-tech.cloudfunctions.net/editData",
-            params,
-        )
+        try:
+            await async_send_post_request(
+                "https://asia-northeast2-jphacks-ben-tech.cloudfunctions.net/editData",
+                params,
+            )
+        except Exception as e:
+            print(f"dataの変更のリクエストに失敗しました {e}")
+            return
         """
         response = urequests.post(
             "https://editdata-t2l7bkkhbq-dt.a.run.app",
@@ -158,11 +237,18 @@ class Hub(BenTechStreamableDeviceServer):
         # response.close()
 
     ###### Web Appとの通信関連 ######
-    async def _listen_wifi_data(self):
+    async def _listen_wifi_data(self, capabilities=0):
+        if capabilities & CAP_BINARY:
+            return decode_wifi_data(await self.start_listen(binary=True))
         msg = await self.start_listen()
         wifi_data = ujson.loads(msg)
         return wifi_data["ssid"], wifi_data["password"]
 
+    async def _listen_subscription(self, capabilities=0):
+        if capabilities & CAP_BINARY:
+            return decode_subscription(await self.start_listen(binary=True))
+        return ujson.loads(await self.start_listen())
+
     async def _connect_wifi(self, ssid, password):
         print(ssid, password)
         self.wlan.active(True)
@@ -179,16 +265,19 @@ class Hub(BenTechStreamableDeviceServer):
 
         if count >= limit_sec:
             print("WiFiルーターと接続失敗")
+            self.event_bus.publish(WIFI_DOWN)
             # 失敗したことを伝える
             self._notify_response(__class__.RESPONSES["WIFI_CONNECT_FAILED"])
             return
 
         print("WiFiルーターと接続完了")
+        self.event_bus.publish(WIFI_UP)
         # 完了したことを伝える
         self._notify_response(__class__.RESPONSES["WIFI_CONNECT_COMPLETED"])
 
     async def _disconnect_wifi(self):
         self.wlan.disconnect()
+        self.event_bus.publish(WIFI_DOWN)
         print("wifiとの接続解除をwlanに指示しました")
 
     def _get_connected_devices_list(self):
@@ -205,32 +294,67 @@ class Hub(BenTechStreamableDeviceServer):
 
         return retv
 
-    async def _stream_info(self):
+    async def _stream_info(self, capabilities=0):
+        if capabilities & CAP_BINARY:
+            data = encode_info(
+                self.wlan.isconnected(),
+                self.subscription,
+                self._get_connected_devices_list(),
+            )
+            await self._send_stream(data, capabilities)
+            return
+
         data = {
             "WIFI_CONNECTED": self.wlan.isconnected(),
             "SUBSCRIPTION": self.subscription,
             "CONNECTED_DEVICES": self._get_connected_devices_list(),
         }
-        await self._send_stream(ujson.dumps(data))
+        await self._send_stream(ujson.dumps(data), capabilities)
+
+    async def _stream_trace(self, capabilities=0):
+        # 新しいコマンドなので、受け取れるWeb Appはバイナリにも対応している
+        print(f"トレースを{len(TRACE)}件送ります")
+        await self._send_stream(encode_trace(TRACE), capabilities)
 
     async def _handle_control(self, command):
+        # 2バイト目があれば、それはWeb Appが対応している機能 (common.CAP_*)
+        capabilities = command[1] if len(command) > 1 else 0
+        command = command[:1]
+
         if command == __class__.COMMANDS["CONNECT_WIFI"]:
             print("接続用のデータを受け付けます")
-            ssid, password = await self._listen_wifi_data()
+            try:
+                ssid, password = await self._listen_wifi_data(capabilities)
+            except uasyncio.TimeoutError:
+                print("接続用のデータが届きませんでした")
+                self._notify_response(__class__.RESPONSES["WIFI_CONNECT_FAILED"])
+                return
+            except (ValueError, KeyError) as e:
+                # 壊れたTLVやJSONで操作の受付ごと止まらないよう、失敗として返す
+                print(f"接続用のデータが読めませんでした {e}")
+                self._notify_response(__class__.RESPONSES["WIFI_CONNECT_FAILED"])
+                return
 
             print("WiFiへ接続します")
             await self._connect_wifi(ssid, password)
         elif command == __class__.COMMANDS["REQUEST_INFO"]:
             print("自身の情報を提供します")
-            await self._stream_info()
+            await self._stream_info(capabilities)
         elif command == __class__.COMMANDS["DISCONNECT_WIFI"]:
             await self._disconnect_wifi()
         elif command == __class__.COMMANDS["SET_SUBSCRIPTION"]:
-            subscription = await self.start_listen()
-            self.subscription = ujson.loads(subscription)
+            try:
+                self.subscription = await self._listen_subscription(capabilities)
+            except uasyncio.TimeoutError:
+                print("subscriptionが届きませんでした")
+                return
+            except (ValueError, KeyError) as e:
+                # 失敗を伝えるレスポンスはないので、今のsubscriptionのままにする
+                print(f"subscriptionが読めませんでした {e}")
+                return
             # 保存
             with open("subscription.json", "w") as file:
-                ujson.dump(subscription, file)
+                ujson.dump(self.subscription, file)
             print(f"subscriptionを設定しました\n\t{self.subscription}")
         elif command == __class__.COMMANDS["RE_SCAN"]:
             print("再スキャンして接続を試みます")
@@ -238,54 +362,50 @@ class Hub(BenTechStreamableDeviceServer):
             await self._scan()
             await self._connect()
             self.led.off()
-            await self._send_stream(ujson.dumps(self._get_connected_devices_list()))
+            devices = self._get_connected_devices_list()
+            if capabilities & CAP_BINARY:
+                await self._send_stream(encode_devices(devices), capabilities)
+            else:
+                await self._send_stream(ujson.dumps(devices), capabilities)
+        elif command == __class__.COMMANDS["DUMP_TRACE"]:
+            await self._stream_trace(capabilities)
         else:
             print(f"Unknown Command Received: {command}")
 
     ####### 周辺デバイスとの通信関連 ######
 
     async def _scan(self):
-        def calk_should_break():
-            return (
-                self.lid_controller_manager.is_having_device()
-                and self.auto_flusher_manager.is_having_device()
-                and self.deodorant_manager.is_having_device()
-                and self.paper_observer_manager.is_having_device()
-            )
+        # 最も高いデューティ サイクルで 最大5 秒間近くのデバイスをスキャン
+        # サービスUUIDで見分けられるのでパッシブで、全て見つかった時点で打ち切る
+        await BenTechDeviceManager.scan(self._device_managers(), 5000)
+
+    def _device_managers(self):
+        return (
+            self.lid_controller_manager,
+            self.paper_observer_manager,
+            self.auto_flusher_manager,
+            self.deodorant_manager,
+        )
 
-        # 最も高いデューティ サイクルで 5 秒間近くのデバイスをアクティブ スキャン
-        async with aioble.scan(
-            duration_ms=5000, interval_us=30000, window_us=30000, active=True
-        ) as scanner:
-            async for result in scanner:
-                # 各種デバイスを発見したら変数に代入
-                self.lid_controller_manager.is_this_device_your_charge(result)
-                self.paper_observer_manager.is_this_device_your_charge(result)
-                self.auto_flusher_manager.is_this_device_your_charge(result)
-                self.deodorant_manager.is_this_device_your_charge(result)
+    async def _connect(self):
+        # 一台ずつ直列に待つと応答しないデバイスで全体が止まるので、
+        # タイムアウト・再試行付きのスケジューラに任せる
+        latencies = await BenTechDeviceManager.connect_all(self._device_managers())
+        print(f"周辺デバイスとの接続結果(ms)\n\t{latencies}")
 
-                if calk_should_break():
-                    print("各種デバイスを発見したのでスキャンを終了")
-                    break
+        for manager in self._device_managers():
+            if manager.is_connected():
+                self.event_bus.publish(DEVICE_CONNECTED, manager.name)
 
-                # print(result, result.name(), result.rssi, result.services())
+    def _on_device_connected(self, manager):
+        self.event_bus.publish(DEVICE_CONNECTED, manager.name)
+        print(f"再接続しました\n\t{self.connection_supervisor.stats()}")
 
-    async def _connect(self):
-        # gatherはダメだった
-        """
-        await uasyncio.gather(
-            self.lid_controller_manager.connect(),
-            self.paper_observer_manager.connect(),
-            self.auto_flusher_manager.connect(),
-            self.deodorant_manager.connect(),
-        )
-        """
-        await self.lid_controller_manager.connect(),
-        await self.paper_observer_manager.connect(),
-        await self.auto_flusher_manager.connect(),
-        await self.deodorant_manager.connect(),
+    def _on_device_lost(self, manager):
+        self.event_bus.publish(DEVICE_LOST, manager.name)
 
     async def disconnect(self):
+        self.connection_supervisor.stop()
         self.lid_controller_manager.disconnect()
         self.paper_observer_manager.disconnect()
         self.auto_flusher_manager.disconnect()
@@ -293,12 +413,35 @@ class Hub(BenTechStreamableDeviceServer):
 
     ###### Taskになるものたち ######
 
+    async def _watch_motion(self):
+        # 検知器のイベントをセッションのイベントとして流す
+        while True:
+            event = await self.motion_detector.get_event()
+            if event == EVENT_ENTER:
+                self.event_bus.publish(SESSION_START)
+            else:
+                self.event_bus.publish(
+                    SESSION_END, self.motion_detector.get_current_duration()
+                )
+
+    async def _watch_mock_motion(self):
+        # ブートセルボタンはエッジ割り込みを持たないのでポーリングする
+        while True:
+            if self.mock_motion_detector.is_detection_started():
+                self.event_bus.publish(SESSION_START)
+            if self.mock_motion_detector.is_detection_ended():
+                self.event_bus.publish(
+                    SESSION_END, self.motion_detector.get_current_duration()
+                )
+            await uasyncio.sleep(0.1)
+
     async def _control_devices(self):
+        subscription = self.event_bus.subscribe(SESSION_START, SESSION_END)
         while True:
-            if (
-                self.motion_detector.is_detection_started()
-                or self.mock_motion_detector.is_detection_started()
-            ):
+            event, payload = await subscription.get()
+
+            if event == SESSION_START:
+                trace(TR_SESSION_START)
                 print("新しい動き検知を開始しました")
                 self.led.on()
 
@@ -312,12 +455,11 @@ class Hub(BenTechStreamableDeviceServer):
                     # ユーザーが入ってきたことをfirebaseに保存
                     self._update_data({"in_room": True}),
                 )
+                trace(TR_SESSION_OPENED)
 
-            if (
-                self.motion_detector.is_detection_ended()
-                or self.mock_motion_detector.is_detection_ended()
-            ):
-                staying_time = self.motion_detector.get_current_duration()
+            elif event == SESSION_END:
+                staying_time = payload
+                trace(TR_SESSION_END, staying_time)
                 print(f"検知終了 - 合計滞在時間: {staying_time}秒")
                 self.led.off()
 
@@ -329,21 +471,32 @@ class Hub(BenTechStreamableDeviceServer):
                     # ペーパー測定機へ測定を終了するように指示
                     self.paper_observer_manager.stop_observe(),
                 )
+                trace(TR_SESSION_CLOSED, -1 if used_roll_count is None else used_roll_count)
                 print(f"消費ロール数 {used_roll_count}")
 
-                await uasyncio.gather(
-                    # 水を流す
-                    self.auto_flusher_manager.flush(),
-                    # 消臭する
-                    self.deodorant_manager.spray(),
+                # 水を流す・消臭する 応答を待たずに続けて送る
+                await ControllableDeviceManager.control_all(
+                    (
+                        (
+                            self.auto_flusher_manager,
+                            AutoFlusherManager.FLUSH,
+                            DELIVERY_UNACKED,
+                        ),
+                        (
+                            self.deodorant_manager,
+                            DeodorantManager.SPRAY,
+                            DELIVERY_UNACKED,
+                        ),
+                    )
                 )
+                trace(TR_SESSION_DISPATCHED)
+                print("水を流し、消臭するように指示しました")
 
                 await uasyncio.gather(
                     # 履歴を保存します（自動的に通知も送る）
                     self._save_history(staying_time, used_roll_count),
                 )
-
-            await uasyncio.sleep(0.1)
+                trace(TR_SESSION_SAVED)
 
     async def _communicate_web_app(self):
         # BenTechStreamableDeviceServerのrun()を参考
@@ -365,6 +518,8 @@ class Hub(BenTechStreamableDeviceServer):
         await self._scan()
         await self._connect()
         self.led.off()
+        # 切断の見張りと、見つからなかったデバイスの捜索はここから自動で行う
+        self.connection_supervisor.start()
 
         self.motion_detector.monitoring = True
         control_devices_task = uasyncio.create_task(self._control_devices())
@@ -372,10 +527,15 @@ class Hub(BenTechStreamableDeviceServer):
         monitor_presence_task = uasyncio.create_task(
             self.motion_detector.monitor_presence()
         )
+        watch_motion_task = uasyncio.create_task(self._watch_motion())
+        uasyncio.create_task(self._upload_history_on_wifi_up())
+        if USE_MOCK_MOTION_DETECTOR:
+            uasyncio.create_task(self._watch_mock_motion())
 
         await control_devices_task
         await communicate_web_app_task
         await monitor_presence_task
+        await watch_motion_task
 
 
 if __name__ == "__main__":
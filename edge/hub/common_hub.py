@@ -1,43 +1,247 @@
 from micropython import const
+from aioble.client import ClientCharacteristic, GattError
+import aioble
 import bluetooth
+import random
+import time
 import uasyncio
+import log
+from gatt_cache import cache_key
+from stream_codec import DEVICE_CODES
+from trace_ring import (
+    trace,
+    TR_CONNECT_BEGIN,
+    TR_CONNECT_END,
+    TR_CONNECT_FAIL,
+    TR_CONTROL_BEGIN,
+    TR_CONTROL_END,
+    TR_CONTROL_FAIL,
+    TR_RESPONSE_BEGIN,
+    TR_RESPONSE_END,
+)
+
+# 接続1回あたりのタイムアウト
+CONNECT_TIMEOUT_MS = const(5000)
+# タイムアウト・失敗時の再試行回数
+CONNECT_RETRIES = const(2)
+# 再試行までの待ち時間（試行ごとに倍になる）
+CONNECT_BACKOFF_MS = const(500)
+# 同時に進める接続の数 (周辺デバイスの台数)
+# CYW43 + NimBLE では保留中のGAP接続は1つしか持てない（gatherがダメだった理由）ので
+# GAP接続そのものはradio_lockで1台ずつ行い、その後のGATTの探索を並行させる
+CONNECT_CONCURRENCY = const(4)
+
+# 切断後の再接続の待ち時間 失敗するたびに倍にし、上限で頭打ちにする
+RECONNECT_BACKOFF_MS = const(1000)
+RECONNECT_BACKOFF_MAX_MS = const(30000)
+# 続けてこの回数失敗したら、アドレスが変わった可能性があるのでスキャンし直す
+RECONNECT_SCAN_AFTER = const(3)
+# 再接続のためのスキャン時間
+RECONNECT_SCAN_MS = const(3000)
+# 続けてこの回数スキャンしても見つからなければ、電源が切れているか置かれていないものとして
+# RECONNECT_IDLE_MSごとにしか探さない (スキャン中は無線を占有し、他のデバイスを待たせるので)
+RECONNECT_SCAN_MISSES = const(3)
+RECONNECT_IDLE_MS = const(600000)
+
+# controlの送り方
+# ACKED  : write request 周辺デバイスが受け取るまで待つ (1往復=接続間隔分かかる)
+# UNACKED: write command 送信キューに積んだらすぐ戻る (投げっぱなしの操作向け)
+DELIVERY_ACKED = const(0)
+DELIVERY_UNACKED = const(1)
+# write requestの応答を待つ時間
+CONTROL_TIMEOUT_MS = const(1000)
+# write commandで送信バッファが一杯だった時に送り直す回数と間隔
+UNACKED_WRITE_RETRIES = const(3)
+UNACKED_WRITE_RETRY_MS = const(10)
 
 
 class BenTechDeviceManager:
+    # 全デバイスで共有するハンドルのキャッシュ (gatt_cache.GATTCache) Noneなら毎回探す
+    gatt_cache = None
+    # 見つけたデバイスのアドレス (device_registry.DeviceRegistry) Noneなら覚えない
+    device_registry = None
+    # GAP接続・スキャンは同時に1つまで (CONNECT_CONCURRENCYのコメント参照)
+    radio_lock = uasyncio.Lock()
 
     def __init__(self, name, service_id):
         self.name = const(name)
         self.service_id = const(service_id)
+        self.service_uuid = bluetooth.UUID(service_id)
+        # トレースの引数に使う番号 ("BT-"を除いた名前で引く)
+        self.trace_id = DEVICE_CODES.get(name[3:], 0)
         self.device = None
         self.connection = None
         self.service = None
         self.characteristics = {}
+        # 直近の接続にかかった時間(ms)
+        self.connect_latency_ms = None
+        # キャラクタリスティックをキャッシュから組み立てたかどうか
+        self.gatt_from_cache = False
+        # 接続した時刻と、切断・再接続の回数
+        self.connected_at = None
+        self.disconnect_count = 0
+        self.reconnect_count = 0
 
     def is_having_device(self):
         return self.device is not None
 
+    def known_address(self):
+        """前に見つけた時のアドレス (アドレスの種類, アドレス) か None"""
+        registry = __class__.device_registry
+        if registry is None:
+            return None
+        return registry.get(self.name)
+
+    def forget_address(self):
+        registry = __class__.device_registry
+        if registry is not None:
+            registry.forget(self.name)
+
+    def _matches(self, result):
+        # 安い照合から順に アドレスは全ての広告パケットに載っている
+        known = self.known_address()
+        if known is not None:
+            device = result.device
+            if device.addr_type == known[0] and device.addr == known[1]:
+                return True
+        # aiobleはサービスUUIDを先に広告データへ入れるので、パッシブスキャンでも見える
+        for uuid in result.services():
+            if uuid == self.service_uuid:
+                return True
+        # 名前はUUIDの後ろであふれてスキャン応答に入る (アクティブスキャンの時だけ見える)
+        return result.name() == self.name
+
     def is_this_device_your_charge(self, result):
-        if self.device is not None:
-            return
-        if result.name() == self.name:
-            self.device = result.device
+        """自分のデバイスならdeviceとして保持してTrueを返す"""
+        if self.device is not None or not self._matches(result):
+            return False
+        self.device = result.device
+        registry = __class__.device_registry
+        if registry is not None:
+            registry.put(self.name, self.device)
+        return True
 
     def is_connected(self):
-        return self.connection is not None
+        return self.connection is not None and self.connection.is_connected()
+
+    def uptime_ms(self):
+        """今の接続が続いている時間"""
+        if not self.is_connected() or self.connected_at is None:
+            return 0
+        return time.ticks_diff(time.ticks_ms(), self.connected_at)
+
+    def stats(self):
+        return {
+            "uptime_ms": self.uptime_ms(),
+            "disconnects": self.disconnect_count,
+            "reconnects": self.reconnect_count,
+        }
 
-    async def connect(self):
+    def forget_connection(self):
+        """切れた接続を片付ける"""
+        self.connection = None
+        self.connected_at = None
+        self.service = None
+        self.characteristics = {}
+
+    async def connect(
+        self,
+        timeout_ms=CONNECT_TIMEOUT_MS,
+        retries=CONNECT_RETRIES,
+        backoff_ms=CONNECT_BACKOFF_MS,
+    ):
         if self.device is None:
             self._log("[connect] deviceを保持していません")
-            return
-        self.connection = await self.device.connect()
-        self._log("接続完了")
+            return False
 
-    async def disconnect(self):
-        if self.connection is None:
-            self._log("[disconnect] 接続されていません")
-            return
-        await self.connection.disconnect()
-        self._log("接続解除完了")
+        for attempt in range(retries + 1):
+            trace(TR_CONNECT_BEGIN, self.trace_id)
+            try:
+                async with __class__.radio_lock:
+                    if self.is_connected():
+                        # ロックを待っている間に別の経路(connect_allと再接続)で繋がった
+                        self._log("[connect] 既に接続されています")
+                        trace(TR_CONNECT_END, self.trace_id)
+                        return True
+                    start = time.ticks_ms()
+                    self.connection = await self.device.connect(timeout_ms=timeout_ms)
+                    self.connect_latency_ms = time.ticks_diff(time.ticks_ms(), start)
+                self.connected_at = time.ticks_ms()
+                self._log(f"接続完了 {self.connect_latency_ms}ms (試行{attempt + 1}回目)")
+                await self._discover()
+                trace(TR_CONNECT_END, self.trace_id)
+                return True
+            except Exception as e:
+                trace(TR_CONNECT_FAIL, self.trace_id)
+                self._log(f"[connect] 接続に失敗しました (試行{attempt + 1}回目) e: {e}")
+
+            if attempt < retries:
+                await uasyncio.sleep_ms(backoff_ms << attempt)
+
+        self.forget_connection()
+        self.connect_latency_ms = None
+        return False
+
+    @staticmethod
+    async def scan(managers, duration_ms, active=False):
+        """
+        managersのうちdeviceを持っていないものを探す
+        見つかったデバイスから照合の対象を外していき、全て見つかった時点で打ち切る
+        アドレスとサービスUUIDは広告データに載っているので、普段はパッシブスキャンで足りる
+        (スキャン要求を送らないので速く、電力も少ない)
+        名前でしか見分けられない相手を探す時だけactive=Trueにする
+        """
+        async with BenTechDeviceManager.radio_lock:
+            pending = [manager for manager in managers if not manager.is_having_device()]
+            if not pending:
+                return
+            log.info("[scan] {}台を{}スキャンで探します", len(pending), "アクティブ" if active else "パッシブ")
+
+            async with aioble.scan(
+                duration_ms=duration_ms,
+                interval_us=30000,
+                window_us=30000,
+                active=active,
+            ) as scanner:
+                async for result in scanner:
+                    pending = [
+                        manager
+                        for manager in pending
+                        if not manager.is_this_device_your_charge(result)
+                    ]
+                    if not pending:
+                        log.info("[scan] 全て見つかったのでスキャンを終了")
+                        break
+
+    @staticmethod
+    async def connect_all(managers, concurrency=CONNECT_CONCURRENCY):
+        """
+        複数のデバイスへの接続をまとめて行う
+        GAP接続はradio_lockで1台ずつになるが、接続できたデバイスのGATTの探索は次のデバイスの
+        接続と重なるので、全体の時間は各デバイスの合計より短くなる
+        各デバイスはタイムアウト・再試行付きで接続するので
+        応答しないデバイスがいても残りのデバイスの接続は止まらない
+        戻り値は {デバイス名: 接続にかかった時間(ms) or None}
+        """
+        pending = [
+            manager
+            for manager in managers
+            if manager.is_having_device() and not manager.is_connected()
+        ]
+
+        async def worker():
+            while pending:
+                manager = pending.pop(0)
+                await manager.connect()
+
+        workers = [
+            uasyncio.create_task(worker())
+            for _ in range(min(concurrency, len(pending)))
+        ]
+        for task in workers:
+            await task
+
+        return {manager.name: manager.connect_latency_ms for manager in managers}
 
     async def disconnect(self):
         if self.connection is None:
@@ -46,6 +250,82 @@ class BenTechDeviceManager:
         await self.connection.disconnect()
         self._log("接続を解除しました")
 
+    def _characteristic_ids(self):
+        """接続直後に取得しておくキャラクタリスティックのUUID"""
+        return ()
+
+    async def _discover(self):
+        """
+        最初の操作で探索の往復が発生しないよう、接続直後にキャラクタリスティックを揃えておく
+        サービスのハンドル範囲がキャッシュと一致すれば、キャラクタリスティックは探さずに組み立てる
+        """
+        # 前の接続のオブジェクトは使えない
+        self.service = None
+        self.characteristics = {}
+        self.gatt_from_cache = False
+        try:
+            service = await self.get_service()
+            if self._restore_characteristics(service):
+                self.gatt_from_cache = True
+                self._log("キャッシュからキャラクタリスティックを復元しました")
+                return
+            for char_id in self._characteristic_ids():
+                await self.get_characteristic(char_id)
+            self._store_characteristics(service)
+        except Exception as e:
+            # 最初の操作の時にもう一度探すことになるだけなので続ける
+            self._log(f"[_discover] キャラクタリスティックの取得に失敗しました e: {e}")
+
+    def _restore_characteristics(self, service):
+        cache = __class__.gatt_cache
+        if cache is None:
+            return False
+        entry = cache.get(cache_key(self.device, self.service_id))
+        if entry is None:
+            return False
+        if entry["service"] != [service._start_handle, service._end_handle]:
+            self._log("サービスの範囲が変わっていたのでキャッシュを捨てます")
+            self._invalidate_gatt_cache()
+            return False
+
+        cached = entry["characteristics"]
+        char_ids = self._characteristic_ids()
+        if any(char_id not in cached for char_id in char_ids):
+            return False
+        for char_id in char_ids:
+            end_handle, value_handle, properties = cached[char_id]
+            self.characteristics[char_id] = ClientCharacteristic(
+                service, end_handle, value_handle, properties, bluetooth.UUID(char_id)
+            )
+        return True
+
+    def _store_characteristics(self, service):
+        cache = __class__.gatt_cache
+        if cache is None:
+            return
+        characteristics = {}
+        for char_id, char in self.characteristics.items():
+            characteristics[char_id] = [
+                char._end_handle,
+                char._value_handle,
+                char.properties,
+            ]
+        cache.put(
+            cache_key(self.device, self.service_id),
+            {
+                "service": [service._start_handle, service._end_handle],
+                "characteristics": characteristics,
+            },
+        )
+
+    def _invalidate_gatt_cache(self):
+        # 次に使う時に探し直す
+        self.characteristics = {}
+        self.gatt_from_cache = False
+        cache = __class__.gatt_cache
+        if cache is not None and self.device is not None:
+            cache.invalidate(cache_key(self.device, self.service_id))
+
     async def get_service(self):
         if self.connection is None:
             raise Exception("接続されていないのでサービスを取得できない")
@@ -65,8 +345,97 @@ class BenTechDeviceManager:
             self.characteristics[char_id] = char
         return self.characteristics[char_id]
 
-    def _log(self, msg):
-        print(f"[{self.name}] {msg}")
+    def _log(self, msg, *args):
+        # argsを渡せばINFOが出る時だけformatする
+        if log.enabled(log.INFO):
+            print(f"[{self.name}]", msg.format(*args) if args else msg)
+
+
+class ConnectionSupervisor:
+    """
+    周辺デバイスの接続を見張り、切れたら自動で繋ぎ直す
+    デバイスごとにタスクを1つ持ち、接続中はdisconnected()で眠っている
+    再接続は保持しているdeviceのアドレスに対して行い、ばらつきを入れたバックオフで繰り返す
+    何度も失敗した時やdeviceをまだ持っていない時はスキャンして探し直す
+    スキャンしても続けて見つからないデバイスは、RECONNECT_IDLE_MSごとにしか探さない
+    """
+
+    def __init__(self, managers, on_connected=None, on_lost=None):
+        self.managers = managers
+        self.on_connected = on_connected
+        self.on_lost = on_lost
+        self._tasks = []
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [
+            uasyncio.create_task(self._supervise(manager)) for manager in self.managers
+        ]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def stats(self):
+        """{デバイス名: {"uptime_ms", "disconnects", "reconnects"}}"""
+        return {manager.name: manager.stats() for manager in self.managers}
+
+    def _backoff_ms(self, failures):
+        delay = min(RECONNECT_BACKOFF_MAX_MS, RECONNECT_BACKOFF_MS << min(failures, 5))
+        # 全デバイスが同時に切れても一斉に繋ぎにいかないよう、半分〜全部の間でばらつかせる
+        return delay // 2 + random.randint(0, delay // 2)
+
+    async def _wait_disconnected(self, manager):
+        connection = manager.connection
+        try:
+            await connection.disconnected(timeout_ms=None)
+        except Exception as e:
+            manager._log(f"[_wait_disconnected] 切断の待機に失敗しました {e}")
+        # 待っている間に別の経路で繋ぎ直されていたら何もしない
+        if manager.connection is not connection:
+            return
+        manager.forget_connection()
+        manager.disconnect_count += 1
+        manager._log("切断されました")
+        if self.on_lost is not None:
+            self.on_lost(manager)
+
+    async def _supervise(self, manager):
+        failures = 0
+        misses = 0
+        while True:
+            if manager.is_connected():
+                failures = 0
+                await self._wait_disconnected(manager)
+                continue
+
+            if failures >= RECONNECT_SCAN_AFTER:
+                # 覚えているアドレスが古いかもしれないので、サービスUUIDで探し直す (パッシブスキャンで見つかる)
+                manager.device = None
+                manager.forget_address()
+            if not manager.is_having_device():
+                await BenTechDeviceManager.scan([manager], RECONNECT_SCAN_MS)
+                misses = 0 if manager.is_having_device() else misses + 1
+
+            if manager.is_connected():
+                # スキャンの間に別の経路(RE_SCANのconnect_all)で繋がった
+                continue
+            if manager.is_having_device() and await manager.connect(retries=0):
+                manager.reconnect_count += 1
+                if self.on_connected is not None:
+                    self.on_connected(manager)
+                continue
+
+            failures += 1
+            if misses >= RECONNECT_SCAN_MISSES:
+                delay = RECONNECT_IDLE_MS
+                manager._log(f"{misses}回探しても見つからないので{delay}ms後に探し直します")
+            else:
+                delay = self._backoff_ms(failures)
+                manager._log(f"再接続に失敗しました {delay}ms後に再試行します ({failures}回目)")
+            await uasyncio.sleep_ms(delay)
 
 
 class ControllableDeviceManager(BenTechDeviceManager):
@@ -75,12 +444,64 @@ class ControllableDeviceManager(BenTechDeviceManager):
         super().__init__(name, service_id)
         self.control_char_id = control_char_id
 
-    async def control(self, value):
+    def _characteristic_ids(self):
+        return (self.control_char_id,)
+
+    async def control(self, value, delivery=DELIVERY_ACKED):
+        """コマンドを送る 送れたかどうかを返す"""
+        trace(TR_CONTROL_BEGIN, self.trace_id)
         try:
             char = await self.get_characteristic(self.control_char_id)
-            await char.write(value)
+            if delivery == DELIVERY_UNACKED:
+                await self._write_unacked(char, value)
+            else:
+                await char.write(value, response=True, timeout_ms=CONTROL_TIMEOUT_MS)
+            trace(TR_CONTROL_END, self.trace_id)
+            return True
+        except GattError as e:
+            trace(TR_CONTROL_FAIL, self.trace_id)
+            # ハンドルが合っていない可能性があるので探し直させる
+            self._log(f"コントロールに失敗しました e: {e}")
+            if self.gatt_from_cache:
+                self._invalidate_gatt_cache()
+            return False
         except Exception as e:
+            trace(TR_CONTROL_FAIL, self.trace_id)
             self._log(f"コントロールに失敗しました e: {e}")
+            return False
+
+    async def _write_unacked(self, char, value):
+        for _ in range(UNACKED_WRITE_RETRIES):
+            try:
+                await char.write(value, response=False)
+                return
+            except OSError:
+                await uasyncio.sleep_ms(UNACKED_WRITE_RETRY_MS)
+        await char.write(value, response=False)
+
+    @staticmethod
+    async def control_all(commands):
+        """
+        複数のデバイスへコマンドをまとめて送る commandsは (manager, value, delivery) の並び
+        UNACKEDのものは応答を待たずに続けて積むので、同じ接続イベントで送られる
+        ACKEDのものはデバイスごとに並行して応答を待つ
+        接続していないデバイスは飛ばし、送れたかどうかをcommandsの順で返す
+        """
+        results = [False] * len(commands)
+        acked = []
+        for i, (manager, value, delivery) in enumerate(commands):
+            if not manager.is_connected():
+                manager._log("接続されていないのでpassします")
+            elif delivery == DELIVERY_UNACKED:
+                results[i] = await manager.control(value, DELIVERY_UNACKED)
+            else:
+                acked.append((i, manager.control(value, DELIVERY_ACKED)))
+
+        if acked:
+            done = await uasyncio.gather(*(coro for _, coro in acked))
+            for (i, _), ok in zip(acked, done):
+                results[i] = ok
+        return results
 
 
 class ResponsiveDeviceManager(ControllableDeviceManager):
@@ -95,6 +516,9 @@ class ResponsiveDeviceManager(ControllableDeviceManager):
         super().__init__(name, service_id, control_char_id)
         self.response_char_id = response_char_id
 
+    def _characteristic_ids(self):
+        return (self.control_char_id, self.response_char_id)
+
     async def control_with_response(self, value, callback):
         retv = None
         listen_response_task = None
@@ -109,7 +533,9 @@ class ResponsiveDeviceManager(ControllableDeviceManager):
 
         async def listen_response():
             nonlocal retv
+            trace(TR_RESPONSE_BEGIN, self.trace_id)
             data = await char.notified()
+            trace(TR_RESPONSE_END, self.trace_id)
             retv = callback(data)
 
         listen_response_task = uasyncio.create_task(listen_response())
@@ -1,5 +1,9 @@
 from micropython import const
-from common_hub import ResponsiveDeviceManager, ControllableDeviceManager
+from common_hub import (
+    ResponsiveDeviceManager,
+    ControllableDeviceManager,
+    DELIVERY_UNACKED,
+)
 
 
 class LidControllerManager(ResponsiveDeviceManager):
@@ -62,6 +66,8 @@ class PaperObserverManager(ResponsiveDeviceManager):
 
 
 class AutoFlusherManager(ControllableDeviceManager):
+    FLUSH = b"\x01"
+
     def __init__(self):
         super().__init__(
             name=const("BT-auto-flusher"),
@@ -70,11 +76,14 @@ class AutoFlusherManager(ControllableDeviceManager):
         )
 
     async def flush(self):
-        await self.control(b"\x01")
+        # 投げっぱなしでよいので応答を待たない
+        await self.control(__class__.FLUSH, DELIVERY_UNACKED)
         self._log("水を流すように指示しました")
 
 
 class DeodorantManager(ControllableDeviceManager):
+    SPRAY = b"\x01"
+
     def __init__(self):
         super().__init__(
             name=const("BT-deodorant"),
@@ -86,5 +95,5 @@ class DeodorantManager(ControllableDeviceManager):
         if self.connection is None:
             self._log("接続していないのでスプレーしません")
             return
-        await self.control(b"\x01")
+        await self.control(__class__.SPRAY, DELIVERY_UNACKED)
         self._log("消臭を指示しました")
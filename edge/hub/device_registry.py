@@ -0,0 +1,56 @@
+import os
+import ubinascii
+import ujson
+
+# 形式を変えたら番号を上げる
+DEVICE_REGISTRY_VERSION = 1
+
+
+class DeviceRegistry:
+    """
+    見つけた周辺デバイスのアドレスをデバイス名ごとにフラッシュへ保存しておく
+    次の起動からはアドレスで照合できるので、スキャン応答を待たないパッシブスキャンで探せる
+    """
+
+    def __init__(self, path="device_registry.json"):
+        self.path = path
+        self._entries = {}  # デバイス名 -> [アドレスの種類, アドレス(16進)]
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as file:
+                data = ujson.load(file)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != DEVICE_REGISTRY_VERSION:
+            print("[DeviceRegistry] 形式が違うので読み捨てます")
+            return
+        self._entries = data.get("devices", {})
+
+    def _save(self):
+        # 一時ファイルに書いてからrenameで置き換える（途中で落ちても壊れない）
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            ujson.dump(
+                {"version": DEVICE_REGISTRY_VERSION, "devices": self._entries}, file
+            )
+        os.rename(tmp_path, self.path)
+
+    def get(self, name):
+        """(アドレスの種類, アドレス) か None"""
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        return entry[0], ubinascii.unhexlify(entry[1])
+
+    def put(self, name, device):
+        entry = [device.addr_type, str(ubinascii.hexlify(device.addr), "ascii")]
+        if self._entries.get(name) == entry:
+            return
+        self._entries[name] = entry
+        self._save()
+
+    def forget(self, name):
+        if self._entries.pop(name, None) is not None:
+            self._save()
@@ -0,0 +1,59 @@
+from micropython import const
+import uasyncio
+
+# ハブ内で流れるイベント
+SESSION_START = const(1)  # 入室 payload: None
+SESSION_END = const(2)  # 退室 payload: 滞在時間(秒)
+DEVICE_CONNECTED = const(3)  # payload: デバイス名
+DEVICE_LOST = const(4)  # payload: デバイス名
+WIFI_UP = const(5)  # payload: None
+WIFI_DOWN = const(6)  # payload: None
+
+# 受け取られないまま溜めておくイベントの上限（超えたら古いものから捨てる）
+MAX_QUEUED_EVENTS = const(8)
+
+
+class Subscription:
+    """EventBus.subscribeが返す購読 get()でイベントを待つ"""
+
+    def __init__(self, events):
+        self.events = events
+        self._queue = []
+        self._ready = uasyncio.Event()
+
+    def _put(self, event, payload):
+        if len(self._queue) >= MAX_QUEUED_EVENTS:
+            self._queue.pop(0)
+        self._queue.append((event, payload))
+        self._ready.set()
+
+    async def get(self):
+        """次のイベントを待って (event, payload) を返す"""
+        while not self._queue:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._queue.pop(0)
+
+
+class EventBus:
+    """
+    ハブ内のpub/sub
+    購読者はイベントが来るまでEventで眠るので、ポーリングでループを起こさない
+    """
+
+    def __init__(self):
+        self._subscriptions = []
+
+    def subscribe(self, *events):
+        subscription = Subscription(events)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    def publish(self, event, payload=None):
+        for subscription in self._subscriptions:
+            if event in subscription.events:
+                subscription._put(event, payload)
@@ -0,0 +1,57 @@
+import os
+import ubinascii
+import ujson
+
+# キャッシュの形式を変えたら番号を上げる
+GATT_CACHE_VERSION = 1
+
+
+def cache_key(device, service_id):
+    """周辺デバイスのアドレスとサービスUUIDからキーを作る"""
+    addr = str(ubinascii.hexlify(device.addr), "ascii")
+    return f"{device.addr_type}:{addr}/{service_id}"
+
+
+class GATTCache:
+    """
+    周辺デバイスごとに、サービスとキャラクタリスティックのハンドルをフラッシュに保存しておく
+    エントリの形式
+        {"service": [開始ハンドル, 終了ハンドル],
+         "characteristics": {UUID: [終了ハンドル, 値ハンドル, プロパティ]}}
+    """
+
+    def __init__(self, path="gatt_cache.json"):
+        self.path = path
+        self._entries = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as file:
+                data = ujson.load(file)
+        except (OSError, ValueError):
+            return
+        if data.get("version") != GATT_CACHE_VERSION:
+            print("[GATTCache] 形式が違うので読み捨てます")
+            return
+        self._entries = data.get("entries", {})
+
+    def _save(self):
+        # 一時ファイルに書いてからrenameで置き換える（途中で落ちても壊れない）
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            ujson.dump({"version": GATT_CACHE_VERSION, "entries": self._entries}, file)
+        os.rename(tmp_path, self.path)
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def put(self, key, entry):
+        if self._entries.get(key) == entry:
+            return
+        self._entries[key] = entry
+        self._save()
+
+    def invalidate(self, key):
+        if self._entries.pop(key, None) is not None:
+            self._save()
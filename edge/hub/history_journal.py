@@ -0,0 +1,124 @@
+import os
+import struct
+import time
+from micropython import const
+
+# ファイル先頭のマジック（形式を変えたら番号を上げる）
+JOURNAL_MAGIC = b"BTJ2"
+# 1レコード = 滞在時間(秒, u32) + 消費ロール数(u16, 不明ならNO_ROLL_COUNT) + 終了時刻(time.time(), u32)
+RECORD_FORMAT = "<IHI"
+RECORD_SIZE = const(10)
+# 終了時刻を持たない前の形式 読み込んだら今の形式に書き直す
+V1_JOURNAL_MAGIC = b"BTJ1"
+V1_RECORD_FORMAT = "<IH"
+V1_RECORD_SIZE = const(6)
+NO_ROLL_COUNT = const(0xFFFF)
+# 保持するレコードの上限 溢れたら古いものからEVICT_COUNT件まとめて捨てる
+MAX_RECORDS = const(512)
+EVICT_COUNT = const(64)
+
+
+class HistoryJournal:
+    """
+    送信できていない履歴をフラッシュに溜めておく追記型のジャーナル
+    送信に成功した分だけdropで先頭から消すので、電源が落ちても未送信の履歴は残る
+    終了時刻はtime.time()で残すが、RTCは起動するたびに戻るので、
+    起動前から残っているレコードは何秒前に終わったかが分からない
+    """
+
+    def __init__(self, path="history_journal.bin"):
+        self.path = path
+        self.count = 0
+        self._load()
+        # 先頭からこの件数は前の起動で書かれたレコード
+        self._previous_boot_count = self.count
+
+    def _load(self):
+        try:
+            size = os.stat(self.path)[6]
+        except OSError:
+            self._rewrite([])
+            return
+
+        with open(self.path, "rb") as file:
+            magic = file.read(len(JOURNAL_MAGIC))
+        if magic == V1_JOURNAL_MAGIC:
+            self._migrate_v1(size)
+            return
+        if magic != JOURNAL_MAGIC:
+            print(f"[HistoryJournal] 形式が違うので作り直します magic={magic}")
+            self._rewrite([])
+            return
+
+        self.count = (size - len(JOURNAL_MAGIC)) // RECORD_SIZE
+        if (size - len(JOURNAL_MAGIC)) % RECORD_SIZE != 0:
+            # 書き込み途中で電源が落ちた半端なレコードを切り捨てる
+            self._rewrite([self._read_raw(0, self.count)])
+
+    def _migrate_v1(self, size):
+        count = (size - len(V1_JOURNAL_MAGIC)) // V1_RECORD_SIZE
+        with open(self.path, "rb") as file:
+            file.seek(len(V1_JOURNAL_MAGIC))
+            raw = file.read(count * V1_RECORD_SIZE)
+        records = bytearray(count * RECORD_SIZE)
+        for i in range(count):
+            staying_time, roll = struct.unpack_from(V1_RECORD_FORMAT, raw, i * V1_RECORD_SIZE)
+            struct.pack_into(RECORD_FORMAT, records, i * RECORD_SIZE, staying_time, roll, 0)
+        print(f"[HistoryJournal] 前の形式の履歴{count}件を書き直します")
+        self._rewrite([records])
+
+    def _read_raw(self, start, n):
+        with open(self.path, "rb") as file:
+            file.seek(len(JOURNAL_MAGIC) + start * RECORD_SIZE)
+            return file.read(n * RECORD_SIZE)
+
+    def _rewrite(self, raw):
+        # 一時ファイルに書いてからrenameで置き換える（途中で落ちても壊れない）
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(JOURNAL_MAGIC)
+            for chunk in raw:
+                file.write(chunk)
+        os.rename(tmp_path, self.path)
+        self.count = sum(len(chunk) for chunk in raw) // RECORD_SIZE
+
+    def append(self, staying_time, used_roll_count):
+        if self.count >= MAX_RECORDS:
+            print(f"[HistoryJournal] 上限に達したので古い履歴を{EVICT_COUNT}件捨てます")
+            self.drop(EVICT_COUNT)
+
+        roll = NO_ROLL_COUNT if used_roll_count is None else min(used_roll_count, NO_ROLL_COUNT - 1)
+        record = struct.pack(RECORD_FORMAT, max(0, int(staying_time)), roll, int(time.time()))
+        with open(self.path, "ab") as file:
+            file.write(record)
+        self.count += 1
+
+    def peek(self, n):
+        """
+        先頭(古い方)から最大n件を {"stayingTime", "usedRollCount", "endedSecondsAgo"} のリストで返す
+        endedSecondsAgoは今から何秒前に終わったか 前の起動で書かれたものはNone
+        """
+        n = min(n, self.count)
+        raw = self._read_raw(0, n)
+        now = int(time.time())
+        entries = []
+        for i in range(n):
+            staying_time, roll, ended_at = struct.unpack_from(RECORD_FORMAT, raw, i * RECORD_SIZE)
+            entries.append(
+                {
+                    "stayingTime": staying_time,
+                    "usedRollCount": None if roll == NO_ROLL_COUNT else roll,
+                    "endedSecondsAgo": (
+                        None if i < self._previous_boot_count else max(0, now - ended_at)
+                    ),
+                }
+            )
+        return entries
+
+    def drop(self, n):
+        """先頭(古い方)からn件を消す"""
+        n = min(n, self.count)
+        if n == 0:
+            return
+        self._previous_boot_count = max(0, self._previous_boot_count - n)
+        self._rewrite([self._read_raw(n, self.count - n)])
@@ -1,25 +1,70 @@
 import time
+from array import array
 from machine import Pin
+from micropython import const
 import uasyncio as asyncio
+import log
 
 # 設定
 MOTION_SENSOR_PIN = 18  # GP28ピンを使用
 PIR_SETTINGS = 5     # 30秒のタイムアウト
 
-class PIRMotionDetector:
+# get_event()で受け取るイベント
+EVENT_ENTER = const(1)  # 人が入ってきた
+EVENT_LEAVE = const(2)  # 人が出ていった
+
+# 割り込みで受け取ったエッジを溜めておくリングバッファの大きさ
+IRQ_RING_SIZE = const(16)
+# 受け取られないまま溜めておくイベントの上限（超えたら古いものから捨てる）
+MAX_QUEUED_EVENTS = const(8)
+
+# ポーリングで100msごとに通るので、HIGHの間も出すのは1秒に1回まで
+_high_log = log.RateLimitedLog(1000)
+
+
+class MotionEventQueue:
+    """検知器の入退室イベントを await で受け取れるようにするキュー"""
+
+    def __init__(self):
+        self._events = []
+        self._event_ready = asyncio.Event()
+
+    def _push_event(self, event):
+        if len(self._events) >= MAX_QUEUED_EVENTS:
+            self._events.pop(0)
+        self._events.append(event)
+        self._event_ready.set()
+
+    async def get_event(self):
+        """次の入退室イベント(EVENT_ENTER / EVENT_LEAVE)を待って返す"""
+        while not self._events:
+            self._event_ready.clear()
+            await self._event_ready.wait()
+        return self._events.pop(0)
+
+
+class PIRMotionDetector(MotionEventQueue):
+    """
+    100msごとにピンを読むポーリング方式の検知器
+    割り込みが使えない環境向けのフォールバック
+    """
+
     def __init__(self, motion_sensor_pin=MOTION_SENSOR_PIN, presence_timeout=PIR_SETTINGS):
+        super().__init__()
         # 設定値の確認を追加
-        print("\n=== 設定値の確認 ===")
-        print(f"MOTION_SENSOR_PIN: {motion_sensor_pin}")
-        print(f"PIR_SETTINGS: {presence_timeout}")
-        print("==================\n")
+        if __debug__:
+            log.debug(
+                "\n=== 設定値の確認 ===\nMOTION_SENSOR_PIN: {}\nPIR_SETTINGS: {}\n==================\n",
+                motion_sensor_pin,
+                presence_timeout,
+            )
 
         self.pir_pin = motion_sensor_pin
         self.presence_timeout = presence_timeout
         self.pir_sensor = Pin(self.pir_pin, Pin.IN)
 
         # デバッグ情報を出力
-        print(f"初期化: PIN={self.pir_pin}, TIMEOUT={self.presence_timeout}")
+        log.info("初期化: PIN={}, TIMEOUT={}", self.pir_pin, self.presence_timeout)
 
         self.person_present = False
         self.last_detection_time = 0
@@ -37,58 +82,57 @@ class PIRMotionDetector:
         if not self.monitoring:
             self.monitoring = True
             self._monitor_task = asyncio.create_task(self.monitor_presence())
-            print("モニタリングタスクを開始しました")
+            log.info("モニタリングタスクを開始しました")
 
     async def stop_monitoring(self):
         """監視を停止する"""
         self.monitoring = False
         if self._monitor_task:
             await self._monitor_task
-            print("モニタリングタスクを停止しました")
+            log.info("モニタリングタスクを停止しました")
 
     async def monitor_presence(self):
         try:
-            print("\n=== モニタリング開始 ===")
-            print("PIRセンサーの監視を開始します...")
-            print(f"PIRセンサーピン: {self.pir_pin}")
-            print(f"不在判定時間: {self.presence_timeout}秒")
-            print("=====================\n")
+            log.info("PIRセンサーの監視を開始します...")
+            if __debug__:
+                log.debug(
+                    "PIRセンサーピン: {}\n不在判定時間: {}秒", self.pir_pin, self.presence_timeout
+                )
 
             # センサーの初期化と初期状態の確認
             await asyncio.sleep(2)
             initial_state = self.pir_sensor.value()
-            print(f"センサーの初期状態: {initial_state}")
+            log.info("センサーの初期状態: {}", initial_state)
 
             while self.monitoring:
                 current_time = time.time()
                 try:
                     pir_state = self.pir_sensor.value()
                     # センサーの値の変化をデバッグ出力
-                    if pir_state:
-                        print(f"センサー状態: HIGH ({pir_state})")
-
-                    # フラグのリセット
-                    self.detection_started = False
-                    self.detection_ended = False
+                    if __debug__:
+                        if pir_state:
+                            _high_log("センサー状態: HIGH ({})", pir_state)
 
                     if pir_state == 1:  # 人を検知
                         self.last_detection_time = current_time
                         if not self.person_present:
-                            print("動きを検知しました")
+                            log.info("動きを検知しました")
                             self.person_present = True
                             self.detection_started = True
                             self.current_session_start = time.time()
+                            self._push_event(EVENT_ENTER)
 
                     # 一定時間検知がない場合
                     elif (current_time - self.last_detection_time > self.presence_timeout 
                           and self.person_present):
-                        print("タイムアウトによる検知終了")
+                        log.info("タイムアウトによる検知終了")
                         self.person_present = False
                         self.detection_ended = True
 
                         if self.current_session_start:
                             self.current_duration = time.time() - self.current_session_start
                             self.current_session_start = None
+                        self._push_event(EVENT_LEAVE)
 
                     # 現在進行中のセッションの滞在時間を更新
                     if self.person_present and self.current_session_start:
@@ -97,22 +141,32 @@ class PIRMotionDetector:
                     await asyncio.sleep(0.1)
 
                 except Exception as e:
-                    print(f"センサー読み取りエラー: {e}")
+                    log.error("センサー読み取りエラー: {}", e)
                     await asyncio.sleep(1)  # エラー時は少し待機
 
         except Exception as e:
-            print(f"監視中にエラーが発生しました: {e}")
+            log.error("監視中にエラーが発生しました: {}", e)
         finally:
             self.monitoring = False
-            print("監視を終了します")
+            log.info("監視を終了します")
 
     def is_detection_started(self):
-        """人の検知が開始されたかどうかを返す"""
-        return self.detection_started
+        """
+        人の検知が開始されたかどうかを返す
+        読み出すまでTrueを保持するので、ポーリング側が取りこぼすことはない
+        """
+        started = self.detection_started
+        self.detection_started = False
+        return started
 
     def is_detection_ended(self):
-        """人の検知が終了したかどうかを返す"""
-        return self.detection_ended
+        """
+        人の検知が終了したかどうかを返す
+        読み出すまでTrueを保持するので、ポーリング側が取りこぼすことはない
+        """
+        ended = self.detection_ended
+        self.detection_ended = False
+        return ended
 
     def get_current_duration(self):
         """現在の滞在時間（秒）を返す"""
@@ -123,3 +177,172 @@ class PIRMotionDetector:
         await self.stop_monitoring()
 
 
+
+
+class IRQMotionDetector(MotionEventQueue):
+    """
+    ピン割り込みでPIRセンサーのエッジを受け取る検知器
+    割り込みハンドラはエッジをリングバッファに積んでThreadSafeFlagを立てるだけで、
+    入退室の判定はmonitor_presenceタスクが行う
+    ポーリングしないのでエッジを取りこぼさず、入室への反応もすぐに行える
+    """
+
+    def __init__(self, motion_sensor_pin=MOTION_SENSOR_PIN, presence_timeout=PIR_SETTINGS):
+        super().__init__()
+        self.pir_pin = motion_sensor_pin
+        self.presence_timeout = presence_timeout
+        self.pir_sensor = Pin(self.pir_pin, Pin.IN)
+
+        log.info("初期化(割り込み): PIN={}, TIMEOUT={}", self.pir_pin, self.presence_timeout)
+
+        # 割り込みハンドラ内でメモリを確保しないよう事前に確保しておく
+        self._edge_ticks = array("i", [0] * IRQ_RING_SIZE)
+        self._edge_values = bytearray(IRQ_RING_SIZE)
+        self._edge_head = 0  # 割り込みハンドラが次に書き込む位置
+        self._edge_tail = 0  # タスクが次に読み出す位置
+        self._edge_dropped = 0
+        self._edge_flag = asyncio.ThreadSafeFlag()
+
+        self.person_present = False
+        # 最後にセンサーがLOWに落ちた時刻(ticks_ms)
+        self.last_fall_ticks = 0
+
+        self.current_session_start = None
+        self.detection_started = False
+        self.detection_ended = False
+        self.current_duration = 0
+
+        self.monitoring = False
+        self._monitor_task = None
+
+    def _on_edge(self, pin):
+        # hard割り込みから呼ばれるのでメモリ確保をしてはいけない
+        head = self._edge_head
+        next_head = (head + 1) % IRQ_RING_SIZE
+        if next_head == self._edge_tail:
+            # 溢れた場合は最新のエッジを捨てる（状態はdrain時にピンから復元する）
+            self._edge_dropped += 1
+        else:
+            self._edge_ticks[head] = time.ticks_ms()
+            self._edge_values[head] = pin.value()
+            self._edge_head = next_head
+        self._edge_flag.set()
+
+    def _drain_edges(self):
+        while self._edge_tail != self._edge_head:
+            tail = self._edge_tail
+            ticks = self._edge_ticks[tail]
+            value = self._edge_values[tail]
+            self._edge_tail = (tail + 1) % IRQ_RING_SIZE
+            self._apply_level(value, ticks)
+
+        if self._edge_dropped:
+            log.warning("エッジが溢れました dropped={}", self._edge_dropped)
+            self._edge_dropped = 0
+            self._apply_level(self.pir_sensor.value(), time.ticks_ms())
+
+    def _apply_level(self, value, ticks):
+        if value == 1:
+            if not self.person_present:
+                log.info("動きを検知しました")
+                self.person_present = True
+                self.detection_started = True
+                self.current_session_start = time.time()
+                self._push_event(EVENT_ENTER)
+        else:
+            self.last_fall_ticks = ticks
+
+    def _leave(self):
+        log.info("タイムアウトによる検知終了")
+        self.person_present = False
+        self.detection_ended = True
+        if self.current_session_start:
+            self.current_duration = time.time() - self.current_session_start
+            self.current_session_start = None
+        self._push_event(EVENT_LEAVE)
+
+    def _remaining_presence_ms(self):
+        """不在判定までの残り時間(ms) 判定待ちでなければNone"""
+        if not self.person_present or self.pir_sensor.value() == 1:
+            return None
+        elapsed = time.ticks_diff(time.ticks_ms(), self.last_fall_ticks)
+        return max(0, self.presence_timeout * 1000 - elapsed)
+
+    async def start_monitoring(self):
+        """監視を開始する"""
+        if not self.monitoring:
+            self.monitoring = True
+            self._monitor_task = asyncio.create_task(self.monitor_presence())
+            log.info("モニタリングタスクを開始しました")
+
+    async def stop_monitoring(self):
+        """監視を停止する"""
+        self.monitoring = False
+        self._edge_flag.set()
+        if self._monitor_task:
+            await self._monitor_task
+            log.info("モニタリングタスクを停止しました")
+
+    async def monitor_presence(self):
+        log.info("PIRセンサーの割り込み監視を開始します...")
+        self.pir_sensor.irq(
+            handler=self._on_edge,
+            trigger=Pin.IRQ_RISING | Pin.IRQ_FALLING,
+            hard=True,
+        )
+        # 割り込みを有効にする前の状態を反映
+        self._apply_level(self.pir_sensor.value(), time.ticks_ms())
+
+        try:
+            while self.monitoring:
+                remaining_ms = self._remaining_presence_ms()
+                if remaining_ms is None:
+                    await self._edge_flag.wait()
+                else:
+                    try:
+                        await asyncio.wait_for_ms(self._edge_flag.wait(), remaining_ms)
+                    except asyncio.TimeoutError:
+                        pass
+
+                self._drain_edges()
+
+                remaining_ms = self._remaining_presence_ms()
+                if remaining_ms is not None and remaining_ms == 0:
+                    self._leave()
+
+                if self.person_present and self.current_session_start:
+                    self.current_duration = time.time() - self.current_session_start
+        except Exception as e:
+            log.error("監視中にエラーが発生しました: {}", e)
+        finally:
+            self.pir_sensor.irq(handler=None)
+            self.monitoring = False
+            log.info("監視を終了します")
+
+    def is_detection_started(self):
+        """
+        人の検知が開始されたかどうかを返す
+        読み出すまでTrueを保持するので、ポーリング側が取りこぼすことはない
+        """
+        started = self.detection_started
+        self.detection_started = False
+        return started
+
+    def is_detection_ended(self):
+        """
+        人の検知が終了したかどうかを返す
+        読み出すまでTrueを保持するので、ポーリング側が取りこぼすことはない
+        """
+        ended = self.detection_ended
+        self.detection_ended = False
+        return ended
+
+    def get_current_duration(self):
+        """現在の滞在時間（秒）を返す"""
+        if self.person_present and self.current_session_start:
+            return int(time.time() - self.current_session_start)
+        return int(self.current_duration)
+
+    async def cleanup(self):
+        """リソースの解放"""
+        await self.stop_monitoring()
@@ -0,0 +1,141 @@
+# Web Appとstreamでやり取りするデータのバイナリ形式 (common.CAP_BINARYで有効になる)
+# JSONの代わりに タグ(u8) + 長さ(u16) + 値 を並べる
+# Web App側の実装は web/src/lib/streamCodec.ts
+import struct
+import time
+import ubinascii
+from micropython import const
+
+TLV_HEADER_FORMAT = ">BH"
+TLV_HEADER_SIZE = const(3)
+
+# REQUEST_INFO / RE_SCAN
+TAG_WIFI_CONNECTED = const(0x01)  # u8 (0 or 1)
+TAG_SUBSCRIPTION = const(0x02)  # subscriptionのTLVを入れ子にしたもの
+TAG_DEVICE = const(0x03)  # u8 (DEVICE_CODES) 繋がっているデバイスごとに1つ
+
+# SET_SUBSCRIPTION
+TAG_ENDPOINT = const(0x10)  # UTF-8
+TAG_EXPIRATION_TIME = const(0x11)  # u64 (ms) nullの時は送らない
+TAG_P256DH = const(0x12)  # 鍵の生のバイト列 (JSONではbase64url)
+TAG_AUTH = const(0x13)  # 同上
+
+# CONNECT_WIFI
+TAG_SSID = const(0x20)  # UTF-8
+TAG_PASSWORD = const(0x21)  # UTF-8
+
+# DUMP_TRACE
+TAG_TRACE_NOW = const(0x30)  # u32 送った時のticks_us
+TAG_TRACE_ENTRIES = const(0x31)  # 1件 = ticks_us(u32) + イベント番号(u8) + 引数(i32) を古い順に並べたもの
+TRACE_ENTRY_FORMAT = ">IBi"
+TRACE_ENTRY_SIZE = const(9)
+
+DEVICE_CODES = {
+    "lid-controller": 1,
+    "paper-observer": 2,
+    "auto-flusher": 3,
+    "deodorant": 4,
+}
+
+
+def _append(buffer, tag, value):
+    buffer.extend(struct.pack(TLV_HEADER_FORMAT, tag, len(value)))
+    buffer.extend(value)
+
+
+def iter_tlv(data):
+    """(tag, value) を順に返す 値はコピーせずmemoryviewで返す"""
+    view = memoryview(data)
+    offset = 0
+    while offset + TLV_HEADER_SIZE <= len(view):
+        tag, length = struct.unpack_from(TLV_HEADER_FORMAT, view, offset)
+        offset += TLV_HEADER_SIZE
+        if offset + length > len(view):
+            raise ValueError("truncated TLV")
+        yield tag, view[offset : offset + length]
+        offset += length
+
+
+def _b64url_encode(raw):
+    encoded = ubinascii.b2a_base64(raw).rstrip(b"\n=")
+    return str(encoded.replace(b"+", b"-").replace(b"/", b"_"), "ascii")
+
+
+def _b64url_decode(text):
+    encoded = text.encode("ascii").replace(b"-", b"+").replace(b"_", b"/")
+    return ubinascii.a2b_base64(encoded + b"=" * (-len(encoded) % 4))
+
+
+def encode_devices(devices, buffer=None):
+    if buffer is None:
+        buffer = bytearray()
+    for name in devices:
+        _append(buffer, TAG_DEVICE, bytes((DEVICE_CODES[name],)))
+    return buffer
+
+
+def encode_subscription(subscription):
+    buffer = bytearray()
+    _append(buffer, TAG_ENDPOINT, subscription["endpoint"].encode("utf-8"))
+    expiration_time = subscription.get("expirationTime")
+    if expiration_time is not None:
+        _append(buffer, TAG_EXPIRATION_TIME, struct.pack(">Q", int(expiration_time)))
+    keys = subscription["keys"]
+    _append(buffer, TAG_P256DH, _b64url_decode(keys["p256dh"]))
+    _append(buffer, TAG_AUTH, _b64url_decode(keys["auth"]))
+    return buffer
+
+
+def decode_subscription(data):
+    """PushSubscription.toJSON()と同じ形の辞書に戻す (鍵はbase64url)"""
+    endpoint = None
+    expiration_time = None
+    keys = {}
+    for tag, value in iter_tlv(data):
+        if tag == TAG_ENDPOINT:
+            endpoint = str(value, "utf-8")
+        elif tag == TAG_EXPIRATION_TIME:
+            if len(value) != 8:
+                raise ValueError("bad expiration time")
+            expiration_time = struct.unpack(">Q", value)[0]
+        elif tag == TAG_P256DH:
+            keys["p256dh"] = _b64url_encode(value)
+        elif tag == TAG_AUTH:
+            keys["auth"] = _b64url_encode(value)
+    if endpoint is None or len(keys) != 2:
+        raise ValueError("incomplete subscription")
+    return {"endpoint": endpoint, "expirationTime": expiration_time, "keys": keys}
+
+
+def encode_info(wifi_connected, subscription, devices):
+    buffer = bytearray()
+    _append(buffer, TAG_WIFI_CONNECTED, b"\x01" if wifi_connected else b"\x00")
+    if subscription is not None:
+        _append(buffer, TAG_SUBSCRIPTION, encode_subscription(subscription))
+    return encode_devices(devices, buffer)
+
+
+def decode_wifi_data(data):
+    ssid = None
+    password = None
+    for tag, value in iter_tlv(data):
+        if tag == TAG_SSID:
+            ssid = str(value, "utf-8")
+        elif tag == TAG_PASSWORD:
+            password = str(value, "utf-8")
+    if ssid is None or password is None:
+        raise ValueError("incomplete wifi data")
+    return ssid, password
+
+
+def encode_trace(ring):
+    """trace_ring.TraceRingの中身 イベント番号の意味は trace_ring.TR_*"""
+    entries = bytearray(len(ring) * TRACE_ENTRY_SIZE)
+    offset = 0
+    for ticks, event, arg in ring.entries():
+        struct.pack_into(TRACE_ENTRY_FORMAT, entries, offset, ticks, event, arg)
+        offset += TRACE_ENTRY_SIZE
+    buffer = bytearray()
+    _append(buffer, TAG_TRACE_NOW, struct.pack(">I", time.ticks_us()))
+    _append(buffer, TAG_TRACE_ENTRIES, entries)
+    return buffer
@@ -1,42 +1,403 @@
 import usocket
 import ssl
+import time
+import uasyncio
 import ujson
+from micropython import const
+from trace_ring import trace, TR_HTTP_BEGIN, TR_HTTP_END
 
+# DNSの結果を使い回す時間
+DNS_TTL_MS = const(300000)
+# これ以上使われていない接続はサーバー側で切られている可能性が高いので捨てる
+KEEPALIVE_IDLE_MS = const(60000)
+# ホストごとに保持しておく接続の数（TLSのバッファでヒープを食うので小さく）
+MAX_IDLE_CONNECTIONS_PER_HOST = const(1)
+SOCKET_TIMEOUT_S = const(10)
+# 非同期版で1リクエスト（接続〜レスポンス読み切り）にかけてよい時間
+REQUEST_TIMEOUT_MS = const(15000)
+
+
+class HTTPStatusError(Exception):
+    """サーバーがエラー(4xx/5xx)を返した"""
+
+    def __init__(self, status, body):
+        super().__init__(f"HTTP {status}: {body}")
+        self.status = status
+        self.body = body
 
-def send_post_request(url, data):
-    # URL の解析
-    proto, _, host, path = url.split("/", 3)
-    addr_info = usocket.getaddrinfo(host, 443, 0, usocket.SOCK_STREAM)[0]
 
-    # ソケット作成と接続
-    sock = usocket.socket(addr_info[0], addr_info[1], addr_info[2])
-    sock.connect(addr_info[4])
+class DNSCache:
+    """getaddrinfoの結果をTTL付きで保持する"""
 
-    # ソケットを SSL でラップ
-    sock = ssl.wrap_socket(sock)
+    def __init__(self, ttl_ms=DNS_TTL_MS):
+        self.ttl_ms = ttl_ms
+        self._entries = {}  # (host, port) -> (addr_info, 取得時刻)
 
-    # POST リクエストの作成
-    request_body = ujson.dumps(data)
-    headers = (
-        f"POST /{path} HTTP/1.1\r\n"
+    def resolve(self, host, port):
+        key = (host, port)
+        entry = self._entries.get(key)
+        if entry is not None and time.ticks_diff(time.ticks_ms(), entry[1]) < self.ttl_ms:
+            return entry[0]
+        addr_info = usocket.getaddrinfo(host, port, 0, usocket.SOCK_STREAM)[0]
+        self._entries[key] = (addr_info, time.ticks_ms())
+        return addr_info
+
+    def invalidate(self, host, port):
+        self._entries.pop((host, port), None)
+
+
+def _request_head(method, host, path, body):
+    return (
+        f"{method} /{path} HTTP/1.1\r\n"
         f"Host: {host}\r\n"
         f"Content-Type: application/json\r\n"
-        f"Content-Length: {len(request_body)}\r\n"
-        f"Connection: close\r\n\r\n"
-    )
-
-    # リクエスト送信
-    sock.write(headers.encode("utf-8") + request_body.encode("utf-8"))
-
-    # レスポンスを受信
-    response = b""
-    while True:
-        chunk = sock.read(1024)
-        if not chunk:
-            break
-        response += chunk
-
-    sock.close()
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: keep-alive\r\n\r\n"
+    ).encode("utf-8")
+
+
+class ResponseHead:
+    """レスポンスのステータス行とヘッダーを1行ずつ受け取って解釈する"""
+
+    def __init__(self, status_line):
+        if not status_line:
+            # サーバーがアイドル接続を閉じていた
+            raise OSError("connection closed by server")
+        self.status = int(status_line.split(None, 2)[1])
+        self.content_length = None
+        self.chunked = False
+        self.keep_alive = True
+
+    def feed(self, line):
+        """ヘッダーの1行を渡す ヘッダーが終わったらFalseを返す"""
+        if not line or line == b"\r\n":
+            return False
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        value = value.strip().lower()
+        if name == b"content-length":
+            self.content_length = int(value)
+        elif name == b"transfer-encoding" and value == b"chunked":
+            self.chunked = True
+        elif name == b"connection" and value == b"close":
+            self.keep_alive = False
+        return True
+
+
+class HTTPConnection:
+    """keep-aliveで使い回せるHTTP/1.1(TLS)の接続"""
+
+    def __init__(self, host, port, dns_cache):
+        self.host = host
+        self.port = port
+        self.dns_cache = dns_cache
+        self.sock = None
+        self.last_used = 0
+
+    def is_open(self):
+        return self.sock is not None
+
+    def is_idle_too_long(self):
+        return time.ticks_diff(time.ticks_ms(), self.last_used) >= KEEPALIVE_IDLE_MS
+
+    def connect(self):
+        addr_info = self.dns_cache.resolve(self.host, self.port)
+        sock = usocket.socket(addr_info[0], addr_info[1], addr_info[2])
+        sock.settimeout(SOCKET_TIMEOUT_S)
+        try:
+            sock.connect(addr_info[4])
+        except OSError:
+            sock.close()
+            # 接続できなかった場合はアドレスが変わっているかもしれない
+            self.dns_cache.invalidate(self.host, self.port)
+            raise
+        self.sock = ssl.wrap_socket(sock, server_hostname=self.host)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def request(self, method, path, body):
+        """
+        リクエストを送りレスポンスを読み切る
+        戻り値は (status, body, keep_alive)
+        """
+        if self.sock is None:
+            self.connect()
+
+        self.sock.write(_request_head(method, self.host, path, body) + body)
+
+        head = ResponseHead(self.sock.readline())
+        while head.feed(self.sock.readline()):
+            pass
+
+        keep_alive = head.keep_alive
+        if head.chunked:
+            response = self._read_chunked()
+        elif head.content_length is not None:
+            response = self._read_exactly(head.content_length)
+        else:
+            # 長さが分からないので閉じられるまで読むしかない
+            response = self._read_until_close()
+            keep_alive = False
+
+        self.last_used = time.ticks_ms()
+        return head.status, response, keep_alive
+
+    def _read_exactly(self, length):
+        buf = bytearray(length)
+        view = memoryview(buf)
+        received = 0
+        while received < length:
+            n = self.sock.readinto(view[received:])
+            if not n:
+                raise OSError("connection closed while reading body")
+            received += n
+        return bytes(buf)
+
+    def _read_chunked(self):
+        response = b""
+        while True:
+            size = int(self.sock.readline().split(b";")[0].strip(), 16)
+            if size == 0:
+                # trailerと最後の空行を読み捨てる
+                while self.sock.readline() not in (b"\r\n", b""):
+                    pass
+                return response
+            response += self._read_exactly(size)
+            self.sock.readline()
+
+    def _read_until_close(self):
+        response = b""
+        while True:
+            chunk = self.sock.read(1024)
+            if not chunk:
+                return response
+            response += chunk
+
+
+class ConnectionPool:
+    """ホストごとにkeep-alive接続を保持し、連続したリクエストでTLSセッションを使い回す"""
+
+    def __init__(self, max_idle_per_host=MAX_IDLE_CONNECTIONS_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self.dns_cache = DNSCache()
+        self._idle = {}  # (host, port) -> [HTTPConnection]
+
+    def _acquire(self, host, port):
+        idle = self._idle.get((host, port))
+        while idle:
+            conn = idle.pop()
+            if conn.is_idle_too_long():
+                conn.close()
+                continue
+            return conn
+        return HTTPConnection(host, port, self.dns_cache)
+
+    def _release(self, conn):
+        idle = self._idle.setdefault((conn.host, conn.port), [])
+        if len(idle) >= self.max_idle_per_host:
+            conn.close()
+            return
+        idle.append(conn)
+
+    def request(self, method, url, body):
+        _, _, host, path = url.split("/", 3)
+        port = 443
+
+        # 使い回した接続が切れていた場合は一度だけ張り直す
+        for attempt in range(2):
+            conn = self._acquire(host, port)
+            reused = conn.is_open()
+            try:
+                status, response, keep_alive = conn.request(method, path, body)
+            except OSError:
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+
+            if keep_alive:
+                self._release(conn)
+            else:
+                conn.close()
+            return status, response
+
+    def close_all(self):
+        for idle in self._idle.values():
+            for conn in idle:
+                conn.close()
+        self._idle = {}
+
+
+class AsyncHTTPConnection:
+    """
+    HTTPConnectionのuasyncio版
+    読み書きを待つ間もイベントループを止めないので、BLEの処理と並行して通信できる
+    """
+
+    def __init__(self, host, port, dns_cache):
+        self.host = host
+        self.port = port
+        self.dns_cache = dns_cache
+        self.stream = None
+        self.last_used = 0
+
+    def is_open(self):
+        return self.stream is not None
+
+    def is_idle_too_long(self):
+        return time.ticks_diff(time.ticks_ms(), self.last_used) >= KEEPALIVE_IDLE_MS
+
+    async def connect(self):
+        # 名前解決はブロッキングなのでキャッシュしたアドレスに繋ぎ、SNIにはホスト名を使う
+        addr_info = self.dns_cache.resolve(self.host, self.port)
+        ip = addr_info[4][0]
+        try:
+            reader, writer = await uasyncio.open_connection(
+                ip, self.port, ssl=True, server_hostname=self.host
+            )
+        except OSError:
+            self.dns_cache.invalidate(self.host, self.port)
+            raise
+        self.stream = (reader, writer)
+
+    async def close(self):
+        if self.stream is not None:
+            _, writer = self.stream
+            self.stream = None
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def request(self, method, path, body):
+        """
+        リクエストを送りレスポンスを読み切る
+        戻り値は (status, body, keep_alive)
+        """
+        if self.stream is None:
+            await self.connect()
+        reader, writer = self.stream
+
+        writer.write(_request_head(method, self.host, path, body) + body)
+        await writer.drain()
+
+        head = ResponseHead(await reader.readline())
+        while head.feed(await reader.readline()):
+            pass
+
+        keep_alive = head.keep_alive
+        if head.chunked:
+            response = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip(), 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b""):
+                        pass
+                    break
+                response += await reader.readexactly(size)
+                await reader.readline()
+        elif head.content_length is not None:
+            response = await reader.readexactly(head.content_length)
+        else:
+            response = b""
+            while True:
+                chunk = await reader.read(1024)
+                if not chunk:
+                    break
+                response += chunk
+            keep_alive = False
+
+        self.last_used = time.ticks_ms()
+        return head.status, response, keep_alive
+
+
+class AsyncConnectionPool:
+    """ConnectionPoolのuasyncio版"""
+
+    def __init__(self, dns_cache, max_idle_per_host=MAX_IDLE_CONNECTIONS_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self.dns_cache = dns_cache
+        self._idle = {}  # (host, port) -> [AsyncHTTPConnection]
+
+    async def _acquire(self, host, port):
+        idle = self._idle.get((host, port))
+        while idle:
+            conn = idle.pop()
+            if conn.is_idle_too_long():
+                await conn.close()
+                continue
+            return conn
+        return AsyncHTTPConnection(host, port, self.dns_cache)
+
+    async def _release(self, conn):
+        idle = self._idle.setdefault((conn.host, conn.port), [])
+        if len(idle) >= self.max_idle_per_host:
+            await conn.close()
+            return
+        idle.append(conn)
+
+    async def request(self, method, url, body, timeout_ms=REQUEST_TIMEOUT_MS):
+        _, _, host, path = url.split("/", 3)
+        port = 443
+
+        for attempt in range(2):
+            conn = await self._acquire(host, port)
+            reused = conn.is_open()
+            try:
+                status, response, keep_alive = await uasyncio.wait_for_ms(
+                    conn.request(method, path, body), timeout_ms
+                )
+            except (OSError, uasyncio.TimeoutError) as e:
+                await conn.close()
+                if reused and attempt == 0 and isinstance(e, OSError):
+                    continue
+                raise
+
+            if keep_alive:
+                await self._release(conn)
+            else:
+                await conn.close()
+            return status, response
+
+
+_pool = ConnectionPool()
+_async_pool = AsyncConnectionPool(_pool.dns_cache)
+
+
+def send_post_request(url, data):
+    # 同じホストへのリクエストは接続を使い回す
+    trace(TR_HTTP_BEGIN)
+    try:
+        status, response = _pool.request("POST", url, ujson.dumps(data).encode("utf-8"))
+    except Exception:
+        trace(TR_HTTP_END, -1)
+        raise
+    trace(TR_HTTP_END, status)
+    if status >= 400:
+        raise HTTPStatusError(status, response)
+    return response
+
+
+async def async_send_post_request(url, data, timeout_ms=REQUEST_TIMEOUT_MS):
+    # send_post_requestの非同期版 待っている間もイベントループは止まらない
+    trace(TR_HTTP_BEGIN)
+    try:
+        status, response = await _async_pool.request(
+            "POST", url, ujson.dumps(data).encode("utf-8"), timeout_ms
+        )
+    except Exception:
+        trace(TR_HTTP_END, -1)
+        raise
+    trace(TR_HTTP_END, status)
+    if status >= 400:
+        raise HTTPStatusError(status, response)
     return response
 
 
@@ -0,0 +1,101 @@
+"""
+edge/ 共通のログ
+printの代わりに使う レベルより低いものは文字列を組み立てずに捨てる
+
+    import log
+    log.info("{}バイトを受け取りました", len(msg))   # 出す時だけformatする
+    if __debug__:
+        log.debug("V = {:.2f}", voltage)              # mpy-cross -O1 で呼び出しごと消える
+
+既定のレベルはINFO 開発中にdebugを見たい時は、起動時に log.set_level(log.DEBUG) を呼ぶ
+(.pyのまま置くと__debug__はTrueなので、debugを出すかどうかはレベルだけで決まる)
+
+サンプリングなどのホットパスでは
+- f文字列ではなく書式と引数を渡す (レベルで捨てられる時は組み立てない)
+- debugは `if __debug__:` で囲む mpy-cross -O1 でビルドすると__debug__がFalseになり、
+  ブロックごとバイトコードから消える (引数のタプルも作られない)
+- 何度も通る場所はRateLimitedLogで間引く
+"""
+
+import time
+from micropython import const
+
+DEBUG = const(10)
+INFO = const(20)
+WARNING = const(30)
+ERROR = const(40)
+# これにするとログを全て止める
+SILENT = const(100)
+
+# これより低いレベルは出さない
+level = INFO
+
+
+def set_level(new_level):
+    global level
+    level = new_level
+
+
+def enabled(message_level):
+    return message_level >= level
+
+
+def _emit(message, args, suppressed=0):
+    if args:
+        message = message.format(*args)
+    if suppressed:
+        print(message, f"(他{suppressed}件を省略)")
+    else:
+        print(message)
+
+
+def debug(message, *args):
+    if DEBUG >= level:
+        _emit(message, args)
+
+
+def info(message, *args):
+    if INFO >= level:
+        _emit(message, args)
+
+
+def warning(message, *args):
+    if WARNING >= level:
+        _emit(message, args)
+
+
+def error(message, *args):
+    if ERROR >= level:
+        _emit(message, args)
+
+
+class RateLimitedLog:
+    """
+    呼び出す場所ごとに1つ作り、interval_msに1回だけ出すログ
+    出さなかった回数は次に出す時に添える
+
+        _high_log = log.RateLimitedLog(1000)
+        ...
+        if __debug__:
+            _high_log("センサー状態: HIGH ({})", state)
+    """
+
+    def __init__(self, interval_ms, message_level=DEBUG):
+        self.interval_ms = interval_ms
+        self.level = message_level
+        self._last_ms = 0
+        self._emitted = False
+        self._suppressed = 0
+
+    def __call__(self, message, *args):
+        if self.level < level:
+            return
+        now = time.ticks_ms()
+        if self._emitted and time.ticks_diff(now, self._last_ms) < self.interval_ms:
+            self._suppressed += 1
+            return
+        self._last_ms = now
+        self._emitted = True
+        suppressed = self._suppressed
+        self._suppressed = 0
+        _emit(message, args, suppressed)
@@ -0,0 +1,162 @@
+# トイレットペーパーの回転(ロール)を電圧の揺れから数える検出器と、記録した波形(トレース)の形式
+# machine / rp2 に依存しないのでCPythonでも読み込める (edge/bench/paper_replay.py から使う)
+import struct
+from array import array
+
+# この分散を超えたら回っているとみなす
+DEFAULT_THRESHOLD = 0.005
+# 分散を計算する窓の長さ
+WINDOW_MS = 50
+# 1ロールを数えてから次を数えるまでの最短時間
+MIN_ROLL_INTERVAL_MS = 1000
+# read_u16() の値を電圧にする係数
+COEFF_U16 = 3.3 / 65535
+# ADCのFIFOから読む12bitの値を電圧にする係数
+COEFF_12BIT = 3.3 / 4095
+
+# トレースファイル: マジック + サンプリング周波数(u32) + 12bitの生の値(u16)の並び (すべてリトルエンディアン)
+TRACE_MAGIC = b"BTP1"
+TRACE_HEADER_FORMAT = "<4sI"
+TRACE_HEADER_SIZE = 8
+
+
+class RollingStats:
+    """
+    直近size個の値の平均と分散を保持する
+    値はarray('f')のリングバッファに置き、合計と二乗和を足し引きするので1回の更新はO(1)
+    丸め誤差が溜まらないよう、バッファを1周するごとに合計を計算し直す
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._values = array("f", [0.0] * size)
+        self.clear()
+
+    def clear(self):
+        for i in range(self.size):
+            self._values[i] = 0.0
+        self._index = 0
+        self._count = 0
+        self._sum = 0.0
+        self._sum_sq = 0.0
+
+    def add(self, value):
+        index = self._index
+        if self._count == self.size:
+            old = self._values[index]
+            self._sum -= old
+            self._sum_sq -= old * old
+        else:
+            self._count += 1
+        self._values[index] = value
+        self._sum += value
+        self._sum_sq += value * value
+
+        index += 1
+        if index == self.size:
+            index = 0
+            self._resum()
+        self._index = index
+
+    def _resum(self):
+        total = 0.0
+        total_sq = 0.0
+        for i in range(self._count):
+            value = self._values[i]
+            total += value
+            total_sq += value * value
+        self._sum = total
+        self._sum_sq = total_sq
+
+    def __len__(self):
+        return self._count
+
+    def mean(self):
+        if self._count == 0:
+            return 0
+        return self._sum / self._count
+
+    def variance(self):
+        # 要素がない場合、分散はゼロとする
+        if self._count == 0:
+            return 0
+        mean = self._sum / self._count
+        return max(0.0, self._sum_sq / self._count - mean * mean)
+
+
+class RollDetector:
+    """
+    電圧を1つずつ受け取り、直近windowサンプルの分散がしきい値を超えた立ち上がりでロールを数える
+    1つ数えたらintervalサンプルの間は次を数えない
+    on_change(flag, voltage, variance) は判定が切り替わった時に呼ばれる (LEDの点灯など)
+    """
+
+    def __init__(self, window, interval, threshold=DEFAULT_THRESHOLD, on_change=None):
+        self.stats = RollingStats(window)
+        self.interval = interval
+        self.threshold = threshold
+        self.on_change = on_change
+        self.reset()
+
+    def reset(self):
+        self.stats.clear()
+        self.roll = 0
+        self.count = 0
+        self.current_flag = False
+
+    def feed(self, voltage):
+        self.stats.add(voltage)
+        variance = self.stats.variance()
+
+        flag = variance >= self.threshold and self.count >= self.interval
+
+        if flag != self.current_flag:
+            if flag:
+                self.roll += 1
+                self.count = 0
+            self.current_flag = flag
+            if self.on_change is not None:
+                self.on_change(flag, voltage, variance)
+
+        self.count += 1
+
+
+def make_detector(rate_hz, threshold=DEFAULT_THRESHOLD, on_change=None):
+    """rate_hzで電圧を渡す時の検出器を作る 窓と間隔はサンプル数に直す"""
+    return RollDetector(
+        window=max(2, rate_hz * WINDOW_MS // 1000),
+        interval=rate_hz * MIN_ROLL_INTERVAL_MS // 1000,
+        threshold=threshold,
+        on_change=on_change,
+    )
+
+
+def feed_block(detector, block, decimation, coeff, length=None):
+    """
+    高いレートで取った生の値をdecimation個ずつ平均して(間引いて)detectorへ渡す
+    平均することでノイズも減る 端数のサンプルは捨てる
+    """
+    if length is None:
+        length = len(block)
+    scale = coeff / decimation
+    for start in range(0, length - decimation + 1, decimation):
+        total = 0
+        for i in range(start, start + decimation):
+            total += block[i]
+        detector.feed(total * scale)
+
+
+def write_trace_header(file, rate_hz):
+    file.write(struct.pack(TRACE_HEADER_FORMAT, TRACE_MAGIC, rate_hz))
+
+
+def load_trace(path):
+    """トレースファイルを (サンプリング周波数, array('H')) で返す PC側で使う"""
+    with open(path, "rb") as file:
+        magic, rate_hz = struct.unpack(TRACE_HEADER_FORMAT, file.read(TRACE_HEADER_SIZE))
+        if magic != TRACE_MAGIC:
+            raise ValueError(f"not a paper trace: {path}")
+        raw = file.read()
+    samples = array("H")
+    samples.frombytes(raw[: len(raw) - len(raw) % 2])
+    return rate_hz, samples
@@ -0,0 +1,145 @@
+"""
+edge/ のコードをPC(CPython)上で、実機なしで動かすためのシミュレーション
+
+install() でMicroPython固有のモジュール(micropython, machine, rp2, bluetooth, aioble,
+network, usocket, uasyncio, ujson, ubinascii)を偽物に差し替え、time.ticks_* と
+asyncio.ThreadSafeFlag / sleep_ms / wait_for_ms を足す
+偽物はデバイスごとの状態を bus.VirtualBLEBus 上の VirtualDevice に持つので、
+ハブと周辺デバイスを1つのイベントループで一緒に動かせる (runner.Simulator)
+
+    import sim
+    sim.install()
+    simulator = sim.Simulator()
+
+sim.run() で動かすと仮想時計(clock.VirtualTimeEventLoop)になり、タイマーを待つ間は時計を進めるだけになる
+"""
+
+import asyncio
+import binascii
+import json
+import os
+import sys
+import time
+import types
+
+EDGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HUB_DIR = os.path.join(EDGE_DIR, "hub")
+
+
+class ThreadSafeFlag:
+    def __init__(self):
+        self._event = asyncio.Event()
+
+    def set(self):
+        self._event.set()
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self):
+        await self._event.wait()
+        self._event.clear()
+
+
+async def _sleep_ms(ms):
+    await asyncio.sleep(ms / 1000)
+
+
+async def _wait_for_ms(awaitable, timeout_ms):
+    return await asyncio.wait_for(awaitable, timeout_ms / 1000)
+
+
+def _identity(func):
+    return func
+
+
+def _micropython_module():
+    module = types.ModuleType("micropython")
+    module.const = lambda value: value
+    # コード生成の指定はCPythonでは意味がないのでそのまま返す
+    module.native = _identity
+    module.viper = _identity
+    module.schedule = lambda func, arg: asyncio.get_running_loop().call_soon(func, arg)
+    module.alloc_emergency_exception_buf = lambda size: None
+    return module
+
+
+# rp2のMicroPythonと同じく、ticks_*は30bitで折り返す
+_TICKS_MAX = (1 << 30) - 1
+_TICKS_HALF = 1 << 29
+
+
+def _install_time():
+    # イベントループの時刻から作るので、仮想時計のループ(sim.clock)の中では仮想の時刻になる
+    from sim import clock
+    from sim.bus import now
+
+    epoch = time.time() - time.monotonic()
+    time.time = lambda: epoch + now()
+    time.ticks_ms = lambda: int(now() * 1000) & _TICKS_MAX
+    time.ticks_us = lambda: int(now() * 1000000) & _TICKS_MAX
+    time.ticks_diff = lambda a, b: ((a - b + _TICKS_HALF) & _TICKS_MAX) - _TICKS_HALF
+    time.ticks_add = lambda a, b: (a + b) & _TICKS_MAX
+    time.sleep_ms = lambda ms: clock.sleep(ms / 1000)
+    time.sleep_us = lambda us: clock.sleep(us / 1000000)
+
+
+def install(bus=None):
+    """
+    偽物のモジュールを入れ、edge/ と edge/hub/ をimportできるようにする 何度呼んでもよい
+    busを渡すとそれを以後の仮想BLEバスにする
+    """
+    for path in (EDGE_DIR, HUB_DIR):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    from sim import bus as bus_module
+
+    if bus is not None:
+        bus_module.set_bus(bus)
+    if "micropython" in sys.modules and getattr(sys.modules["micropython"], "_sim", False):
+        return
+
+    micropython = _micropython_module()
+    micropython._sim = True
+    sys.modules["micropython"] = micropython
+
+    # MicroPythonではasyncio = uasyncio なので、edge/のコードは両方の名前で使う
+    asyncio.ThreadSafeFlag = ThreadSafeFlag
+    asyncio.sleep_ms = _sleep_ms
+    asyncio.wait_for_ms = _wait_for_ms
+    _install_time()
+
+    from sim import fake_aioble, fake_bluetooth, fake_machine, fake_network, fake_rp2
+
+    uasyncio = types.ModuleType("uasyncio")
+    uasyncio.__dict__.update(asyncio.__dict__)
+    uasyncio.open_connection = fake_network.open_connection
+    sys.modules["uasyncio"] = uasyncio
+
+    usocket = types.ModuleType("usocket")
+    usocket.AF_INET = fake_network.socket.AF_INET
+    usocket.SOCK_STREAM = fake_network.socket.SOCK_STREAM
+    usocket.getaddrinfo = fake_network.getaddrinfo
+    # 同期版(HTTPConnection)はシミュレーションでは使わない
+    usocket.socket = fake_network.socket.socket
+    sys.modules["usocket"] = usocket
+
+    # from aioble.client import ... も同じモジュールから読む
+    fake_aioble.client = fake_aioble
+    sys.modules["aioble"] = fake_aioble
+    sys.modules["aioble.client"] = fake_aioble
+    sys.modules["bluetooth"] = fake_bluetooth
+    sys.modules["machine"] = fake_machine
+    sys.modules["rp2"] = fake_rp2
+    sys.modules["network"] = fake_network
+    sys.modules["ujson"] = json
+    sys.modules["ubinascii"] = binascii
+    sys.modules["utime"] = time
+    sys.modules["uos"] = os
+
+
+from sim.bus import VirtualBLEBus, VirtualDevice, current_device, get_bus  # noqa: E402
+from sim.clock import VirtualClock, VirtualTimeEventLoop, run  # noqa: E402
+from sim.cloud import CloudFunctionsStub  # noqa: E402
+from sim.runner import Simulator  # noqa: E402
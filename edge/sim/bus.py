@@ -0,0 +1,442 @@
+"""
+1つのイベントループの中で複数のデバイスをつなぐ仮想BLEバス
+広告・スキャン・接続・GATTの読み書きと通知を、遅延・MTU・パケットロス付きで再現する
+
+どのデバイスとして動いているかはcontextvarで持つ
+デバイスごとにrun()/create_task()で作ったタスクの中では、aioble/machine/rp2の偽物が
+そのデバイスの状態(ピン・レジスタ・広告・接続)を使う
+"""
+
+import asyncio
+import contextvars
+import errno
+import random
+import time
+from collections import deque
+
+DEFAULT_ATT_MTU = 23
+# ATTのヘッダー(opcode + handle)
+ATT_HEADER_SIZE = 3
+# 広告パケット・スキャン応答1つに載せられる長さ
+ADV_PAYLOAD_SIZE = 31
+
+_current_device = contextvars.ContextVar("sim_device", default=None)
+_bus = None
+
+
+def get_bus():
+    global _bus
+    if _bus is None:
+        _bus = VirtualBLEBus()
+    return _bus
+
+
+def set_bus(bus):
+    global _bus
+    _bus = bus
+
+
+def now():
+    """イベントループの時刻 (ループの外ではtime.monotonic)"""
+    try:
+        return asyncio.get_running_loop().time()
+    except RuntimeError:
+        return time.monotonic()
+
+
+def current_device():
+    """今動いているデバイス デバイスの外(シナリオ側)ではバスのhost"""
+    device = _current_device.get()
+    if device is None:
+        return get_bus().host
+    return device
+
+
+def _task_factory(loop, coro, context=None, **kwargs):
+    task = asyncio.Task(coro, loop=loop, context=context, **kwargs)
+    device = (context or contextvars.copy_context()).get(_current_device)
+    if device is not None:
+        device.tasks.add(task)
+        task.add_done_callback(device.tasks.discard)
+    return task
+
+
+def track_tasks(loop):
+    """デバイスとして作られたタスクを、子タスクも含めてVirtualDevice.tasksに集める"""
+    loop.set_task_factory(_task_factory)
+
+
+class VirtualDevice:
+    """バスにつながった1台分の状態 (ピン・レジスタ・DMA・広告・接続)"""
+
+    def __init__(self, bus, name, addr):
+        self.bus = bus
+        self.name = name
+        self.addr_type = 0
+        self.addr = addr
+        self.radio_on = True
+        # GATTサーバー
+        self.services = []
+        self.handles = {}  # 値ハンドル -> Characteristic
+        self.preferred_mtu = DEFAULT_ATT_MTU
+        # 広告中なら (adv_data, resp_data, 接続を受け取るfuture)
+        self.advertising = None
+        self.advertising_changed = asyncio.Event()
+        self.links = []
+        # machine / rp2
+        self.pins = {}
+        self.registers = {}
+        self.dmas = []
+        self.state_machines = {}
+        self.pwm_log = []  # (時刻, ピン, duty_u16)
+        self.adc_source = None  # (チャネル, 時刻) -> 12bitの値
+        self.bootsel = 0
+        # network
+        self.wifi_connected = False
+        # このデバイスとして動いているタスク (track_tasksで集める)
+        self.tasks = set()
+
+    def __repr__(self):
+        return f"<VirtualDevice {self.name}>"
+
+    def context(self):
+        """このデバイスとして動くContext (タスクやコールバックに渡す)"""
+        context = contextvars.copy_context()
+        context.run(_current_device.set, self)
+        return context
+
+    def call(self, func, *args):
+        """このデバイスとしてfuncを呼ぶ (割り込みハンドラやコンストラクタ用)"""
+        return self.context().run(func, *args)
+
+    def create_task(self, coro):
+        return asyncio.get_running_loop().create_task(coro, context=self.context())
+
+    def power_off(self):
+        """無線を止めて接続を切る (止めたデバイスに繋ぎ直されないように)"""
+        self.radio_on = False
+        self.advertising_changed.set()
+        for link in list(self.links):
+            link.close()
+
+    def pin(self, pin_id):
+        """Pinの状態 (fake_machine.PinState) なければ作る"""
+        state = self.pins.get(pin_id)
+        if state is None:
+            from sim.fake_machine import PinState
+
+            state = self.pins[pin_id] = PinState(self, pin_id)
+        return state
+
+    def adc(self, channel, t):
+        if self.adc_source is None:
+            return 0
+        return self.adc_source(channel, t)
+
+    def is_advertising(self):
+        return self.radio_on and self.advertising is not None
+
+    def start_advertising(self, adv_data, resp_data):
+        future = asyncio.get_running_loop().create_future()
+        self.advertising = (bytes(adv_data), bytes(resp_data or b""), future)
+        self.advertising_changed.set()
+        return future
+
+    def stop_advertising(self, future=None):
+        if self.advertising is None:
+            return
+        if future is not None and self.advertising[2] is not future:
+            return
+        self.advertising = None
+        self.advertising_changed.set()
+
+    def register(self, services):
+        # NimBLEと同じく サービス宣言 / (キャラクタリスティック宣言, 値, CCCD) の順にハンドルを振る
+        self.services = list(services)
+        self.handles = {}
+        handle = 1
+        for service in self.services:
+            service._start_handle = handle
+            for char in service.characteristics:
+                char._def_handle = handle + 1
+                char._value_handle = handle + 2
+                handle += 2
+                if char.properties & (_FLAG_NOTIFY | _FLAG_INDICATE):
+                    handle += 1
+                self.handles[char._value_handle] = char
+            service._end_handle = handle
+            handle += 1
+        for service in self.services:
+            chars = service.characteristics
+            for i, char in enumerate(chars):
+                char._end_handle = (
+                    chars[i + 1]._def_handle - 1 if i + 1 < len(chars) else service._end_handle
+                )
+
+
+# aiobleと同じプロパティのビット
+_FLAG_NOTIFY = 0x0010
+_FLAG_INDICATE = 0x0020
+
+
+class _Channel:
+    """一方向のPDUの列 送った順に、遅延の後で1つずつ届ける"""
+
+    def __init__(self, bus):
+        self.bus = bus
+        self._queue = deque()
+        self._handle = None
+        self._last_due = 0.0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def push(self, deliver, args):
+        loop = asyncio.get_running_loop()
+        due = max(loop.time() + self.bus._delay(), self._last_due)
+        self._last_due = due
+        self._queue.append((due, deliver, args))
+        if self._handle is None:
+            self._handle = loop.call_at(due, self._pump)
+
+    def _pump(self):
+        self._handle = None
+        loop = asyncio.get_running_loop()
+        while self._queue and self._queue[0][0] <= loop.time():
+            _, deliver, args = self._queue.popleft()
+            deliver(*args)
+        if self._queue:
+            self._handle = loop.call_at(self._queue[0][0], self._pump)
+
+    def clear(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._queue.clear()
+
+
+class Link:
+    """centralとperipheralの間の1つの接続"""
+
+    def __init__(self, bus, central, peripheral):
+        self.bus = bus
+        self.central = central
+        self.peripheral = peripheral
+        self.mtu = DEFAULT_ATT_MTU
+        self.connected = True
+        self._channels = {central: _Channel(bus), peripheral: _Channel(bus)}
+        # 両端のDeviceConnection (fake_aioble)
+        self.ends = {}
+
+    def peer(self, device):
+        return self.peripheral if device is self.central else self.central
+
+    def payload_size(self):
+        return self.mtu - ATT_HEADER_SIZE
+
+    def send(self, sender, deliver, *args, unacked=False):
+        """
+        senderから相手へPDUを送る 届いたらdeliver(*args)を呼ぶ
+        unackedのPDU(通知・write command)は送信バッファが溢れるとOSError、
+        bus.lossの確率で失われる
+        """
+        if not self.connected:
+            raise OSError(errno.ENOTCONN, "not connected")
+        channel = self._channels[self.peer(sender)]
+        stats = self.bus.stats
+        if unacked:
+            if len(channel) >= self.bus.tx_buffer:
+                stats["tx_full"] += 1
+                raise OSError(errno.ENOMEM, "tx buffer full")
+            if self.bus.loss and self.bus.rng.random() < self.bus.loss:
+                stats["lost"] += 1
+                return
+        stats["pdus"] += 1
+        channel.push(self._deliver, (deliver, args))
+
+    def _deliver(self, deliver, args):
+        if self.connected:
+            deliver(*args)
+
+    def clip(self, data):
+        """MTUに入りきらない分を切り捨てる"""
+        data = bytes(data)
+        size = self.payload_size()
+        if len(data) > size:
+            self.bus.stats["truncated"] += 1
+            return data[:size]
+        return data
+
+    def close(self):
+        if not self.connected:
+            return
+        self.connected = False
+        for channel in self._channels.values():
+            channel.clear()
+        for device in (self.central, self.peripheral):
+            if self in device.links:
+                device.links.remove(self)
+        for end in self.ends.values():
+            end._on_disconnected()
+
+
+class VirtualBLEBus:
+    """
+    仮想デバイスを登録し、その間の無線を模擬する
+    latency_ms   : 1つのPDUが相手に届くまでの時間 (jitter_msの幅でばらつかせる)
+    loss         : 通知・write commandが失われる確率
+    tx_buffer    : 届いていない通知・write commandを接続ごとに溜められる数
+    connect_ms   : 広告を見つけてから接続が確立するまでの時間
+    """
+
+    def __init__(
+        self,
+        latency_ms=15,
+        jitter_ms=0,
+        loss=0.0,
+        tx_buffer=16,
+        connect_ms=50,
+        advertise_interval_ms=100,
+        supervision_timeout_ms=500,
+        seed=0,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.loss = loss
+        self.tx_buffer = tx_buffer
+        self.connect_ms = connect_ms
+        self.advertise_interval_ms = advertise_interval_ms
+        self.supervision_timeout_ms = supervision_timeout_ms
+        self.rng = random.Random(seed)
+        self.devices = []
+        # WiFiのSSID -> パスワード と、ホスト名 -> (接続先ホスト, ポート)
+        self.wifi_networks = {}
+        self.wifi_connect_ms = 1000
+        self.http_routes = {}
+        self.stats = {
+            "pdus": 0,
+            "lost": 0,
+            "truncated": 0,
+            "tx_full": 0,
+            "connections": 0,
+            "discovery_round_trips": 0,
+        }
+        # observe()で呼ばれる関数 (kind, *args) ベンチマークなどが出来事の時刻を取るのに使う
+        self.observers = []
+        # デバイスの外(シナリオ側)で使う仮のデバイス
+        self.host = VirtualDevice(self, "host", bytes(6))
+
+    def observe(self, kind, *args):
+        """
+        出来事をobserversに知らせる
+        "write"  (周辺デバイス, キャラクタリスティックのUUID, データ): 周辺デバイスに書き込みが届いた
+        "notify" (周辺デバイス, キャラクタリスティックのUUID, データ): 周辺デバイスからの通知が届いた
+        "http"   (ホスト名, パス, ボディ): HTTPのスタブが応答を返した
+        """
+        for observer in self.observers:
+            observer(kind, *args)
+
+    def _delay(self):
+        delay = self.latency_ms
+        if self.jitter_ms:
+            delay += self.rng.uniform(0, self.jitter_ms)
+        return delay / 1000
+
+    async def round_trip(self):
+        """要求と応答の1往復を待つ"""
+        await asyncio.sleep(2 * self._delay())
+
+    def add_device(self, name):
+        # アドレスは登録順で決まるので、毎回同じになる
+        addr = bytes((0x28, 0xCD, 0xC1, 0x00, 0x00, len(self.devices) + 1))
+        device = VirtualDevice(self, name, addr)
+        self.devices.append(device)
+        return device
+
+    def device(self, name):
+        for device in self.devices:
+            if device.name == name:
+                return device
+        raise KeyError(name)
+
+    def find(self, addr_type, addr):
+        for device in self.devices:
+            if device.addr_type == addr_type and device.addr == bytes(addr):
+                return device
+        return None
+
+    async def connect(self, central, addr_type, addr):
+        """広告しているperipheralに接続し、(Link, peripheral側の広告future) を返す"""
+        while True:
+            peripheral = self.find(addr_type, addr)
+            if peripheral is not None and peripheral.is_advertising():
+                await asyncio.sleep(self.connect_ms / 1000)
+                # 待っている間に他の相手と繋がった・広告をやめた時はやり直す
+                if peripheral.is_advertising() and central.radio_on:
+                    break
+                continue
+            if peripheral is None:
+                await asyncio.sleep(self.advertise_interval_ms / 1000)
+                continue
+            peripheral.advertising_changed.clear()
+            await peripheral.advertising_changed.wait()
+
+        future = peripheral.advertising[2]
+        peripheral.stop_advertising()
+        link = Link(self, central, peripheral)
+        central.links.append(link)
+        peripheral.links.append(link)
+        self.stats["connections"] += 1
+        return link, future
+
+    def drop(self, name):
+        """デバイスの接続を全て失わせる 両端が気付くのは監視タイムアウトの後"""
+        device = self.device(name)
+        loop = asyncio.get_running_loop()
+        for link in list(device.links):
+            loop.call_later(self.supervision_timeout_ms / 1000, link.close)
+
+    def set_radio(self, name, on):
+        """無線を止める(電源断の代わり) 止めている間は見つからず、接続もできない"""
+        device = self.device(name)
+        device.radio_on = on
+        device.advertising_changed.set()
+        if not on:
+            self.drop(name)
+
+    async def scan(self, scanner, queue, duration_ms, active, make_result):
+        """
+        広告しているデバイスを広告の間隔で見つけ、make_result(device, adv, resp)をqueueに入れる
+        同じデバイスは1回のスキャンで1度だけ (aiobleは内容が変わらない結果を重複して返さない)
+        アクティブスキャンの時はスキャン応答を1往復後にもう一度入れる
+        """
+        loop = asyncio.get_running_loop()
+        interval = self.advertise_interval_ms / 1000
+        end = loop.time() + duration_ms / 1000
+        next_seen = {}
+        reported = set()
+        while True:
+            now = loop.time()
+            if now >= end:
+                break
+            for device in self.devices:
+                if device is scanner or device in reported or not device.is_advertising():
+                    continue
+                due = next_seen.get(device)
+                if due is None:
+                    # 広告の位相はデバイスごとにばらばら
+                    due = next_seen[device] = now + self.rng.random() * interval
+                if due > now:
+                    continue
+                reported.add(device)
+                adv_data, resp_data, _ = device.advertising
+                queue.put_nowait(make_result(device, adv_data, b""))
+                if active and resp_data:
+                    loop.call_later(
+                        2 * self._delay(),
+                        queue.put_nowait,
+                        make_result(device, adv_data, resp_data),
+                    )
+            wake = min([end, now + interval] + [t for t in next_seen.values() if t > now])
+            await asyncio.sleep(wake - now)
+        queue.put_nowait(None)
@@ -0,0 +1,71 @@
+"""
+仮想時計のイベントループ
+待つものがタイマーしかない時は、selectで眠らずに次のタイマーの時刻まで時計を進める
+sim.install()のtime.ticks_ms / ticks_us / time.time はイベントループの時刻から作るので、
+このループの中では全て仮想の時刻になる 1時間分の利用も実時間では数秒で流せる
+
+    import sim
+    sim.run(main())            # 仮想時計で動かす
+    sim.run(main(), clock=c)   # 時計を外から見たい時
+
+ソケット(CloudFunctionsStubなど)は本物なので、届いている分は時計を進める前に必ず処理する
+"""
+
+import asyncio
+import selectors
+import time
+
+
+class VirtualClock:
+    """秒単位の仮想の時刻 advance()でしか進まない"""
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+
+class _VirtualTimeSelector(selectors.DefaultSelector):
+    def __init__(self, clock):
+        super().__init__()
+        self._clock = clock
+
+    def select(self, timeout=None):
+        # 本物のソケットに届いているものがあれば時計を進めずに返す
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            # タイマーがなく、ソケットを待つしかない
+            return super().select(None)
+        self._clock.advance(timeout)
+        return []
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock=None):
+        self.clock = clock or VirtualClock()
+        super().__init__(_VirtualTimeSelector(self.clock))
+
+    def time(self):
+        return self.clock.now
+
+
+def run(coro, clock=None):
+    """asyncio.runの仮想時計版"""
+    with asyncio.Runner(loop_factory=lambda: VirtualTimeEventLoop(clock)) as runner:
+        return runner.run(coro)
+
+
+def sleep(seconds):
+    """time.sleepの代わり 仮想時計のループの中なら時計を進めるだけで戻る"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if isinstance(loop, VirtualTimeEventLoop):
+        loop.clock.advance(seconds)
+    else:
+        time.sleep(seconds)
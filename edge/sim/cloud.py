@@ -0,0 +1,105 @@
+"""
+Cloud Functions (saveHistoryBatch / editData) の代わりに手元で動かすHTTPサーバー
+usocket_firebase_test.async_send_post_request が送るkeep-aliveのHTTP/1.1を受けて200を返す
+start()でVirtualBLEBus.http_routesに登録するので、ハブのURLはそのままでよい
+"""
+
+import asyncio
+import json
+
+from sim.bus import get_bus, now
+
+# ハブが使うCloud Functionsのホスト
+FUNCTIONS_HOSTS = (
+    "asia-northeast1-jphacks-ben-tech.cloudfunctions.net",
+    "asia-northeast2-jphacks-ben-tech.cloudfunctions.net",
+)
+
+
+class CloudFunctionsStub:
+    """
+    受けたリクエストを (時刻, パス, ボディ) でrequestsに残し、応答を返すたびにbus.observe("http", ...)する
+    response_delay_msで関数の実行時間を、statusでエラー応答を模擬できる
+    """
+
+    def __init__(self, response_delay_ms=0, status=200):
+        self.response_delay_ms = response_delay_ms
+        self.status = status
+        self.requests = []
+        self.connections = 0
+        self._server = None
+        self._handlers = {}  # 接続ごとの処理タスク -> writer
+
+    async def start(self, hosts=FUNCTIONS_HOSTS):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        port = self._server.sockets[0].getsockname()[1]
+        bus = get_bus()
+        for host in hosts:
+            bus.http_routes[host] = ("127.0.0.1", port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        # keep-aliveで残っている接続はこちらから閉じ、処理タスクが読み終わるのを待つ
+        # (キャンセルするとasyncio.streamsがエラーを出す)
+        handlers = list(self._handlers.items())
+        for _, writer in handlers:
+            writer.close()
+        if handlers:
+            await asyncio.wait([task for task, _ in handlers])
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        task = asyncio.current_task()
+        self._handlers[task] = writer
+        try:
+            # keep-aliveなので、クライアントが閉じるまで同じ接続でリクエストを受ける
+            while await self._handle(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self._handlers[task]
+            writer.close()
+
+    async def _handle(self, reader, writer):
+        request_line = await reader.readline()
+        if not request_line:
+            return False
+        _, path, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+        if self.response_delay_ms:
+            await asyncio.sleep(self.response_delay_ms / 1000)
+        data = json.loads(body) if body else None
+        self.requests.append((now(), path, data))
+
+        response = json.dumps({"ok": self.status < 400}).encode("utf-8")
+        writer.write(
+            (
+                f"HTTP/1.1 {self.status} {'OK' if self.status < 400 else 'Error'}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(response)}\r\n"
+                f"Connection: keep-alive\r\n\r\n"
+            ).encode("utf-8")
+            + response
+        )
+        await writer.drain()
+        get_bus().observe("http", headers.get("host"), path, data)
+        return True
@@ -0,0 +1,546 @@
+"""
+aiobleの代わり 仮想BLEバス(bus.py)の上で、このリポジトリが使う範囲のAPIを再現する
+  peripheral: Service / Characteristic / register_services / advertise / config
+  central   : scan / Device.connect / DeviceConnection / ClientService / ClientCharacteristic
+aioble.clientとしても読み込まれる (ClientCharacteristic / GattError)
+"""
+
+import asyncio
+import struct
+from collections import deque
+
+from sim.bus import ADV_PAYLOAD_SIZE, current_device, get_bus
+from sim.fake_bluetooth import (
+    FLAG_INDICATE,
+    FLAG_NOTIFY,
+    FLAG_READ,
+    FLAG_WRITE,
+    FLAG_WRITE_NO_RESPONSE,
+    UUID,
+)
+
+_ADV_TYPE_FLAGS = 0x01
+_ADV_TYPE_UUID16_COMPLETE = 0x03
+_ADV_TYPE_UUID32_COMPLETE = 0x05
+_ADV_TYPE_UUID128_COMPLETE = 0x07
+_ADV_TYPE_NAME = 0x09
+
+# capture=Trueのキャラクタリスティックが溜めておける書き込みの数 (aiobleと同じ)
+_WRITE_CAPTURE_QUEUE_LIMIT = 10
+
+# ATTのエラーコード
+_ATT_ERROR_INVALID_HANDLE = 0x01
+_ATT_ERROR_READ_NOT_PERMITTED = 0x02
+_ATT_ERROR_WRITE_NOT_PERMITTED = 0x03
+_ATT_ERROR_INVALID_LENGTH = 0x0D
+
+
+class GattError(Exception):
+    def __init__(self, status):
+        super().__init__(f"GATT error {status}")
+        self._status = status
+
+
+class DeviceDisconnectedError(Exception):
+    pass
+
+
+def config(*args, **kwargs):
+    device = current_device()
+    if "mtu" in kwargs:
+        device.preferred_mtu = kwargs["mtu"]
+    if args == ("mac",):
+        return device.addr_type, device.addr
+    if args == ("mtu",):
+        return device.preferred_mtu
+    return None
+
+
+###### peripheral ######
+
+
+class Service:
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.characteristics = []
+        self._start_handle = None
+        self._end_handle = None
+
+
+class Characteristic:
+    def __init__(
+        self,
+        service,
+        uuid,
+        read=False,
+        write=False,
+        write_no_response=False,
+        notify=False,
+        indicate=False,
+        initial=None,
+        capture=False,
+    ):
+        service.characteristics.append(self)
+        self.service = service
+        self.uuid = uuid
+        self.properties = (
+            (FLAG_READ if read else 0)
+            | (FLAG_WRITE if write else 0)
+            | (FLAG_WRITE_NO_RESPONSE if write_no_response else 0)
+            | (FLAG_NOTIFY if notify else 0)
+            | (FLAG_INDICATE if indicate else 0)
+        )
+        self._value = bytes(initial or b"")
+        self._value_handle = None
+        self._write_queue = deque((), _WRITE_CAPTURE_QUEUE_LIMIT) if capture else None
+        self._write_connection = None
+        self._write_event = asyncio.Event()
+
+    def read(self):
+        return self._value
+
+    def write(self, data):
+        self._value = bytes(data)
+
+    async def written(self, timeout_ms=None):
+        """書き込まれるまで待つ captureなら (connection, data)、そうでなければconnection"""
+        while True:
+            if self._write_queue:
+                return self._write_queue.popleft()
+            if self._write_queue is None and self._write_connection is not None:
+                connection = self._write_connection
+                self._write_connection = None
+                return connection
+            self._write_event.clear()
+            if timeout_ms is None:
+                await self._write_event.wait()
+            else:
+                await asyncio.wait_for(self._write_event.wait(), timeout_ms / 1000)
+
+    def _remote_write(self, connection, data):
+        self._value = data
+        if self._write_queue is not None:
+            self._write_queue.append((connection, data))
+        else:
+            self._write_connection = connection
+        self._write_event.set()
+
+    def notify(self, connection, data=None):
+        if not self.properties & FLAG_NOTIFY:
+            raise ValueError("Not supported")
+        # aiobleと同じく、connectionがNoneならAttributeError、切れていればOSError
+        link = connection._link
+        payload = link.clip(self._value if data is None else data)
+        link.send(
+            connection._device,
+            connection._peer_end()._on_notify,
+            self._value_handle,
+            payload,
+            unacked=True,
+        )
+
+
+def register_services(*services):
+    current_device().register(services)
+
+
+def _append(adv_data, resp_data, adv_type, value):
+    # 広告パケットに入りきらなければスキャン応答に回す (aiobleと同じ)
+    data = struct.pack("BB", len(value) + 1, adv_type) + value
+    if len(data) + len(adv_data) < ADV_PAYLOAD_SIZE:
+        adv_data += data
+        return
+    if len(data) + len(resp_data) < ADV_PAYLOAD_SIZE:
+        resp_data += data
+        return
+    raise ValueError("Advertising payload too long")
+
+
+async def advertise(
+    interval_us,
+    adv_data=None,
+    resp_data=None,
+    connectable=True,
+    limited_disc=False,
+    appearance=0,
+    services=None,
+    manufacturer=None,
+    timeout_ms=None,
+    name=None,
+):
+    """接続されるまで広告し、peripheral側のDeviceConnectionを返す"""
+    if not adv_data and not resp_data:
+        adv_data = bytearray()
+        resp_data = bytearray()
+        _append(
+            adv_data, resp_data, _ADV_TYPE_FLAGS, bytes(((0x01 if limited_disc else 0x02) + 0x18,))
+        )
+        # aioble と同じく、サービスを先に入れてから名前を入れる
+        # (iOSはサービスでしか絞り込めないので広告データに入るようにしている)
+        # 128bitのUUIDは広告データに収まり、名前の方がスキャン応答にあふれる
+        for uuid in services or ():
+            raw = bytes(uuid)
+            adv_type = {
+                2: _ADV_TYPE_UUID16_COMPLETE,
+                4: _ADV_TYPE_UUID32_COMPLETE,
+                16: _ADV_TYPE_UUID128_COMPLETE,
+            }[len(raw)]
+            _append(adv_data, resp_data, adv_type, raw)
+        if name:
+            _append(adv_data, resp_data, _ADV_TYPE_NAME, name.encode("utf-8"))
+
+    device = current_device()
+    future = device.start_advertising(adv_data, resp_data)
+    try:
+        timeout = None if timeout_ms is None else timeout_ms / 1000
+        await asyncio.wait({future}, timeout=timeout)
+    finally:
+        device.stop_advertising(future)
+        if not future.done():
+            future.cancel()
+    if future.cancelled():
+        raise asyncio.TimeoutError
+    return future.result()
+
+
+###### central ######
+
+
+class Device:
+    def __init__(self, addr_type, addr):
+        self.addr_type = addr_type
+        self.addr = bytes(addr)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Device)
+            and self.addr_type == other.addr_type
+            and self.addr == other.addr
+        )
+
+    def __hash__(self):
+        return hash((self.addr_type, self.addr))
+
+    def __repr__(self):
+        return f"Device({self.addr_type}, {self.addr_hex()})"
+
+    def addr_hex(self):
+        return ":".join(f"{b:02x}" for b in self.addr)
+
+    async def connect(self, timeout_ms=10000, **kwargs):
+        central = current_device()
+        link, future = await asyncio.wait_for(
+            get_bus().connect(central, self.addr_type, self.addr), timeout_ms / 1000
+        )
+        peripheral = link.peripheral
+        central_end = DeviceConnection(central, link, Device(peripheral.addr_type, peripheral.addr))
+        peripheral_end = DeviceConnection(peripheral, link, Device(central.addr_type, central.addr))
+        link.ends = {central: central_end, peripheral: peripheral_end}
+        if future.done():
+            # 広告をやめた直後だった
+            link.close()
+            raise asyncio.TimeoutError
+        future.set_result(peripheral_end)
+        return central_end
+
+
+class DeviceConnection:
+    """接続の片端 centralとperipheralの両方が1つずつ持つ"""
+
+    def __init__(self, device, link, peer):
+        self._device = device
+        self._link = link
+        self.device = peer
+        # exchange_mtuするまではNone (aiobleと同じ)
+        self.mtu = None
+        self._characteristics = {}  # 値ハンドル -> ClientCharacteristic
+        self._pending = set()
+        self._disconnected = asyncio.Event()
+
+    def is_connected(self):
+        return self._link.connected
+
+    def _peer_end(self):
+        return self._link.ends[self._link.peer(self._device)]
+
+    def _on_disconnected(self):
+        self._disconnected.set()
+        for future in self._pending:
+            if not future.done():
+                future.set_exception(DeviceDisconnectedError())
+        self._pending.clear()
+
+    def _on_notify(self, value_handle, data):
+        char = self._characteristics.get(value_handle)
+        if char is not None:
+            char._on_notify(data)
+
+    async def _request(self, handler, timeout_ms, *args):
+        """
+        handler(respond, *args)を相手側で実行し、respondで返された値を待つ
+        値が例外なら送出する 切断されたらDeviceDisconnectedError
+        """
+        if not self.is_connected():
+            raise DeviceDisconnectedError()
+        link = self._link
+        peer = link.peer(self._device)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.add(future)
+
+        def resolve(result):
+            if future.done():
+                return
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+        def respond(result):
+            if link.connected:
+                link.send(peer, resolve, result)
+
+        link.send(self._device, handler, respond, *args)
+        try:
+            return await asyncio.wait_for(future, timeout_ms / 1000)
+        finally:
+            self._pending.discard(future)
+
+    async def disconnect(self, timeout_ms=2000):
+        if not self.is_connected():
+            return
+        link = self._link
+        link.send(self._device, link.close)
+        await self.disconnected(timeout_ms)
+
+    async def disconnected(self, timeout_ms=60000, disconnect=False):
+        if disconnect:
+            await self.disconnect()
+        if timeout_ms is None:
+            await self._disconnected.wait()
+        else:
+            await asyncio.wait_for(self._disconnected.wait(), timeout_ms / 1000)
+
+    async def exchange_mtu(self, mtu=None, timeout_ms=1000):
+        requested = mtu or self._device.preferred_mtu
+        peer = self._link.peer(self._device)
+
+        def handle(respond):
+            respond(min(requested, peer.preferred_mtu))
+
+        agreed = await self._request(handle, timeout_ms)
+        self._link.mtu = agreed
+        for end in self._link.ends.values():
+            end.mtu = agreed
+        return agreed
+
+    async def service(self, uuid, timeout_ms=2000):
+        get_bus().stats["discovery_round_trips"] += 1
+        peer = self._link.peer(self._device)
+
+        def handle(respond):
+            for service in peer.services:
+                if service.uuid == uuid:
+                    respond((service._start_handle, service._end_handle))
+                    return
+            respond(None)
+
+        found = await self._request(handle, timeout_ms)
+        if found is None:
+            return None
+        return ClientService(self, found[0], found[1], uuid)
+
+
+class ClientService:
+    def __init__(self, connection, start_handle, end_handle, uuid):
+        self.connection = connection
+        self._start_handle = start_handle
+        self._end_handle = end_handle
+        self.uuid = uuid
+
+    async def characteristic(self, uuid, timeout_ms=2000):
+        get_bus().stats["discovery_round_trips"] += 1
+        connection = self.connection
+        peer = connection._link.peer(connection._device)
+        start, end = self._start_handle, self._end_handle
+
+        def handle(respond):
+            for value_handle, char in peer.handles.items():
+                if start <= value_handle <= end and char.uuid == uuid:
+                    respond((char._end_handle, value_handle, char.properties))
+                    return
+            respond(None)
+
+        found = await connection._request(handle, timeout_ms)
+        if found is None:
+            return None
+        return ClientCharacteristic(self, found[0], found[1], found[2], uuid)
+
+
+class ClientCharacteristic:
+    def __init__(self, service, end_handle, value_handle, properties, uuid):
+        self.service = service
+        self.connection = service.connection
+        self._end_handle = end_handle
+        self._value_handle = value_handle
+        self.properties = properties
+        self.uuid = uuid
+        # 最新の通知だけを取っておく (aiobleと同じ)
+        self._notify_queue = deque((), 1)
+        self._notify_event = asyncio.Event()
+        self.connection._characteristics[value_handle] = self
+
+    def _check(self, flag):
+        if not self.properties & flag:
+            raise ValueError("Unsupported")
+
+    def _peer_char(self, respond, status_if_missing):
+        connection = self.connection
+        peer = connection._link.peer(connection._device)
+        char = peer.handles.get(self._value_handle)
+        if char is None:
+            respond(GattError(status_if_missing))
+        return char
+
+    async def read(self, timeout_ms=1000):
+        self._check(FLAG_READ)
+
+        def handle(respond):
+            char = self._peer_char(respond, _ATT_ERROR_INVALID_HANDLE)
+            if char is None:
+                return
+            if not char.properties & FLAG_READ:
+                respond(GattError(_ATT_ERROR_READ_NOT_PERMITTED))
+                return
+            respond(self.connection._link.clip(char.read()))
+
+        return await self.connection._request(handle, timeout_ms)
+
+    def _deliver_write(self, respond, data):
+        connection = self.connection
+        peer = connection._link.peer(connection._device)
+        char = peer.handles.get(self._value_handle)
+        if char is None:
+            status = _ATT_ERROR_INVALID_HANDLE
+        elif not char.properties & (FLAG_WRITE | FLAG_WRITE_NO_RESPONSE):
+            status = _ATT_ERROR_WRITE_NOT_PERMITTED
+        else:
+            char._remote_write(connection._peer_end(), data)
+            get_bus().observe("write", peer, char.uuid, data)
+            status = 0
+        if respond is not None:
+            respond(GattError(status) if status else None)
+
+    async def write(self, data, response=None, timeout_ms=1000):
+        self._check(FLAG_WRITE | FLAG_WRITE_NO_RESPONSE)
+        if response is None:
+            # write requestしか使えない時だけ応答を待つ
+            response = not self.properties & FLAG_WRITE_NO_RESPONSE
+        if not self.connection.is_connected():
+            raise DeviceDisconnectedError()
+        link = self.connection._link
+
+        if not response:
+            # write command: 送信バッファに積んだら戻る 届いたかどうかは分からない
+            link.send(
+                self.connection._device,
+                self._deliver_write,
+                None,
+                link.clip(data),
+                unacked=True,
+            )
+            return
+        if len(data) > link.payload_size():
+            raise GattError(_ATT_ERROR_INVALID_LENGTH)
+        await self.connection._request(self._deliver_write, timeout_ms, bytes(data))
+
+    def _on_notify(self, data):
+        self._notify_queue.append(data)
+        self._notify_event.set()
+        connection = self.connection
+        get_bus().observe("notify", connection._link.peer(connection._device), self.uuid, data)
+
+    async def notified(self, timeout_ms=None):
+        if not self._notify_queue:
+            connection = self.connection
+            if not connection.is_connected():
+                raise DeviceDisconnectedError()
+            self._notify_event.clear()
+            waiter = asyncio.ensure_future(self._notify_event.wait())
+            connection._pending.add(waiter)
+            try:
+                timeout = None if timeout_ms is None else timeout_ms / 1000
+                await asyncio.wait_for(waiter, timeout)
+            finally:
+                connection._pending.discard(waiter)
+        return self._notify_queue.popleft()
+
+
+class ScanResult:
+    def __init__(self, device, adv_data, resp_data):
+        self.device = Device(device.addr_type, device.addr)
+        self.adv_data = adv_data
+        self.resp_data = resp_data
+        self.rssi = -50
+        self.connectable = True
+
+    def _decode_field(self, *adv_types):
+        for payload in (self.adv_data, self.resp_data):
+            i = 0
+            while i + 1 < len(payload):
+                length = payload[i]
+                if payload[i + 1] in adv_types:
+                    yield payload[i + 2 : i + 1 + length]
+                i += 1 + length
+
+    def name(self):
+        for value in self._decode_field(_ADV_TYPE_NAME):
+            return str(value, "utf-8")
+        return None
+
+    def services(self):
+        for value in self._decode_field(
+            _ADV_TYPE_UUID16_COMPLETE, _ADV_TYPE_UUID32_COMPLETE, _ADV_TYPE_UUID128_COMPLETE
+        ):
+            yield UUID(value)
+
+
+class scan:
+    """async with aioble.scan(...) as scanner: async for result in scanner"""
+
+    def __init__(self, duration_ms, interval_us=None, window_us=None, active=False):
+        self._duration_ms = duration_ms
+        self._active = active
+        self._queue = None
+        self._task = None
+
+    def _start(self):
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(
+            get_bus().scan(
+                current_device(), self._queue, self._duration_ms, self._active, ScanResult
+            )
+        )
+
+    async def __aenter__(self):
+        self._start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.cancel()
+
+    def cancel(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def __aiter__(self):
+        self._start()
+        return self
+
+    async def __anext__(self):
+        result = await self._queue.get()
+        if result is None:
+            raise StopAsyncIteration
+        return result
+
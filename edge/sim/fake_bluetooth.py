@@ -0,0 +1,49 @@
+"""MicroPythonのbluetoothモジュールの代わり (UUIDとフラグだけ)"""
+
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+FLAG_INDICATE = 0x0020
+
+
+class UUID:
+    """
+    16/32/128bitのUUID bytes()はMicroPythonと同じくリトルエンディアン
+    文字列・整数・bytesのどれからでも作れる
+    """
+
+    def __init__(self, value):
+        if isinstance(value, UUID):
+            raw = value._bytes
+        elif isinstance(value, int):
+            raw = value.to_bytes(2 if value <= 0xFFFF else 4, "little")
+        elif isinstance(value, str):
+            text = value.replace("-", "")
+            if text.lower().startswith("0x"):
+                number = int(text, 16)
+                raw = number.to_bytes(2 if number <= 0xFFFF else 4, "little")
+            elif len(text) == 32:
+                raw = bytes.fromhex(text)[::-1]
+            else:
+                raise ValueError(f"invalid UUID: {value}")
+        else:
+            raw = bytes(value)
+        if len(raw) not in (2, 4, 16):
+            raise ValueError(f"invalid UUID length: {len(raw)}")
+        self._bytes = raw
+
+    def __bytes__(self):
+        return self._bytes
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and self._bytes == other._bytes
+
+    def __hash__(self):
+        return hash(self._bytes)
+
+    def __repr__(self):
+        if len(self._bytes) != 16:
+            return f"UUID(0x{int.from_bytes(self._bytes, 'little'):04x})"
+        text = self._bytes[::-1].hex()
+        return f"UUID('{text[:8]}-{text[8:12]}-{text[12:16]}-{text[16:20]}-{text[20:]}')"
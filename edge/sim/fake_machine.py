@@ -0,0 +1,174 @@
+"""
+machineモジュールの代わり ピン・ADC・PWM・タイマー・mem32をデバイスごとに持つ
+シナリオ側からは VirtualDevice.pin(番号).drive(値) でピンを動かし、割り込みを起こせる
+"""
+
+import asyncio
+
+from sim.bus import current_device, now
+
+
+class PinState:
+    """1本のピンの状態 同じ番号のPinオブジェクトはこれを共有する"""
+
+    def __init__(self, device, pin_id):
+        self.device = device
+        self.pin_id = pin_id
+        self.level = 0
+        self.handler = None
+        self.trigger = 0
+        self.pin = None
+        self.history = []  # 出力ピンに書かれた (時刻, 値)
+
+    def drive(self, level):
+        """外から電圧を与える トリガーに合うエッジなら割り込みハンドラを呼ぶ"""
+        level = 1 if level else 0
+        previous = self.level
+        self.level = level
+        if self.handler is None or previous == level:
+            return
+        edge = Pin.IRQ_RISING if level else Pin.IRQ_FALLING
+        if self.trigger & edge:
+            self.device.call(self.handler, self.pin)
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 4
+    IRQ_RISING = 8
+
+    def __init__(self, pin_id, mode=-1, pull=-1, value=None):
+        self._state = current_device().pin(pin_id)
+        self.mode = mode
+        if value is not None:
+            self.value(value)
+
+    def value(self, value=None):
+        if value is None:
+            return self._state.level
+        self._state.level = 1 if value else 0
+        if self.mode == Pin.OUT:
+            self._state.history.append((now(), self._state.level))
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def toggle(self):
+        self.value(1 - self._state.level)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._state.handler = handler
+        self._state.trigger = trigger
+        self._state.pin = self
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+
+class ADC:
+    """read_u16()はVirtualDevice.adc_sourceが返す12bitの値を16bitに広げて返す"""
+
+    def __init__(self, channel):
+        if isinstance(channel, Pin):
+            channel = channel._state.pin_id - 26
+        self.channel = channel
+        self._device = current_device()
+
+    def read_u16(self):
+        raw = self._device.adc(self.channel, now()) & 0xFFF
+        return (raw << 4) | (raw >> 8)
+
+
+class PWM:
+    def __init__(self, pin, freq=None, duty_u16=None):
+        self._device = current_device()
+        self._pin = pin._state.pin_id
+        self._freq = 0
+        self._duty = 0
+        if freq is not None:
+            self.freq(freq)
+        if duty_u16 is not None:
+            self.duty_u16(duty_u16)
+
+    def freq(self, value=None):
+        if value is None:
+            return self._freq
+        self._freq = value
+
+    def duty_u16(self, value=None):
+        if value is None:
+            return self._duty
+        self._duty = value
+        self._device.pwm_log.append((now(), self._pin, value))
+
+    def deinit(self):
+        self._duty = 0
+
+
+class Timer:
+    """イベントループのcall_atで周期を刻む 割り込みの代わりにループの中でcallbackを呼ぶ"""
+
+    ONE_SHOT = 0
+    PERIODIC = 1
+
+    def __init__(self, timer_id=-1, **kwargs):
+        self._device = current_device()
+        self._handle = None
+        if kwargs:
+            self.init(**kwargs)
+
+    def init(self, mode=PERIODIC, freq=None, period=None, callback=None, hard=True):
+        self.deinit()
+        # rp2と同じくhard割り込みが既定 CPythonではメモリ確保を止められないので、
+        # hardなcallbackがメモリを確保しないことはここでは確かめられない
+        self.hard = hard
+        self._interval = 1 / freq if freq else period / 1000
+        self._mode = mode
+        self._callback = callback
+        loop = asyncio.get_running_loop()
+        self._next = loop.time() + self._interval
+        self._context = self._device.context()
+        self._handle = loop.call_at(self._next, self._fire, context=self._context)
+
+    def _fire(self):
+        self._handle = None
+        if self._mode == Timer.PERIODIC:
+            # 遅れても周期がずれていかないよう、予定時刻から次を決める
+            self._next += self._interval
+            loop = asyncio.get_running_loop()
+            self._handle = loop.call_at(self._next, self._fire, context=self._context)
+        if self._callback is not None:
+            self._callback(self)
+
+    def deinit(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+
+class _Memory32:
+    """mem32[アドレス] デバイスごとのレジスタの辞書を読み書きする (書いたことのないアドレスは0)"""
+
+    def __getitem__(self, address):
+        return current_device().registers.get(address, 0)
+
+    def __setitem__(self, address, value):
+        current_device().registers[address] = value & 0xFFFFFFFF
+
+
+mem32 = _Memory32()
+
+
+def freq(hz=None):
+    return 125000000
+
+
+def unique_id():
+    return bytes(current_device().addr)
@@ -0,0 +1,96 @@
+"""
+network / usocket の代わりと、uasyncio.open_connection
+WiFiはVirtualBLEBus.wifi_networksにあるSSIDとパスワードの時だけwifi_connect_ms後につながる
+HTTPSの接続先はVirtualBLEBus.http_routesでホスト名ごとに手元のサーバーへ振り向ける
+(TLSは張らない) 振り向け先がないホストやWiFiにつながっていない時はOSError
+"""
+
+import asyncio
+import errno
+import socket
+
+from sim.bus import current_device, get_bus
+
+STA_IF = 0
+AP_IF = 1
+
+STAT_IDLE = 0
+STAT_CONNECTING = 1
+STAT_WRONG_PASSWORD = -3
+STAT_NO_AP_FOUND = -2
+STAT_GOT_IP = 3
+
+
+class WLAN:
+    def __init__(self, interface=STA_IF):
+        self._device = current_device()
+        self._active = False
+        self._status = STAT_IDLE
+        self._handle = None
+
+    def active(self, value=None):
+        if value is None:
+            return self._active
+        self._active = bool(value)
+        if not value:
+            self.disconnect()
+
+    def connect(self, ssid=None, key=None, **kwargs):
+        if isinstance(ssid, (bytes, bytearray)):
+            ssid = str(ssid, "utf-8")
+        self.disconnect()
+        networks = get_bus().wifi_networks
+        if ssid not in networks:
+            self._status = STAT_NO_AP_FOUND
+            return
+        if networks[ssid] != key:
+            self._status = STAT_WRONG_PASSWORD
+            return
+        self._status = STAT_CONNECTING
+        self._handle = asyncio.get_running_loop().call_later(
+            get_bus().wifi_connect_ms / 1000, self._on_connected
+        )
+
+    def _on_connected(self):
+        self._handle = None
+        self._status = STAT_GOT_IP
+        self._device.wifi_connected = True
+
+    def disconnect(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._status = STAT_IDLE
+        self._device.wifi_connected = False
+
+    def isconnected(self):
+        return self._device.wifi_connected
+
+    def status(self, param=None):
+        if self._device.wifi_connected:
+            return STAT_GOT_IP
+        return self._status
+
+    def ifconfig(self):
+        return ("192.168.0.10", "255.255.255.0", "192.168.0.1", "192.168.0.1")
+
+
+###### usocket ######
+
+# 振り向け先のないホストを解決した時のアドレス (TEST-NET-3)
+_UNROUTED_ADDRESS = "203.0.113.1"
+
+
+def getaddrinfo(host, port, af=0, type=0, proto=0, flags=0):
+    route = get_bus().http_routes.get(host)
+    address = route[0] if route is not None else _UNROUTED_ADDRESS
+    return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port))]
+
+
+async def open_connection(host, port, ssl=None, server_hostname=None):
+    if not current_device().wifi_connected:
+        raise OSError(errno.ENETUNREACH, "wifi is not connected")
+    route = get_bus().http_routes.get(server_hostname or host)
+    if route is None:
+        raise OSError(errno.EHOSTUNREACH, f"no route to {server_hostname or host}")
+    return await asyncio.open_connection(route[0], route[1])
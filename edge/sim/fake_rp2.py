@@ -0,0 +1,296 @@
+"""
+rp2モジュールの代わり
+  StateMachine: stepper_pio.half_step_programのコマンドワードを時間どおりに消化する
+  DMA         : ADCのFIFOからの取り込み(adc_dma.ADCBurstCapture)を、変換の周期どおりに埋める
+"""
+
+import asyncio
+from collections import deque
+
+from sim.bus import current_device
+from stepper_command import STEP_OVERHEAD_CYCLES, decode_move
+
+# adc_dma.pyと同じレジスタ
+_ADC_BASE = 0x4004C000
+_ADC_CS = _ADC_BASE + 0x00
+_ADC_FIFO = _ADC_BASE + 0x0C
+_ADC_DIV = _ADC_BASE + 0x10
+_ADC_CLOCK_HZ = 48000000
+_ADC_CONVERSION_CYCLES = 96
+_CS_AINSEL_SHIFT = 12
+
+# 区間を終えた直後のx (jmp(x_dec)で0からさらに1減る)
+_X_AFTER_SEGMENT = 0xFFFFFFFF
+_FIFO_DEPTH = 4
+
+
+class PIO:
+    OUT_LOW = 0
+    OUT_HIGH = 1
+    IN_LOW = 0
+    IN_HIGH = 1
+    SHIFT_LEFT = 0
+    SHIFT_RIGHT = 1
+    JOIN_NONE = 0
+    JOIN_TX = 1
+    JOIN_RX = 2
+
+
+def asm_pio(**kwargs):
+    # プログラムはStateMachineが振る舞いで再現するので、関数をそのまま返す
+    # FIFOの結合だけはStateMachineが段数を決めるのに使うので残しておく
+    def decorator(program):
+        program.fifo_join = kwargs.get("fifo_join", PIO.JOIN_NONE)
+        return program
+
+    return decorator
+
+
+def bootsel_button():
+    return current_device().bootsel
+
+
+class StateMachine:
+    """
+    half_step_programの振る舞い: TX FIFOからコマンドを1つずつ取り出し、
+    ハーフステップ数 x (待ちループ + STEP_OVERHEAD_CYCLES) サイクルかけて回してからirqを上げる
+    途中で止めた時のxは経過時間から求める
+    FIFOの段数はプログラムのfifo_joinに従う (JOIN_TXならRX FIFOはなく、pushは捨てられる)
+    実機ではput()/get()がFIFOの空きやデータを待ってブロックするが、
+    シミュレーションではイベントループごと止まってしまうのでRuntimeErrorにする
+    """
+
+    def __init__(self, sm_id, program=None, freq=125000000, **kwargs):
+        device = current_device()
+        old = device.state_machines.get(sm_id)
+        if old is not None:
+            # 初期化し直すと前の状態は消える
+            old.active(0)
+        device.state_machines[sm_id] = self
+        self._device = device
+        self.freq = freq
+        fifo_join = getattr(program, "fifo_join", PIO.JOIN_NONE)
+        self._tx_depth = {PIO.JOIN_TX: 2 * _FIFO_DEPTH, PIO.JOIN_RX: 0}.get(fifo_join, _FIFO_DEPTH)
+        self._rx_depth = {PIO.JOIN_RX: 2 * _FIFO_DEPTH, PIO.JOIN_TX: 0}.get(fifo_join, _FIFO_DEPTH)
+        self._tx = deque()
+        self._rx = deque()
+        self._handler = None
+        self._running = False
+        self._timer = None
+        # 実行中の区間 (開始時刻, ハーフステップ数, 1ハーフステップの秒数)
+        self._segment = None
+        self.osr = 0
+        self.isr = 0
+        self.x = 0
+        # 回したハーフステップの合計 (向きは区別しない)
+        self.steps = 0
+
+    def put(self, value, shift=0):
+        if isinstance(value, int):
+            value = (value,)
+        for word in value:
+            if len(self._tx) >= self._tx_depth:
+                raise RuntimeError("TX FIFO is full (put() would block forever)")
+            self._tx.append(word >> shift)
+        if self._running and self._segment is None:
+            self._start_next()
+
+    def get(self, buf=None, shift=0):
+        if not self._rx:
+            raise RuntimeError("RX FIFO is empty (get() would block forever)")
+        return self._rx.popleft() >> shift
+
+    def tx_fifo(self):
+        return len(self._tx)
+
+    def rx_fifo(self):
+        return len(self._rx)
+
+    def exec(self, instruction):
+        instruction = instruction.replace(" ", "")
+        if instruction == "pull()":
+            if self._tx:
+                self.osr = self._tx.popleft()
+        elif instruction == "mov(isr,osr)":
+            self.isr = self.osr
+        elif instruction == "mov(isr,x)":
+            self.isr = self.x
+        elif instruction == "push(noblock)":
+            if len(self._rx) < self._rx_depth:
+                self._rx.append(self.isr)
+            self.isr = 0
+        else:
+            raise NotImplementedError(f"unsupported instruction: {instruction}")
+
+    def irq(self, handler=None, trigger=0, hard=False):
+        self._handler = handler
+
+    def active(self, value=None):
+        if value is None:
+            return 1 if self._running else 0
+        if value and not self._running:
+            self._running = True
+            if self._segment is None:
+                self._start_next()
+            else:
+                # 止めていた区間の残りから続ける
+                _, _, step_s = self._segment
+                self._schedule(self.x, step_s)
+        elif not value and self._running:
+            self._running = False
+            if self._segment is not None:
+                self._sync_x()
+                self._timer.cancel()
+                self._timer = None
+
+    def _loop(self):
+        return asyncio.get_running_loop()
+
+    def _schedule(self, steps, step_s):
+        loop = self._loop()
+        self._segment = (loop.time(), steps, step_s)
+        self._timer = loop.call_later(
+            steps * step_s, self._finish_segment, context=self._device.context()
+        )
+
+    def _start_next(self):
+        if not self._tx:
+            return
+        self.osr = self._tx.popleft()
+        steps, _, delay = decode_move(self.osr)
+        self.x = steps
+        self._schedule(steps, (delay + STEP_OVERHEAD_CYCLES) / self.freq)
+
+    def _sync_x(self):
+        started, steps, step_s = self._segment
+        done = min(steps, int((self._loop().time() - started) / step_s))
+        self.steps += done
+        self.x = steps - done
+        self._segment = (started, self.x, step_s)
+
+    def _finish_segment(self):
+        _, steps, _ = self._segment
+        self.steps += steps
+        self._segment = None
+        self._timer = None
+        self.x = _X_AFTER_SEGMENT
+        # ステートマシンはすぐ次のコマンドを取りに行き、割り込みのハンドラはその後で動く
+        if self._running:
+            self._start_next()
+        if self._handler is not None:
+            self._handler(self)
+
+
+class DMA:
+    """
+    ADCのFIFOを読むDMAチャネル (read=ADC_FIFO, treq_sel=DREQ_ADC の設定だけに対応)
+    ADC_DIVから決まる変換の周期でcount個のサンプルを書き込み、終わったらchain_toを起こす
+    irqのハンドラはrp2と同じく、ctrlでirq_quiet=Falseにしたチャネルでしか呼ばれない
+    値はVirtualDevice.adc_sourceから取る
+    """
+
+    def __init__(self):
+        device = current_device()
+        self._device = device
+        self.channel = len(device.dmas)
+        device.dmas.append(self)
+        self.read = None
+        self.write = None
+        self._count = 0
+        self._ctrl = {}
+        self._handler = None
+        self._timer = None
+        self._started = None
+
+    def pack_ctrl(self, default=None, **kwargs):
+        # rp2.DMA.pack_ctrlの既定値 (完了割り込みは上げない)
+        ctrl = {"irq_quiet": True}
+        ctrl.update(default or {})
+        ctrl.update(kwargs)
+        return ctrl
+
+    def config(self, read=None, write=None, count=None, ctrl=None, trigger=False):
+        if read is not None:
+            self.read = read
+        if write is not None:
+            self.write = write
+        if count is not None:
+            self._count = count
+        if ctrl is not None:
+            self._ctrl = ctrl
+        if trigger:
+            self.active(1)
+
+    @property
+    def count(self):
+        if self._started is None:
+            return self._count
+        return self._count - self._elapsed_samples()
+
+    @count.setter
+    def count(self, value):
+        self._count = value
+
+    def irq(self, handler=None, hard=False):
+        self._handler = handler
+
+    def _rate_hz(self):
+        div = (self._device.registers.get(_ADC_DIV, 0) >> 8) & 0xFFFF
+        return _ADC_CLOCK_HZ / max(_ADC_CONVERSION_CYCLES, div + 1)
+
+    def _elapsed_samples(self):
+        elapsed = asyncio.get_running_loop().time() - self._started
+        return min(self._count, int(elapsed * self._rate_hz()))
+
+    def active(self, value=None):
+        if value is None:
+            return 1 if self._started is not None else 0
+        if value and self._started is None:
+            if self.read != _ADC_FIFO:
+                raise NotImplementedError("sim DMA only supports reading the ADC FIFO")
+            loop = asyncio.get_running_loop()
+            self._started = loop.time()
+            self._timer = loop.call_later(
+                self._count / self._rate_hz(), self._complete, context=self._device.context()
+            )
+        elif not value and self._started is not None:
+            written = self._elapsed_samples()
+            self._fill(written)
+            self._count -= written
+            self._timer.cancel()
+            self._timer = None
+            self._started = None
+
+    def _fill(self, n):
+        channel = (self._device.registers.get(_ADC_CS, 0) >> _CS_AINSEL_SHIFT) & 0x7
+        rate = self._rate_hz()
+        source = self._device.adc_source
+        buffer = self.write
+        started = self._started
+        if source is None:
+            for i in range(n):
+                buffer[i] = 0
+            return
+        if hasattr(source, "fill"):
+            # まとめて埋められる信号源 (signals.PaperRollSignalなど)
+            source.fill(channel, buffer, n, started, rate)
+            return
+        for i in range(n):
+            buffer[i] = source(channel, started + i / rate) & 0xFFF
+
+    def _complete(self):
+        self._fill(self._count)
+        self._count = 0
+        self._timer = None
+        self._started = None
+        chain_to = self._ctrl.get("chain_to", self.channel)
+        if chain_to != self.channel:
+            self._device.dmas[chain_to].active(1)
+        if self._handler is not None and not self._ctrl.get("irq_quiet", True):
+            self._handler(self)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._started = None
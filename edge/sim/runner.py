@@ -0,0 +1,171 @@
+"""
+ハブと周辺デバイス4台(蓋開閉機・ペーパー観測機・自動水洗・消臭)を1つのイベントループで動かす
+それぞれ実機と同じスクリプト(edge/*.py, edge/hub/BT-hub.py)のクラスを、自分のVirtualDeviceとして動かす
+"""
+
+import asyncio
+import builtins
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+
+from sim.bus import VirtualBLEBus, current_device, track_tasks
+from sim.signals import PaperRollSignal
+
+# (役割, edge/からのパス, クラス名) 周辺デバイスを先に動かし、広告させてからハブを起動する
+PERIPHERALS = (
+    ("lid-controller", "BT-lid-controller.py", "BenTechLidController"),
+    ("paper-observer", "BT-paper-observer.py", "PaperObserver"),
+    ("auto-flusher", "BT-auto-flusher.py", "AutoFlusher"),
+    ("deodorant", "BT_deodorant.py", "Deodorant"),
+)
+HUB = ("hub", os.path.join("hub", "BT-hub.py"), "Hub")
+
+# stop()でタスクを止める時の、キャンセルの回数と1回ごとの待ち時間
+STOP_ATTEMPTS = 3
+STOP_WAIT_S = 1
+
+# 起動時にハブが読むsubscription.json (Web Pushの購読 鍵はダミー)
+DEFAULT_SUBSCRIPTION = {
+    "endpoint": "https://push.example.invalid/sim",
+    "expirationTime": None,
+    "keys": {
+        "p256dh": "BA" + "A" * 85,
+        "auth": "A" * 22,
+    },
+}
+
+
+def load_script(path):
+    """ハイフンを含む名前のスクリプトをモジュールとして読み込む (__main__としては動かさない)"""
+    from sim import EDGE_DIR
+
+    name = "sim_" + os.path.splitext(os.path.basename(path))[0].replace("-", "_")
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.spec_from_file_location(name, os.path.join(EDGE_DIR, path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class Simulator:
+    """
+    async with Simulator() as sim: でハブと周辺デバイスを起動し、抜けると止める
+    ファイル(subscription.json, gatt_cache.jsonなど)はworkdirに置かれる 同じworkdirを渡せば
+    前回の実行で覚えたアドレスやハンドルのキャッシュを使って起動する
+    logがTrueならデバイスのprintに[役割]を付けて出し、Falseなら捨てる
+    """
+
+    def __init__(self, bus=None, workdir=None, subscription=DEFAULT_SUBSCRIPTION, log=True):
+        from sim import install
+
+        self.bus = bus or VirtualBLEBus()
+        install(self.bus)
+        self.workdir = workdir or tempfile.mkdtemp(prefix="bentech-sim-")
+        self.subscription = subscription
+        self.log = log
+        self.devices = {}  # 役割 -> VirtualDevice
+        self.servers = {}  # 役割 -> Hubや周辺デバイスのサーバーのインスタンス
+        self.paper_signal = PaperRollSignal()
+        self._cwd = None
+        self._print = None
+
+    @property
+    def hub(self):
+        return self.servers["hub"]
+
+    def _device_print(self, *args, **kwargs):
+        device = current_device()
+        if device is self.bus.host:
+            self._print(*args, **kwargs)
+        elif self.log:
+            self._print(f"[{device.name}]", *args, **kwargs)
+
+    async def start(self, roles=None):
+        """rolesで動かすデバイスを絞れる (例えば周辺デバイスが1台いない状況)"""
+        self._cwd = os.getcwd()
+        os.chdir(self.workdir)
+        if not os.path.exists("subscription.json"):
+            with open("subscription.json", "w") as file:
+                json.dump(self.subscription, file)
+        self._print = builtins.print
+        builtins.print = self._device_print
+        track_tasks(asyncio.get_running_loop())
+
+        for role, path, class_name in PERIPHERALS + (HUB,):
+            if roles is not None and role not in roles:
+                continue
+            module = load_script(path)
+            device = self.bus.add_device(role)
+            if role == "paper-observer":
+                device.adc_source = self.paper_signal
+            # コンストラクタの中で作るPinやステートマシンもそのデバイスのものになる
+            server = device.call(getattr(module, class_name))
+            self.devices[role] = device
+            self.servers[role] = server
+            device.create_task(server.run())
+
+    async def stop(self):
+        for device in self.devices.values():
+            device.power_off()
+        # PaperObserver.runのように1度目のキャンセルを受け止めて続けるループがあるので、
+        # 終わるまで何度かキャンセルする
+        for _ in range(STOP_ATTEMPTS):
+            pending = [task for device in self.devices.values() for task in device.tasks]
+            if not pending:
+                break
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending, timeout=STOP_WAIT_S)
+        asyncio.get_running_loop().set_task_factory(None)
+        if self._print is not None:
+            builtins.print = self._print
+            self._print = None
+        if self._cwd is not None:
+            os.chdir(self._cwd)
+            self._cwd = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def connected_devices(self):
+        return self.hub._get_connected_devices_list()
+
+    async def wait_connected(self, count=len(PERIPHERALS), timeout_s=30):
+        """ハブがcount台の周辺デバイスと繋がるまで待つ"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_s
+        while len(self.connected_devices()) < count:
+            if loop.time() >= deadline:
+                raise asyncio.TimeoutError(f"connected: {self.connected_devices()}")
+            await asyncio.sleep(0.1)
+
+    async def connect_wifi(self, ssid="bentech-sim", password="password", timeout_s=10):
+        """ハブをWiFiにつなぐ (Web Appから設定された時と同じく、つながったらWIFI_UPを流す)"""
+        from event_bus import WIFI_UP
+
+        self.bus.wifi_networks[ssid] = password
+        self.hub.wlan.active(True)
+        self.hub.wlan.connect(ssid.encode("utf-8"), password)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_s
+        while not self.hub.wlan.isconnected():
+            if loop.time() >= deadline:
+                raise asyncio.TimeoutError(f"wifi status: {self.hub.wlan.status()}")
+            await asyncio.sleep(0.1)
+        self.hub.event_bus.publish(WIFI_UP)
+
+    def motion(self, level):
+        """ハブの人感センサーのピンを動かす (1: 検知中)"""
+        from motion_sensor import MOTION_SENSOR_PIN
+
+        self.devices["hub"].pin(MOTION_SENSOR_PIN).drive(level)
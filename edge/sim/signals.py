@@ -0,0 +1,88 @@
+"""シミュレーションでセンサーに入れる波形"""
+
+import math
+import random
+from array import array
+
+from sim.bus import now
+
+# 12bitのADCの中点と、静かな時のノイズの幅
+MIDPOINT = 2048
+NOISE = 3
+# ロールが回っている間の揺れ (edge/bench/paper_replay.pyのsynthesizeと同じ形)
+SWING = 370
+SWING_HZ = 10
+ROLL_S = 0.3
+# 1ロールを数えた後、次を数えられるようになるまでの間隔 (MIN_ROLL_INTERVAL_MSより長く)
+ROLL_GAP_S = 1.5
+# ノイズは毎回乱数を引かず、作っておいた表を順に使う (仮想時計で長時間流すと乱数が一番重い)
+# fill()は表から切り出してコピーするので、1回で埋める数はこれより小さくなければならない
+NOISE_TABLE_SIZE = 4099
+
+
+class PaperRollSignal:
+    """
+    ペーパー観測機のADCに入れる波形 VirtualDevice.adc_sourceに渡す
+    普段は中点付近の小さなノイズで、roll()するとロールが回る揺れを間を空けて入れる
+    """
+
+    def __init__(self, seed=0):
+        rng = random.Random(seed)
+        quiet = [MIDPOINT + rng.randint(-NOISE, NOISE) for _ in range(NOISE_TABLE_SIZE)]
+        # 2周分並べておき、どこから切り出しても折り返さないようにする
+        self._quiet = array("H", quiet + quiet)
+        self._noise_index = 0
+        self._starts = []
+        # まだ終わっていない最初のロール (ロールは重ならないので、これより前は見なくてよい)
+        self._current = 0
+        self.rolled = 0
+
+    def roll(self, count=1):
+        """今からcount回ロールを回す 前のロールが終わっていなければその後に続ける"""
+        start = max([now()] + [s + ROLL_S + ROLL_GAP_S for s in self._starts[-1:]])
+        for _ in range(count):
+            self._starts.append(start)
+            start += ROLL_S + ROLL_GAP_S
+        self.rolled += count
+
+    def busy_until(self):
+        """入れたロールが全て終わる時刻"""
+        if not self._starts:
+            return now()
+        return self._starts[-1] + ROLL_S
+
+    def _skip_finished(self, t):
+        starts = self._starts
+        while self._current < len(starts) and starts[self._current] + ROLL_S <= t:
+            self._current += 1
+
+    @staticmethod
+    def _swing(t, start):
+        return int(SWING * math.sin(2 * math.pi * SWING_HZ * (t - start)))
+
+    def __call__(self, channel, t):
+        value = self._quiet[self._noise_index]
+        self._noise_index = (self._noise_index + 1) % NOISE_TABLE_SIZE
+        self._skip_finished(t)
+        if self._current < len(self._starts) and self._starts[self._current] <= t:
+            value += self._swing(t, self._starts[self._current])
+        return value
+
+    def fill(self, channel, buffer, n, t0, rate):
+        """
+        t0からrate Hzで取ったn個の値をbuffer(array('H'))に入れる
+        DMAの偽物が1ブロックまとめて呼ぶ 1つずつ__call__するのと同じ値になる
+        """
+        index = self._noise_index
+        buffer[0:n] = self._quiet[index : index + n]
+        self._noise_index = (index + n) % NOISE_TABLE_SIZE
+
+        self._skip_finished(t0)
+        end = t0 + n / rate
+        for start in self._starts[self._current :]:
+            if start >= end:
+                break
+            first = max(0, math.ceil((start - t0) * rate))
+            last = min(n, math.ceil((start + ROLL_S - t0) * rate))
+            for i in range(first, last):
+                buffer[i] += self._swing(t0 + i / rate, start)
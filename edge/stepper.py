@@ -0,0 +1,152 @@
+import asyncio
+from machine import Pin, Timer
+from micropython import const
+
+# モーターのピン定義 (IN1〜IN4)
+MOTOR_PINS = (16, 17, 18, 19)
+
+# ハーフステップの励磁パターン (IN1, IN2, IN3, IN4)
+SEQUENCE = (
+    (1, 0, 0, 0),
+    (1, 1, 0, 0),
+    (0, 1, 0, 0),
+    (0, 1, 1, 0),
+    (0, 0, 1, 0),
+    (0, 0, 1, 1),
+    (0, 0, 0, 1),
+    (1, 0, 0, 1),
+)
+# ピンごとに並べ直した励磁パターン PIN_LEVELS[ピン][位相]
+# hard割り込みの中ではzipやタプルを作れないので、添字だけで引けるようにしておく
+PIN_LEVELS = tuple(bytearray(step[i] for step in SEQUENCE) for i in range(4))
+
+# 28BYJ-48の1回転あたりのハーフステップ数 (512サイクル x 8ハーフステップ)
+HALF_STEPS_PER_ROTATION = const(4096)
+
+# ステップを刻むタイマーの周波数
+TICK_HZ = const(4000)
+# 速度(ハーフステップ/秒)と加速度(ハーフステップ/秒^2)
+DEFAULT_START_RATE = const(600)
+DEFAULT_MAX_RATE = const(1400)
+DEFAULT_ACCEL = const(2000)
+
+
+class StepperMotor:
+    """
+    ステッピングモーターの非同期ドライバ
+    ハードウェアタイマーの割り込みでステップを刻むので、回転中もイベントループは止まらない
+    台形の加減速で回し、stop()で途中から減速して止められる
+    positionは時計回りを正としたハーフステップ単位の現在位置
+    """
+
+    def __init__(
+        self,
+        pins=MOTOR_PINS,
+        start_rate=DEFAULT_START_RATE,
+        max_rate=DEFAULT_MAX_RATE,
+        accel=DEFAULT_ACCEL,
+    ):
+        self.pins = [Pin(pin, Pin.OUT) for pin in pins]
+        self.start_rate = start_rate
+        self.max_rate = max_rate
+        self.accel = accel
+
+        self.position = 0
+        self._phase = 0
+        self._direction = 1
+        self._remaining = 0
+        self._rate = 0
+        # 位相・速度の端数をためるアキュムレータ (DDA)
+        self._step_acc = 0
+        self._rate_acc = 0
+
+        self._timer = Timer()
+        self._done = asyncio.ThreadSafeFlag()
+        self._moving = False
+
+    def is_moving(self):
+        return self._moving
+
+    def _decel_steps(self):
+        # 現在の速度からstart_rateまで減速するのに必要なステップ数
+        rate = self._rate
+        start = self.start_rate
+        if rate <= start:
+            return 0
+        return (rate * rate - start * start) // (2 * self.accel)
+
+    def _step(self):
+        # hard割り込みから呼ばれるのでメモリ確保をしてはいけない
+        phase = (self._phase + self._direction) % 8
+        self._phase = phase
+        pins = self.pins
+        for i in range(4):
+            pins[i].value(PIN_LEVELS[i][phase])
+        self.position += self._direction
+        self._remaining -= 1
+
+    def _tick(self, timer):
+        # hard割り込みから呼ばれるのでメモリ確保をしてはいけない
+        if self._remaining <= 0:
+            return
+
+        self._step_acc += self._rate
+        if self._step_acc >= TICK_HZ:
+            self._step_acc -= TICK_HZ
+            self._step()
+            if self._remaining <= 0:
+                self._timer.deinit()
+                self._done.set()
+                return
+
+        # 残りで止まりきれなくなったら減速、そうでなければ最高速まで加速
+        self._rate_acc += self.accel
+        delta = self._rate_acc // TICK_HZ
+        if delta:
+            self._rate_acc -= delta * TICK_HZ
+            if self._remaining <= self._decel_steps():
+                self._rate = max(self.start_rate, self._rate - delta)
+            elif self._rate < self.max_rate:
+                self._rate = min(self.max_rate, self._rate + delta)
+
+    async def move(self, steps, clockwise=True):
+        """
+        stepsハーフステップ回す 止められた場合も含め、実際に回ったステップ数を返す
+        """
+        if steps <= 0:
+            return 0
+
+        start_position = self.position
+        self._direction = 1 if clockwise else -1
+        self._remaining = steps
+        self._rate = self.start_rate
+        self._step_acc = TICK_HZ  # 最初のtickで1ステップ目を出す
+        self._rate_acc = 0
+        self._moving = True
+
+        self._timer.init(
+            freq=TICK_HZ, mode=Timer.PERIODIC, callback=self._tick, hard=True
+        )
+        try:
+            await self._done.wait()
+        finally:
+            self._timer.deinit()
+            self._remaining = 0
+            self._moving = False
+            self.cleanup()
+
+        return abs(self.position - start_position)
+
+    async def rotate(self, turns, clockwise=True):
+        """turns回転させる"""
+        return await self.move(int(HALF_STEPS_PER_ROTATION * turns), clockwise)
+
+    def stop(self):
+        """回転中なら減速して止める moveは止まりきってから戻る"""
+        if self._moving:
+            self._remaining = min(self._remaining, max(1, self._decel_steps()))
+
+    def cleanup(self):
+        # 停止中はコイルに電流を流さない
+        for pin in self.pins:
+            pin.value(0)
@@ -0,0 +1,177 @@
+# PIOステッピングモータードライバ(stepper_pio.py)へ送るコマンドの形式と、
+# PC上で同じコマンドを解釈するエミュレータ
+# machine / rp2 に依存しないのでCPythonでも読み込める
+
+# ステートマシンのクロック 1サイクル = 1us
+PIO_FREQ = 1000000
+# 1ハーフステップあたりの待ちループ以外のサイクル数
+STEP_OVERHEAD_CYCLES = 6
+
+# コマンドワード (右シフトで下位ビットから取り出す)
+#   bit 0-15 : ハーフステップ数
+#   bit 16   : 向き (1 = 時計回り)
+#   bit 17-31: 1ハーフステップごとの待ちループ回数
+COUNT_BITS = 16
+DELAY_BITS = 15
+MAX_COUNT = 0xFFFF
+MAX_DELAY = 0x7FFF
+
+# 加減速をそれぞれ何段に分けるか
+RAMP_SEGMENTS = 3
+# 1回の移動の区間数の上限 (MAX_COUNTごとに分けた区間も含む)
+MAX_SEGMENTS = 8
+# TX FIFOの段数 止めた時にxをRX FIFOから読み出すので、FIFOは結合しない
+# 入りきらない区間は区間が終わるたびに積み足す
+FIFO_DEPTH = 4
+
+# ハーフステップの励磁パターン IN1をbit0とした4bit
+HALF_STEP_NIBBLES = (0b0001, 0b0011, 0b0010, 0b0110, 0b0100, 0b1100, 0b1000, 0b1001)
+
+
+def pattern_for_phase(phase):
+    """
+    ISRに入れておくパターン 下位4bitが現在の励磁
+    ISRを4bit右に回すと次の位相(時計回り)、28bit右に回すと前の位相になる
+    """
+    pattern = 0
+    for i in range(8):
+        pattern |= HALF_STEP_NIBBLES[(phase + i) % 8] << (4 * i)
+    return pattern
+
+
+def delay_for_rate(rate):
+    """ハーフステップ/秒 を待ちループ回数に変換する"""
+    delay = PIO_FREQ // rate - STEP_OVERHEAD_CYCLES
+    return max(0, min(MAX_DELAY, delay))
+
+
+def encode_move(steps, clockwise, rate):
+    if not 0 <= steps <= MAX_COUNT:
+        raise ValueError(f"steps out of range: {steps}")
+    return (
+        (delay_for_rate(rate) << (COUNT_BITS + 1))
+        | ((1 if clockwise else 0) << COUNT_BITS)
+        | steps
+    )
+
+
+def decode_move(word):
+    """コマンドワードを (steps, clockwise, delay) に戻す"""
+    steps = word & MAX_COUNT
+    clockwise = bool((word >> COUNT_BITS) & 1)
+    delay = (word >> (COUNT_BITS + 1)) & MAX_DELAY
+    return steps, clockwise, delay
+
+
+def _isqrt(n):
+    x = n
+    y = (x + 1) // 2
+    while y < x:
+        x = y
+        y = (x + n // x) // 2
+    return x
+
+
+def plan_segments(steps, start_rate, max_rate, accel):
+    """
+    台形の加減速を一定速度の区間の並びで近似する
+    戻り値は [(ハーフステップ数, 速度)] で、合計はstepsになる
+    """
+    if steps <= 0:
+        return []
+
+    ramp_steps = (max_rate * max_rate - start_rate * start_rate) // (2 * accel)
+    peak_rate = max_rate
+    if 2 * ramp_steps > steps:
+        # 最高速まで届かない短い移動
+        ramp_steps = steps // 2
+        peak_rate = _isqrt(start_rate * start_rate + 2 * accel * ramp_steps)
+
+    per_segment = ramp_steps // RAMP_SEGMENTS
+    if per_segment == 0 or peak_rate <= start_rate:
+        segments = [(steps, start_rate)]
+    else:
+        # 各段はその段の中間の速度で回す
+        rates = [
+            start_rate + (peak_rate - start_rate) * (2 * i + 1) // (2 * RAMP_SEGMENTS)
+            for i in range(RAMP_SEGMENTS)
+        ]
+        cruise = steps - 2 * per_segment * RAMP_SEGMENTS
+        segments = (
+            [(per_segment, rate) for rate in rates]
+            + [(cruise, peak_rate)]
+            + [(per_segment, rate) for rate in reversed(rates)]
+        )
+
+    # 1コマンドで送れない長い区間は分割する
+    result = []
+    for count, rate in segments:
+        while count > 0:
+            chunk = min(count, MAX_COUNT)
+            result.append((chunk, rate))
+            count -= chunk
+    if len(result) > MAX_SEGMENTS:
+        raise ValueError(f"move too long: {steps}")
+    return result
+
+
+def plan_deceleration(rate, start_rate, accel):
+    """
+    rateで回っているところからstart_rateまで減速して止める区間の並び
+    plan_segmentsの減速部分と同じ段の分け方で、戻り値も同じ形
+    """
+    if rate <= start_rate:
+        return []
+    per_segment = (rate * rate - start_rate * start_rate) // (2 * accel) // RAMP_SEGMENTS
+    if per_segment == 0:
+        return []
+    return [
+        (per_segment, start_rate + (rate - start_rate) * (2 * i + 1) // (2 * RAMP_SEGMENTS))
+        for i in reversed(range(RAMP_SEGMENTS))
+    ]
+
+
+class PIOStepperEmulator:
+    """
+    stepper_pio.half_step_programと同じようにコマンドワードを解釈する
+    ピン出力の並びとサイクル数を記録するので、PC上でステップ数や向きを確かめられる
+    """
+
+    def __init__(self, phase=0):
+        self.isr = pattern_for_phase(phase)
+        self.x = 0
+        self.outputs = []
+        self.cycles = 0
+        self.irq_count = 0
+
+    def _rotate(self, clockwise):
+        if clockwise:
+            # in_(isr, 4): 右シフトして下位4bitを上から入れる
+            self.isr = (self.isr >> 4) | ((self.isr & 0xF) << 28)
+        else:
+            # in_(isr, 28)
+            self.isr = (self.isr >> 28) | ((self.isr & 0x0FFFFFFF) << 4)
+
+    def put(self, word, max_steps=None):
+        """
+        1コマンドを実行する max_stepsを渡すとその手前で止めた状態を再現する
+        戻り値は実際に出したハーフステップ数
+        """
+        steps, clockwise, delay = decode_move(word)
+        self.x = steps
+        done = 0
+        while self.x != 0:
+            if max_steps is not None and done >= max_steps:
+                return done
+            self.x -= 1
+            self._rotate(clockwise)
+            self.outputs.append(self.isr & 0xF)
+            self.cycles += delay + STEP_OVERHEAD_CYCLES
+            done += 1
+        # 終了: コイルを切ってIRQを上げる
+        self.outputs.append(0)
+        self.irq_count += 1
+        return done
+
+    def phase(self):
+        return HALF_STEP_NIBBLES.index(self.isr & 0xF)
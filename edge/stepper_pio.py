@@ -0,0 +1,217 @@
+import asyncio
+import rp2
+from machine import Pin
+from stepper import MOTOR_PINS, HALF_STEPS_PER_ROTATION
+from stepper import DEFAULT_START_RATE, DEFAULT_MAX_RATE, DEFAULT_ACCEL
+from stepper_command import (
+    PIO_FREQ,
+    MAX_COUNT,
+    FIFO_DEPTH,
+    encode_move,
+    pattern_for_phase,
+    plan_deceleration,
+    plan_segments,
+)
+
+
+@rp2.asm_pio(
+    out_init=(rp2.PIO.OUT_LOW,) * 4,
+    in_shiftdir=rp2.PIO.SHIFT_RIGHT,
+    out_shiftdir=rp2.PIO.SHIFT_RIGHT,
+    # stop()で残りステップ数をRX FIFO経由で読むので結合しない (JOIN_TXだとpushが捨てられる)
+    fifo_join=rp2.PIO.JOIN_NONE,
+)
+def half_step_program():
+    # ISRには8位相分の励磁パターンが入っていて、回すことで位相を進める
+    # コマンドの形式は stepper_command.encode_move を参照
+    wrap_target()
+    pull(block)
+    out(x, 16)  # x = ハーフステップ数
+    out(y, 1)  # y = 向き
+    jmp(not_y, "ccw")  # osrには待ちループ回数が残る
+
+    label("cw")
+    jmp(x_dec, "cw_step")
+    jmp("done")
+    label("cw_step")
+    in_(isr, 4)  # 次の位相へ
+    mov(pins, isr)
+    mov(y, osr)
+    label("cw_wait")
+    jmp(y_dec, "cw_wait")
+    jmp("cw")
+
+    label("ccw")
+    jmp(x_dec, "ccw_step")
+    jmp("done")
+    label("ccw_step")
+    in_(isr, 28)  # 前の位相へ
+    mov(pins, isr)
+    mov(y, osr)
+    label("ccw_wait")
+    jmp(y_dec, "ccw_wait")
+    jmp("ccw")
+
+    label("done")
+    mov(pins, null)  # コイルを切る
+    irq(rel(0))
+    wrap()
+
+
+class PIOStepperMotor:
+    """
+    ステッピングモーターのPIOドライバ
+    励磁パターンの切り替えはステートマシンが行い、CPUは区間ごとにコマンドを1つ積むだけ
+    加減速は一定速度の区間の並びで近似する (stepper_command.plan_segments)
+    TX FIFOに入りきらない区間は、区間が終わるたびの割り込みで積み足す
+    IN1〜IN4は連続したピンである必要がある
+    StepperMotorと同じインターフェースを持つ
+    """
+
+    def __init__(
+        self,
+        pins=MOTOR_PINS,
+        sm_id=0,
+        start_rate=DEFAULT_START_RATE,
+        max_rate=DEFAULT_MAX_RATE,
+        accel=DEFAULT_ACCEL,
+    ):
+        self.base_pin = Pin(pins[0], Pin.OUT)
+        self.sm_id = sm_id
+        self.start_rate = start_rate
+        self.max_rate = max_rate
+        self.accel = accel
+
+        self.position = 0
+        self._start_position = 0
+        self._direction = 1
+        self._segments = []
+        self._rates = []
+        self._words = []
+        self._queued = 0
+        self._completed = 0
+        self._done = asyncio.ThreadSafeFlag()
+        self._moving = False
+        self._stopping = False
+        # ステートマシンを初期化し直した回数 前のステートマシンの遅れた割り込みを無視するのに使う
+        self._generation = 0
+
+        self._init_state_machine()
+
+    def _init_state_machine(self):
+        # 初期化でFIFOも空になる 現在位置に合わせた位相をISRに入れ直す
+        self._sm = rp2.StateMachine(
+            self.sm_id, half_step_program, freq=PIO_FREQ, out_base=self.base_pin
+        )
+        self._generation += 1
+        generation = self._generation
+        self._sm.irq(lambda sm: self._on_segment_done(generation))
+        self._sm.put(pattern_for_phase(self.position % 8))
+        self._sm.exec("pull()")
+        self._sm.exec("mov(isr, osr)")
+        self._sm.active(1)
+
+    def _start(self, plan, clockwise):
+        # 今の位置からplanの区間を順に回し始める
+        self._start_position = self.position
+        self._direction = 1 if clockwise else -1
+        self._segments = [count for count, _ in plan]
+        self._rates = [rate for _, rate in plan]
+        self._words = [encode_move(count, clockwise, rate) for count, rate in plan]
+        self._queued = 0
+        self._completed = 0
+        # 空きの分だけ積むので、ここでブロックすることはない
+        self._fill_fifo()
+
+    def _fill_fifo(self):
+        # TX FIFOに空きがある分だけ次の区間のコマンドを積む
+        words = self._words
+        while self._queued < len(words) and self._sm.tx_fifo() < FIFO_DEPTH:
+            self._sm.put(words[self._queued])
+            self._queued += 1
+
+    def _on_segment_done(self, generation):
+        if not self._moving or generation != self._generation:
+            return
+        self._fill_fifo()
+        self._completed += 1
+        self.position = self._start_position + self._direction * sum(
+            self._segments[: self._completed]
+        )
+        if self._completed >= len(self._segments):
+            self._done.set()
+
+    def is_moving(self):
+        return self._moving
+
+    async def move(self, steps, clockwise=True):
+        """
+        stepsハーフステップ回す 止められた場合も含め、実際に回ったステップ数を返す
+        """
+        if steps <= 0:
+            return 0
+
+        start_position = self.position
+        plan = plan_segments(steps, self.start_rate, self.max_rate, self.accel)
+        self._moving = True
+        self._stopping = False
+        self._start(plan, clockwise)
+
+        try:
+            await self._done.wait()
+        finally:
+            self._moving = False
+            self._stopping = False
+
+        return abs(self.position - start_position)
+
+    async def rotate(self, turns, clockwise=True):
+        """turns回転させる"""
+        return await self.move(int(HALF_STEPS_PER_ROTATION * turns), clockwise)
+
+    def stop(self):
+        """
+        回転中なら減速して止める moveは止まりきってから戻る
+        いきなり止めると脱調して位置がずれるので、今の速度からstart_rateまで落としてから止める
+        """
+        if not self._moving or self._stopping:
+            return
+
+        self._sm.active(0)
+        # IRQの処理が遅れていても数え間違えないよう、FIFOに残っている数から
+        # 実行中の区間を割り出し、その残りステップ数(x)をRX FIFO経由で読み出す
+        current = self._queued - self._sm.tx_fifo() - 1
+        self._sm.exec("mov(isr, x)")
+        self._sm.exec("push(noblock)")
+        remaining = self._sm.get()
+        segments = self._segments
+        rates = self._rates
+        moved = sum(segments[:current])
+        rest = list(zip(segments[current + 1 :], rates[current + 1 :]))
+        rate = self.start_rate
+        if current >= 0:
+            count = segments[current]
+            rate = rates[current]
+            # 区間を終えた直後はxが0からさらに1減って0xFFFFFFFFになっている
+            if remaining <= MAX_COUNT:
+                moved += count - remaining
+                rest.insert(0, (remaining, rate))
+            else:
+                moved += count
+        self.position = self._start_position + self._direction * moved
+
+        # 残りの区間の方が短ければ、元の計画どおりにそのまま減速して止まる
+        plan = plan_deceleration(rate, self.start_rate, self.accel)
+        if sum(count for count, _ in rest) <= sum(count for count, _ in plan):
+            plan = rest
+        plan = [(count, rate) for count, rate in plan if count]
+
+        self._stopping = True
+        self._init_state_machine()
+        self._start(plan, self._direction > 0)
+        if not plan:
+            self._done.set()
+
+    def cleanup(self):
+        # 区間の終わりでステートマシンがコイルを切るので何もしない
+        pass
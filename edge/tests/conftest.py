@@ -0,0 +1,23 @@
+"""
+edge/ のコードをホストのCPythonでテストする
+sim.install()で偽物のmicropython / machine / aioble などを入れてからimportする
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sim  # noqa: E402
+
+sim.install()
+
+
+@pytest.fixture
+def bus():
+    """テストごとに新しい仮想BLEバス (ピンやレジスタもここに持つ)"""
+    bus = sim.VirtualBLEBus()
+    sim.install(bus=bus)
+    return bus
@@ -0,0 +1,35 @@
+import asyncio
+
+import aioble
+import bluetooth
+
+import sim
+from sim.bus import current_device
+
+SERVICE_ID = bluetooth.UUID("6408f4f4-5002-4787-8c6f-c44147b06802")
+
+
+def _fields(payload):
+    fields = {}
+    i = 0
+    while i < len(payload):
+        length = payload[i]
+        fields[payload[i + 1]] = bytes(payload[i + 2 : i + 1 + length])
+        i += 1 + length
+    return fields
+
+
+def test_services_go_in_the_adv_payload_and_the_name_spills(bus):
+    async def scenario():
+        task = asyncio.create_task(
+            aioble.advertise(250000, name="BT-auto-flusher", services=[SERVICE_ID])
+        )
+        await asyncio.sleep(0)
+        adv_data, resp_data, _ = current_device().advertising
+        task.cancel()
+        return adv_data, resp_data
+
+    adv_data, resp_data = sim.run(scenario())
+    # aiobleと同じ並び 128bitのUUIDを入れると名前は広告データに収まらない
+    assert _fields(adv_data)[0x07] == bytes(SERVICE_ID)
+    assert _fields(resp_data) == {0x09: b"BT-auto-flusher"}
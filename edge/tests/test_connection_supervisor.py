@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+import sim
+from common_hub import (
+    RECONNECT_IDLE_MS,
+    RECONNECT_SCAN_MISSES,
+    BenTechDeviceManager,
+    ConnectionSupervisor,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_registry(monkeypatch):
+    monkeypatch.setattr(BenTechDeviceManager, "device_registry", None)
+
+
+def test_absent_device_is_searched_rarely(bus, monkeypatch):
+    scans = []
+    scan = BenTechDeviceManager.scan
+
+    async def counting_scan(managers, duration_ms, active=False):
+        scans.append(asyncio.get_running_loop().time())
+        await scan(managers, duration_ms, active)
+
+    monkeypatch.setattr(BenTechDeviceManager, "scan", staticmethod(counting_scan))
+    # 置かれていないデバイス
+    manager = BenTechDeviceManager("BT-deodorant", "0698d1ab-9144-496a-9878-9f6027e17ef9")
+    supervisor = ConnectionSupervisor([manager])
+
+    async def scenario():
+        supervisor.start()
+        await asyncio.sleep(3600)
+        supervisor.stop()
+
+    sim.run(scenario())
+    # 最初に何回か探した後は、RECONNECT_IDLE_MSごとにしか探さない
+    idle_scans = 3600 * 1000 // RECONNECT_IDLE_MS
+    assert len(scans) <= RECONNECT_SCAN_MISSES + idle_scans
+    gaps = [b - a for a, b in zip(scans[RECONNECT_SCAN_MISSES - 1 :], scans[RECONNECT_SCAN_MISSES:])]
+    assert all(gap >= RECONNECT_IDLE_MS / 1000 for gap in gaps)
+
+
+def test_concurrent_connects_open_one_connection(tmp_path):
+    async def scenario():
+        async with sim.Simulator(workdir=str(tmp_path), log=False) as simulator:
+            await simulator.wait_connected()
+            hub = simulator.hub
+            # 起動時の接続が終わってから始まる見張りを止め、自分で繋ぎ直す
+            while not hub.connection_supervisor._tasks:
+                await asyncio.sleep(0.1)
+            hub.connection_supervisor.stop()
+            manager = hub.auto_flusher_manager
+            await manager.connection.disconnect()
+            # 周辺デバイスが広告し直すまで待つ
+            await asyncio.sleep(5)
+            manager.forget_connection()
+            before = simulator.bus.stats["connections"]
+            # RE_SCANのconnect_allと再接続が同じデバイスに同時に繋ぎにいく
+            results = await asyncio.gather(manager.connect(), manager.connect())
+            return results, simulator.bus.stats["connections"] - before
+
+    results, opened = sim.run(scenario())
+    assert results == [True, True]
+    assert opened == 1
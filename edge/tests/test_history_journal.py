@@ -0,0 +1,124 @@
+import struct
+import time
+
+import pytest
+
+from history_journal import (
+    EVICT_COUNT,
+    JOURNAL_MAGIC,
+    MAX_RECORDS,
+    NO_ROLL_COUNT,
+    RECORD_SIZE,
+    V1_JOURNAL_MAGIC,
+    V1_RECORD_FORMAT,
+    HistoryJournal,
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """time.time()を手で進める"""
+    now = [1000]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "history_journal.bin")
+
+
+def test_append_and_peek_round_trip(path, clock):
+    journal = HistoryJournal(path)
+    journal.append(42.7, 3)
+    clock[0] += 5
+    journal.append(10, None)
+    clock[0] += 2
+
+    assert journal.peek(10) == [
+        {"stayingTime": 42, "usedRollCount": 3, "endedSecondsAgo": 7},
+        {"stayingTime": 10, "usedRollCount": None, "endedSecondsAgo": 2},
+    ]
+    assert journal.peek(1) == journal.peek(10)[:1]
+
+
+def test_values_are_clamped_to_the_record_format(path, clock):
+    journal = HistoryJournal(path)
+    journal.append(-5, NO_ROLL_COUNT + 10)
+    (entry,) = journal.peek(1)
+    assert entry["stayingTime"] == 0
+    # 不明を表す値とは区別される
+    assert entry["usedRollCount"] == NO_ROLL_COUNT - 1
+
+
+def test_drop_removes_oldest_first(path, clock):
+    journal = HistoryJournal(path)
+    for staying_time in range(5):
+        journal.append(staying_time, staying_time)
+    journal.drop(2)
+    assert journal.count == 3
+    assert [entry["stayingTime"] for entry in journal.peek(10)] == [2, 3, 4]
+    journal.drop(10)
+    assert journal.count == 0
+    assert journal.peek(10) == []
+
+
+def test_records_from_a_previous_boot_have_no_age(path, clock):
+    journal = HistoryJournal(path)
+    journal.append(1, 1)
+    journal.append(2, 2)
+
+    # 再起動するとRTCが戻るので、前の起動のレコードは何秒前か分からない
+    clock[0] = 10
+    rebooted = HistoryJournal(path)
+    rebooted.append(3, 3)
+    clock[0] += 4
+    assert [entry["endedSecondsAgo"] for entry in rebooted.peek(10)] == [None, None, 4]
+
+    rebooted.drop(1)
+    assert [entry["endedSecondsAgo"] for entry in rebooted.peek(10)] == [None, 4]
+
+
+def test_partial_record_is_truncated_on_load(path, clock):
+    journal = HistoryJournal(path)
+    journal.append(1, 1)
+    journal.append(2, 2)
+    with open(path, "ab") as file:
+        file.write(b"\x01\x02\x03")
+
+    reloaded = HistoryJournal(path)
+    assert reloaded.count == 2
+    with open(path, "rb") as file:
+        assert len(file.read()) == len(JOURNAL_MAGIC) + 2 * RECORD_SIZE
+
+
+def test_oldest_records_are_evicted_at_the_limit(path, clock):
+    journal = HistoryJournal(path)
+    for staying_time in range(MAX_RECORDS + 1):
+        journal.append(staying_time, 0)
+    assert journal.count == MAX_RECORDS - EVICT_COUNT + 1
+    assert journal.peek(1)[0]["stayingTime"] == EVICT_COUNT
+
+
+def test_v1_journal_is_migrated(path, clock):
+    with open(path, "wb") as file:
+        file.write(V1_JOURNAL_MAGIC)
+        file.write(struct.pack(V1_RECORD_FORMAT, 30, 2))
+        file.write(struct.pack(V1_RECORD_FORMAT, 40, NO_ROLL_COUNT))
+
+    journal = HistoryJournal(path)
+    assert journal.peek(10) == [
+        {"stayingTime": 30, "usedRollCount": 2, "endedSecondsAgo": None},
+        {"stayingTime": 40, "usedRollCount": None, "endedSecondsAgo": None},
+    ]
+    with open(path, "rb") as file:
+        assert file.read(len(JOURNAL_MAGIC)) == JOURNAL_MAGIC
+
+
+def test_unknown_format_is_recreated(path, clock):
+    with open(path, "wb") as file:
+        file.write(b"XXXX" + bytes(20))
+    journal = HistoryJournal(path)
+    assert journal.count == 0
+    journal.append(5, 1)
+    assert journal.peek(1)[0]["stayingTime"] == 5
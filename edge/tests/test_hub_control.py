@@ -0,0 +1,40 @@
+import pytest
+
+import sim
+from common import CAP_BINARY
+from stream_codec import TAG_SSID
+
+
+@pytest.mark.parametrize(
+    "capabilities, message",
+    [
+        (CAP_BINARY, bytes((TAG_SSID, 0x00, 0x10)) + b"home"),  # 長さが合わないTLV
+        (0, b'{"ssid": "home"'),  # 壊れたJSON
+        (0, b'{"ssid": "home"}'),  # passwordがない
+    ],
+)
+def test_malformed_wifi_data_is_answered_with_failure(tmp_path, capabilities, message):
+    async def scenario():
+        async with sim.Simulator(workdir=str(tmp_path), log=False) as simulator:
+            hub = simulator.hub
+            responses = []
+            hub._notify_response = responses.append
+            hub._deliver_stream_message(message)
+            await hub._handle_control(hub.COMMANDS["CONNECT_WIFI"] + bytes((capabilities,)))
+            return responses, hub.RESPONSES["WIFI_CONNECT_FAILED"]
+
+    responses, failed = sim.run(scenario())
+    assert responses == [failed]
+
+
+def test_malformed_subscription_keeps_the_current_one(tmp_path):
+    async def scenario():
+        async with sim.Simulator(workdir=str(tmp_path), log=False) as simulator:
+            hub = simulator.hub
+            before = hub.subscription
+            hub._deliver_stream_message(b"\x10\x00\x05http")
+            await hub._handle_control(hub.COMMANDS["SET_SUBSCRIPTION"] + bytes((CAP_BINARY,)))
+            return before, hub.subscription
+
+    before, after = sim.run(scenario())
+    assert after == before
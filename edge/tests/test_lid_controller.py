@@ -0,0 +1,38 @@
+import asyncio
+
+import sim
+from sim.runner import load_script
+from stepper import DEFAULT_ACCEL, DEFAULT_MAX_RATE, DEFAULT_START_RATE
+from stepper_command import plan_deceleration
+
+lid = load_script("BT-lid-controller.py")
+Controller = lid.BenTechLidController
+
+
+def test_close_while_opening_returns_to_closed(bus):
+    controller = Controller()
+    motor = controller.motor
+    responses = []
+    controller._notify_response = responses.append
+
+    async def scenario():
+        task = asyncio.create_task(controller._drive_lid())
+        await controller._handle_control(Controller.COMMANDS["LID_OPEN"])
+        await asyncio.sleep(4)
+        await controller._handle_control(Controller.COMMANDS["LID_CLOSE"])
+        # 開ける向きのまま減速してから閉じ始める
+        stopped_at = motor.position
+        turned_at = stopped_at
+        while motor.position != Controller.CLOSED_POSITION or motor.is_moving():
+            turned_at = min(turned_at, motor.position)
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.5)
+        task.cancel()
+        return stopped_at, turned_at
+
+    stopped_at, turned_at = sim.run(scenario())
+    assert Controller.OPEN_POSITION < stopped_at < Controller.CLOSED_POSITION
+    decel = plan_deceleration(DEFAULT_MAX_RATE, DEFAULT_START_RATE, DEFAULT_ACCEL)
+    assert turned_at == stopped_at - sum(count for count, _ in decel)
+    assert motor.position == Controller.CLOSED_POSITION
+    assert responses == [Controller.COMMANDS["COMPLETE"]]
@@ -0,0 +1,15 @@
+import log
+
+
+def test_debug_is_off_by_default(capsys):
+    assert log.level == log.INFO
+    log.debug("見えない {}", 1)
+    log.info("見える {}", 2)
+    assert capsys.readouterr().out == "見える 2\n"
+
+
+def test_debug_can_be_turned_on(capsys, monkeypatch):
+    monkeypatch.setattr(log, "level", log.INFO)
+    log.set_level(log.DEBUG)
+    log.debug("見える {}", 1)
+    assert capsys.readouterr().out == "見える 1\n"
@@ -0,0 +1,57 @@
+import asyncio
+
+import sim
+from motion_sensor import (
+    EVENT_ENTER,
+    EVENT_LEAVE,
+    MOTION_SENSOR_PIN,
+    IRQMotionDetector,
+    PIRMotionDetector,
+)
+
+
+def _run_session(bus, detector):
+    """入室して2秒後に退室し、受け取ったイベントとフラグの読み出し結果を返す"""
+    pin = bus.host.pin(MOTION_SENSOR_PIN)
+
+    async def scenario():
+        await detector.start_monitoring()
+        await asyncio.sleep(3)
+        pin.drive(1)
+        await asyncio.sleep(0.5)
+        entered = await detector.get_event()
+        started = (detector.is_detection_started(), detector.is_detection_started())
+        await asyncio.sleep(2)
+        pin.drive(0)
+        left = await detector.get_event()
+        ended = (detector.is_detection_ended(), detector.is_detection_ended())
+        await detector.stop_monitoring()
+        return entered, left, started, ended
+
+    return sim.run(scenario())
+
+
+def test_pir_detector_emits_enter_and_leave(bus):
+    detector = PIRMotionDetector(presence_timeout=1)
+    entered, left, started, ended = _run_session(bus, detector)
+    assert (entered, left) == (EVENT_ENTER, EVENT_LEAVE)
+    # 読み出すまで保持し、読んだら消える
+    assert started == (True, False)
+    assert ended == (True, False)
+
+
+def test_irq_detector_emits_enter_and_leave(bus):
+    detector = IRQMotionDetector(presence_timeout=1)
+    entered, left, started, ended = _run_session(bus, detector)
+    assert (entered, left) == (EVENT_ENTER, EVENT_LEAVE)
+    assert started == (True, False)
+    assert ended == (True, False)
+
+
+def test_event_queue_drops_oldest_when_full(bus):
+    detector = PIRMotionDetector()
+    for _ in range(20):
+        detector._push_event(EVENT_ENTER)
+    detector._push_event(EVENT_LEAVE)
+    assert len(detector._events) == 8
+    assert detector._events[-1] == EVENT_LEAVE
@@ -0,0 +1,109 @@
+import statistics
+from array import array
+
+import pytest
+
+from paper_detector import (
+    COEFF_12BIT,
+    RollingStats,
+    feed_block,
+    load_trace,
+    make_detector,
+    write_trace_header,
+)
+
+RATE_HZ = 100
+
+
+def quiet(n):
+    return [1.0] * n
+
+
+def burst(n):
+    # 分散0.04 しきい値を大きく超える揺れ
+    return [0.8 if i % 2 else 1.2 for i in range(n)]
+
+
+def feed_all(detector, voltages):
+    for voltage in voltages:
+        detector.feed(voltage)
+    return detector.roll
+
+
+def test_rolling_stats_follow_the_window():
+    values = [0.1 * (i % 7) + 0.01 * i for i in range(23)]
+    stats = RollingStats(5)
+    assert (stats.mean(), stats.variance(), len(stats)) == (0, 0, 0)
+    for i, value in enumerate(values):
+        stats.add(value)
+        window = values[max(0, i - 4) : i + 1]
+        assert len(stats) == len(window)
+        assert stats.mean() == pytest.approx(statistics.fmean(window), abs=1e-6)
+        assert stats.variance() == pytest.approx(statistics.pvariance(window), abs=1e-6)
+
+
+def test_quiet_signal_counts_nothing():
+    assert feed_all(make_detector(RATE_HZ), quiet(1000)) == 0
+
+
+def test_burst_counts_one_roll():
+    detector = make_detector(RATE_HZ)
+    assert feed_all(detector, quiet(150) + burst(20) + quiet(50)) == 1
+    assert not detector.current_flag
+
+
+def test_bursts_within_the_interval_count_once():
+    detector = make_detector(RATE_HZ)
+    assert feed_all(detector, quiet(150) + burst(20) + quiet(20) + burst(20)) == 1
+
+
+def test_separated_bursts_count_separately():
+    detector = make_detector(RATE_HZ)
+    assert feed_all(detector, (quiet(150) + burst(20)) * 2) == 2
+
+
+def test_burst_right_after_reset_is_not_counted():
+    # 起動直後の揺れで数えてしまわないよう、最初のintervalサンプルは数えない
+    detector = make_detector(RATE_HZ)
+    feed_all(detector, quiet(150) + burst(20))
+    detector.reset()
+    assert feed_all(detector, burst(20)) == 0
+
+
+def test_on_change_is_called_on_each_edge():
+    changes = []
+    detector = make_detector(RATE_HZ, on_change=lambda flag, *_: changes.append(flag))
+    feed_all(detector, quiet(150) + burst(20) + quiet(50))
+    assert changes == [True, False]
+
+
+def test_feed_block_averages_and_drops_the_remainder():
+    fed = []
+
+    class Recorder:
+        def feed(self, voltage):
+            fed.append(voltage)
+
+    block = array("H", [0, 4095, 4095, 4095, 1000, 1000, 7])
+    feed_block(Recorder(), block, 2, COEFF_12BIT)
+    assert fed == pytest.approx([1.65, 3.3, 1000 * COEFF_12BIT])
+
+    fed.clear()
+    feed_block(Recorder(), block, 2, COEFF_12BIT, length=3)
+    assert fed == pytest.approx([1.65])
+
+
+def test_trace_round_trip(tmp_path):
+    path = str(tmp_path / "paper.trace")
+    samples = array("H", [0, 1, 2048, 4095])
+    with open(path, "wb") as file:
+        write_trace_header(file, 4000)
+        file.write(samples.tobytes() + b"\x01")  # 途中で切れた最後のサンプルは捨てる
+    assert load_trace(path) == (4000, samples)
+
+
+def test_unknown_trace_raises(tmp_path):
+    path = tmp_path / "paper.trace"
+    path.write_bytes(b"XXXX" + bytes(8))
+    with pytest.raises(ValueError):
+        load_trace(str(path))
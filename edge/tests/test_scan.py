@@ -0,0 +1,46 @@
+import asyncio
+
+import aioble
+import bluetooth
+import pytest
+
+import sim
+from common_hub import BenTechDeviceManager
+
+SERVICE_ID = "6408f4f4-5002-4787-8c6f-c44147b06802"
+OTHER_SERVICE_ID = "0698d1ab-9144-496a-9878-9f6027e17ef9"
+
+
+@pytest.fixture(autouse=True)
+def no_registry(monkeypatch):
+    # 前のテストで覚えたアドレスで見つからないように
+    monkeypatch.setattr(BenTechDeviceManager, "device_registry", None)
+
+
+def _scan(bus, manager, active):
+    peripheral = bus.add_device("peripheral")
+
+    async def scenario():
+        advertising = peripheral.create_task(
+            aioble.advertise(
+                250000, name="BT-auto-flusher", services=[bluetooth.UUID(SERVICE_ID)]
+            )
+        )
+        await asyncio.sleep(0)
+        await BenTechDeviceManager.scan([manager], 3000, active=active)
+        advertising.cancel()
+
+    sim.run(scenario())
+    return manager.device
+
+
+def test_passive_scan_finds_the_service_uuid(bus):
+    # 広告データにUUIDが入っているので、スキャン要求を送らなくても見つかる
+    manager = BenTechDeviceManager("BT-auto-flusher", SERVICE_ID)
+    assert _scan(bus, manager, active=False) is not None
+
+
+@pytest.mark.parametrize("active", [False, True])
+def test_name_is_only_in_the_scan_response(bus, active):
+    manager = BenTechDeviceManager("BT-auto-flusher", OTHER_SERVICE_ID)
+    assert (_scan(bus, manager, active) is not None) == active
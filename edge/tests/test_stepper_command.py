@@ -0,0 +1,103 @@
+import pytest
+
+from stepper import DEFAULT_ACCEL, DEFAULT_MAX_RATE, DEFAULT_START_RATE, SEQUENCE
+from stepper_command import (
+    HALF_STEP_NIBBLES,
+    MAX_COUNT,
+    MAX_DELAY,
+    MAX_SEGMENTS,
+    RAMP_SEGMENTS,
+    PIOStepperEmulator,
+    decode_move,
+    delay_for_rate,
+    encode_move,
+    plan_segments,
+)
+
+RATES = (DEFAULT_START_RATE, DEFAULT_MAX_RATE, DEFAULT_ACCEL)
+
+
+@pytest.mark.parametrize("steps", [0, MAX_COUNT])
+@pytest.mark.parametrize("clockwise", [True, False])
+@pytest.mark.parametrize("rate", [DEFAULT_START_RATE, DEFAULT_MAX_RATE])
+def test_move_round_trip(steps, clockwise, rate):
+    assert decode_move(encode_move(steps, clockwise, rate)) == (
+        steps,
+        clockwise,
+        delay_for_rate(rate),
+    )
+
+
+@pytest.mark.parametrize("steps", [-1, MAX_COUNT + 1])
+def test_steps_out_of_range_raise(steps):
+    with pytest.raises(ValueError):
+        encode_move(steps, True, DEFAULT_START_RATE)
+
+
+def test_delay_is_clamped_to_the_field():
+    # 速すぎれば待ちなし、遅すぎれば15bitの上限
+    assert delay_for_rate(10**7) == 0
+    assert delay_for_rate(1) == MAX_DELAY
+
+
+def test_nibbles_match_the_timer_driver():
+    assert HALF_STEP_NIBBLES == tuple(
+        sum(level << i for i, level in enumerate(step)) for step in SEQUENCE
+    )
+
+
+@pytest.mark.parametrize("steps", [0, -3])
+def test_no_segments_for_no_steps(steps):
+    assert plan_segments(steps, *RATES) == []
+
+
+@pytest.mark.parametrize("steps", [1, 5, 100, 1000, 11059, 2 * MAX_COUNT])
+def test_segments_add_up_and_ramp_symmetrically(steps):
+    segments = plan_segments(steps, *RATES)
+    assert sum(count for count, _ in segments) == steps
+    assert len(segments) <= MAX_SEGMENTS
+    rates = [rate for _, rate in segments]
+    assert all(DEFAULT_START_RATE <= rate <= DEFAULT_MAX_RATE for rate in rates)
+    if len(segments) > 1:
+        ramp = segments[:RAMP_SEGMENTS]
+        assert segments[-RAMP_SEGMENTS:] == ramp[::-1]
+        assert rates[:RAMP_SEGMENTS] == sorted(rates[:RAMP_SEGMENTS])
+
+
+def test_short_move_runs_at_the_start_rate():
+    assert plan_segments(5, *RATES) == [(5, DEFAULT_START_RATE)]
+
+
+def test_short_move_does_not_reach_the_max_rate():
+    segments = plan_segments(100, *RATES)
+    assert max(rate for _, rate in segments) < DEFAULT_MAX_RATE
+
+
+def test_long_cruise_is_split_into_commands():
+    segments = plan_segments(2 * MAX_COUNT, *RATES)
+    assert all(count <= MAX_COUNT for count, _ in segments)
+    assert [rate for _, rate in segments].count(DEFAULT_MAX_RATE) == 2
+
+
+def test_move_with_too_many_segments_raises():
+    with pytest.raises(ValueError):
+        plan_segments(3 * MAX_COUNT, *RATES)
+
+
+@pytest.mark.parametrize("clockwise", [True, False])
+def test_emulator_runs_the_planned_move(clockwise):
+    steps = 1000
+    emulator = PIOStepperEmulator(phase=0)
+    for count, rate in plan_segments(steps, *RATES):
+        assert emulator.put(encode_move(count, clockwise, rate)) == count
+    # 区間ごとに最後はコイルを切る
+    stepped = [nibble for nibble in emulator.outputs if nibble]
+    assert len(stepped) == steps
+    assert emulator.phase() == (steps if clockwise else -steps) % 8
+
+
+def test_emulator_stops_midway():
+    emulator = PIOStepperEmulator(phase=2)
+    assert emulator.put(encode_move(10, True, DEFAULT_START_RATE), max_steps=3) == 3
+    assert emulator.phase() == 5
+    assert emulator.irq_count == 0
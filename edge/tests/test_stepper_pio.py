@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+import sim
+from sim import fake_rp2
+from stepper import DEFAULT_ACCEL, DEFAULT_MAX_RATE, DEFAULT_START_RATE
+from stepper_command import encode_move, plan_deceleration, plan_segments
+from stepper_pio import PIOStepperMotor
+
+
+def test_move_runs_every_planned_segment(bus):
+    motor = PIOStepperMotor()
+    sm = motor._sm
+
+    async def scenario():
+        return await motor.move(11059, clockwise=False)
+
+    # 区間はFIFOの段数より多いので、積み足さないと途中で止まる
+    assert sim.run(scenario()) == 11059
+    assert motor.position == -11059
+    assert sm.steps == 11059
+
+
+def test_stop_mid_move_decelerates_before_stopping(bus):
+    motor = PIOStepperMotor()
+    sm = motor._sm
+
+    async def scenario():
+        task = asyncio.create_task(motor.move(11059))
+        await asyncio.sleep(4)
+        motor.stop()
+        stopped_at = motor.position
+        decelerating = motor.is_moving()
+        moved = await asyncio.wait_for(task, 1)
+        return stopped_at, decelerating, moved
+
+    stopped_at, decelerating, moved = sim.run(scenario())
+    # 最高速から止めたので、start_rateまで落とす分だけ進んでから止まる
+    decel = plan_deceleration(DEFAULT_MAX_RATE, DEFAULT_START_RATE, DEFAULT_ACCEL)
+    assert decelerating
+    assert moved == motor.position == stopped_at + sum(count for count, _ in decel)
+    assert moved < 11059
+    assert sm.steps + motor._sm.steps == moved
+    assert not motor.is_moving()
+
+
+def test_stop_near_the_end_finishes_the_planned_ramp(bus):
+    motor = PIOStepperMotor()
+
+    async def scenario():
+        task = asyncio.create_task(motor.move(300))
+        await asyncio.sleep(0.4)
+        motor.stop()
+        return await asyncio.wait_for(task, 1)
+
+    # 元の計画の残りの方が短いので、目標より先へは回らない
+    assert sim.run(scenario()) == 300
+
+
+def test_stop_right_after_starting(bus):
+    motor = PIOStepperMotor()
+
+    async def scenario():
+        task = asyncio.create_task(motor.move(1000))
+        await asyncio.sleep(0)
+        motor.stop()
+        return await asyncio.wait_for(task, 1)
+
+    # 最初の区間の速度から落とす分だけ回る
+    (count, rate), *_ = plan_segments(1000, DEFAULT_START_RATE, DEFAULT_MAX_RATE, DEFAULT_ACCEL)
+    decel = plan_deceleration(rate, DEFAULT_START_RATE, DEFAULT_ACCEL)
+    assert sim.run(scenario()) == motor.position == sum(count for count, _ in decel)
+
+
+def test_joined_tx_fifo_has_no_rx(bus):
+    @fake_rp2.asm_pio(fifo_join=fake_rp2.PIO.JOIN_TX)
+    def program():
+        pass
+
+    sm = fake_rp2.StateMachine(1, program)
+    for _ in range(8):
+        sm.put(encode_move(1, True, 600))
+    with pytest.raises(RuntimeError):
+        sm.put(0)
+    # RX FIFOがないのでpushは捨てられ、実機のget()は永遠に待つ
+    sm.exec("push(noblock)")
+    with pytest.raises(RuntimeError):
+        sm.get()
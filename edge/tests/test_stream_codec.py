@@ -0,0 +1,124 @@
+import struct
+
+import pytest
+
+from stream_codec import (
+    DEVICE_CODES,
+    TAG_DEVICE,
+    TAG_PASSWORD,
+    TAG_SSID,
+    TAG_SUBSCRIPTION,
+    TAG_TRACE_ENTRIES,
+    TAG_TRACE_NOW,
+    TAG_WIFI_CONNECTED,
+    TLV_HEADER_FORMAT,
+    TRACE_ENTRY_FORMAT,
+    TRACE_ENTRY_SIZE,
+    decode_subscription,
+    decode_wifi_data,
+    encode_devices,
+    encode_info,
+    encode_subscription,
+    encode_trace,
+    iter_tlv,
+)
+from trace_ring import TraceRing
+
+SUBSCRIPTION = {
+    "endpoint": "https://push.example.invalid/abc",
+    "expirationTime": 1700000000000,
+    "keys": {"p256dh": "BA" + "A" * 85, "auth": "A" * 22},
+}
+
+
+def tlv(tag, value):
+    return struct.pack(TLV_HEADER_FORMAT, tag, len(value)) + value
+
+
+def items(data):
+    return [(tag, bytes(value)) for tag, value in iter_tlv(data)]
+
+
+@pytest.mark.parametrize("expiration_time", [SUBSCRIPTION["expirationTime"], None])
+def test_subscription_round_trip(expiration_time):
+    subscription = dict(SUBSCRIPTION, expirationTime=expiration_time)
+    assert decode_subscription(encode_subscription(subscription)) == subscription
+
+
+def test_info_nests_the_subscription():
+    devices = ["lid-controller", "deodorant"]
+    data = encode_info(True, SUBSCRIPTION, devices)
+    tags = items(data)
+    assert tags[0] == (TAG_WIFI_CONNECTED, b"\x01")
+    assert tags[1][0] == TAG_SUBSCRIPTION
+    assert decode_subscription(tags[1][1]) == SUBSCRIPTION
+    assert tags[2:] == [(TAG_DEVICE, bytes((DEVICE_CODES[name],))) for name in devices]
+
+
+def test_info_without_subscription():
+    assert items(encode_info(False, None, [])) == [(TAG_WIFI_CONNECTED, b"\x00")]
+
+
+def test_devices_can_be_appended_to_a_buffer():
+    buffer = bytearray(b"\x09")
+    assert encode_devices(["auto-flusher"], buffer) is buffer
+    assert bytes(buffer) == b"\x09" + tlv(TAG_DEVICE, b"\x03")
+
+
+def test_wifi_data_decodes_in_any_order():
+    data = tlv(TAG_PASSWORD, "パス".encode("utf-8")) + tlv(TAG_SSID, b"home")
+    assert decode_wifi_data(data) == ("home", "パス")
+
+
+def test_unknown_tags_are_skipped():
+    data = tlv(0x7F, b"zz") + tlv(TAG_SSID, b"home") + tlv(TAG_PASSWORD, b"pw")
+    assert decode_wifi_data(data) == ("home", "pw")
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        tlv(TAG_SSID, b"home"),  # パスワードがない
+        tlv(TAG_SSID, b"home") + tlv(TAG_PASSWORD, b"pw")[:-1],  # 値が途中で切れている
+        tlv(TAG_SSID, b"\xff\xfe") + tlv(TAG_PASSWORD, b"pw"),  # UTF-8ではない
+        b"",
+    ],
+)
+def test_malformed_wifi_data_raises_value_error(data):
+    with pytest.raises(ValueError):
+        decode_wifi_data(data)
+
+
+def test_truncated_header_is_ignored():
+    # ヘッダーの途中で終わっているものは値がないので読み飛ばす
+    assert items(tlv(TAG_SSID, b"a") + b"\x20") == [(TAG_SSID, b"a")]
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        encode_subscription(SUBSCRIPTION)[:-1],
+        tlv(0x10, b"https://x") + tlv(0x12, b"k"),  # authがない
+        tlv(0x10, b"https://x") + tlv(0x11, b"\x00\x01") + tlv(0x12, b"k") + tlv(0x13, b"a"),
+    ],
+)
+def test_malformed_subscription_raises_value_error(data):
+    with pytest.raises(ValueError):
+        decode_subscription(data)
+
+
+def test_trace_round_trip(bus):
+    ring = TraceRing(size=4)
+    for event in range(1, 7):
+        ring.record(event, -event)
+
+    data = items(encode_trace(ring))
+    assert [tag for tag, _ in data] == [TAG_TRACE_NOW, TAG_TRACE_ENTRIES]
+    entries = data[1][1]
+    assert len(entries) == 4 * TRACE_ENTRY_SIZE
+    # 溢れた分は古いものから上書きされ、古い順に並ぶ
+    decoded = [
+        struct.unpack_from(TRACE_ENTRY_FORMAT, entries, offset)[1:]
+        for offset in range(0, len(entries), TRACE_ENTRY_SIZE)
+    ]
+    assert decoded == [(3, -3), (4, -4), (5, -5), (6, -6)]
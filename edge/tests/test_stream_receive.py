@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+import sim
+from common import (
+    MAX_STREAM_MESSAGE_SIZE,
+    STREAM_PACKET_SIZE,
+    BenTechStreamableDeviceServer,
+    StreamMessageError,
+)
+
+
+class FakeStreamChar:
+    """written()でpacketsを順に返し、尽きたらタイムアウトする"""
+
+    def __init__(self, packets):
+        self.packets = list(packets)
+
+    async def written(self, timeout_ms=None):
+        if not self.packets:
+            await asyncio.sleep(timeout_ms / 1000)
+            raise asyncio.TimeoutError
+        return None, self.packets.pop(0)
+
+
+class FakeDevice:
+    _receive_stream_message = BenTechStreamableDeviceServer._receive_stream_message
+
+    def __init__(self, packets):
+        self.stream_char = FakeStreamChar(packets)
+
+
+def receive(length, packets):
+    return sim.run(FakeDevice(packets)._receive_stream_message(length))
+
+
+def test_message_is_joined_from_packets():
+    packets = [b"a" * STREAM_PACKET_SIZE, b"bc"]
+    assert receive(2, packets) == b"a" * STREAM_PACKET_SIZE + b"bc"
+
+
+@pytest.mark.parametrize(
+    "length, packets",
+    [
+        (0, []),
+        (MAX_STREAM_MESSAGE_SIZE // STREAM_PACKET_SIZE + 1, []),  # 大きすぎる
+        (2, [b"a"]),  # 時間内に揃わない
+        (1, [b"a" * (STREAM_PACKET_SIZE + 1)]),  # パケットが大きすぎる
+    ],
+)
+def test_unreceivable_message_raises(length, packets):
+    with pytest.raises(StreamMessageError):
+        receive(length, packets)
+
+
+def test_stream_message_error_is_a_value_error():
+    # _listen_controlはValueErrorで命令を諦めるので、同じ扱いになるようにしておく
+    assert issubclass(StreamMessageError, ValueError)
@@ -0,0 +1,84 @@
+"""
+ホットパスの時刻を残す固定長のリングバッファ
+1件は (ticks_us, イベント番号, 引数) で、あらかじめ確保した配列に書き込むだけなので
+記録する時にメモリを確保しない (割り込みハンドラからも呼べる)
+ハブはDUMP_TRACEでこの中身をWeb Appへバイナリで送る (hub/stream_codec.encode_trace)
+"""
+
+import time
+from array import array
+from micropython import const
+
+# 残しておく件数 溢れたら古いものから上書きする
+TRACE_SIZE = const(256)
+# ticks_usが折り返す周期 (rp2のMicroPythonは30bit) Web App側で差を取る時に使う
+TICKS_PERIOD = const(1 << 30)
+
+# イベント番号 (括弧内は引数)
+# Hub._control_devices
+TR_SESSION_START = const(1)  # 入室
+TR_SESSION_OPENED = const(2)  # 蓋を開け、ペーパーの観測を始めた
+TR_SESSION_END = const(3)  # 退室 (滞在時間(秒))
+TR_SESSION_CLOSED = const(4)  # 蓋を閉め、ペーパーの観測を止めた (ロール数 不明なら-1)
+TR_SESSION_DISPATCHED = const(5)  # 水洗と消臭の指示を積んだ
+TR_SESSION_SAVED = const(6)  # 履歴を保存した
+# BenTechDeviceManager (デバイス番号 stream_codec.DEVICE_CODES)
+TR_CONNECT_BEGIN = const(16)
+TR_CONNECT_END = const(17)
+TR_CONNECT_FAIL = const(18)
+TR_CONTROL_BEGIN = const(19)
+TR_CONTROL_END = const(20)
+TR_CONTROL_FAIL = const(21)
+TR_RESPONSE_BEGIN = const(22)  # control_with_responseで応答を待ち始めた
+TR_RESPONSE_END = const(23)  # 応答が届いた
+# usocket_firebase_test (HTTPのステータス 失敗は-1)
+TR_HTTP_BEGIN = const(32)
+TR_HTTP_END = const(33)
+# BenTechStreamableDeviceServer._listen_stream
+TR_STREAM_RX_BEGIN = const(48)  # (パケット数)
+TR_STREAM_RX_END = const(49)  # (受け取ったバイト数 受け取れなければ-1)
+TR_STREAM_ACK = const(50)  # (ackされた連番)
+
+
+class TraceRing:
+    def __init__(self, size=TRACE_SIZE):
+        self.size = size
+        self._ticks = array("I", [0] * size)
+        self._events = bytearray(size)
+        self._args = array("i", [0] * size)
+        self._head = 0  # 次に書き込む位置
+        self._count = 0
+        self.enabled = True
+
+    def record(self, event, arg=0):
+        if not self.enabled:
+            return
+        head = self._head
+        self._ticks[head] = time.ticks_us()
+        self._events[head] = event
+        self._args[head] = arg
+        head += 1
+        if head == self.size:
+            head = 0
+        self._head = head
+        if self._count < self.size:
+            self._count += 1
+
+    def clear(self):
+        self._head = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def entries(self):
+        """古い順に (ticks_us, イベント番号, 引数) を返す"""
+        start = self._head - self._count
+        for i in range(self._count):
+            index = (start + i) % self.size
+            yield self._ticks[index], self._events[index], self._args[index]
+
+
+# デバイス全体で1つ
+TRACE = TraceRing()
+trace = TRACE.record
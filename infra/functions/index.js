@@ -8,8 +8,13 @@
  */
 
 const { onRequest } = require("firebase-functions/v2/https");
+const { onDocumentWritten } = require("firebase-functions/v2/firestore");
 const logger = require("firebase-functions/logger");
-const { getFirestore, Timestamp } = require("firebase-admin/firestore");
+const {
+  getFirestore,
+  FieldValue,
+  Timestamp,
+} = require("firebase-admin/firestore");
 const { initializeApp } = require("firebase-admin/app");
 const { setGlobalOptions } = require("firebase-functions");
 const axios = require("axios");
@@ -28,6 +33,156 @@ const db = getFirestore();
 //   response.send("Hello from Firebase!");
 // });
 
+// 選ばれたunch_typeを選ばれた時刻と一緒に残す
+// /dev/dataのunch_typeは1つしかないので、hubがオフラインの間に何回か選ばれると
+// 上書きされて前の利用の分が消えてしまう
+// このトリガーは遅れて動くことがあり、その間に履歴の保存が/dev/dataのunch_typeを直接使って
+// いたら(unchConsumedAtがそれより後なら)、次の利用に回ってしまわないよう残さない
+exports.recordUnchSelection = onDocumentWritten("dev/data", async (event) => {
+  const before = event.data.before.exists
+    ? event.data.before.data()["unch_type"]
+    : null;
+  const after = event.data.after.exists
+    ? event.data.after.data()["unch_type"]
+    : null;
+  if (after === null || after === undefined || after === before) return;
+
+  const selectedAt = Timestamp.fromDate(new Date(event.time));
+  const doc = db.doc("/dev/data");
+  await db.runTransaction(async (transaction) => {
+    const data = await transaction.get(doc);
+    const consumedAt = data.exists ? data.data()["unchConsumedAt"] : undefined;
+    if (consumedAt && consumedAt.toMillis() >= selectedAt.toMillis()) return;
+    transaction.create(db.collection("unchSelections").doc(), {
+      type: after,
+      selectedAt,
+    });
+  });
+});
+
+// 選ばれた時刻から、どの利用のunch_typeかを決める
+// 利用中(始まってから終わるまで)に選ばれたものはその利用、利用の後に選ばれたものは直前の利用、
+// 最初の利用より前に選ばれたものは最初の利用のものとする 同じ利用に複数あれば最後に選ばれたもの
+// ranges: 古い順の { startMillis, endMillis }
+const assignUnchTypes = (ranges, selections) => {
+  const types = ranges.map(() => null);
+  selections.forEach(({ type, selectedAtMillis }) => {
+    let index = 0;
+    ranges.forEach((range, i) => {
+      if (range.startMillis <= selectedAtMillis) index = i;
+    });
+    types[index] = type;
+  });
+  return types;
+};
+
+// 利用履歴をまとめて保存し、必要ならトイレットペーパーの補充を通知する
+// 読み込みと書き込みは1つのトランザクションにまとめるので、同時に呼ばれても
+// 同じunch_typeの選択を2回割り当てたり、合計消費ロール数を取りこぼしたりしない
+const saveSessions = async (sessions, subscription) => {
+  const doc = db.doc("/dev/data");
+  const data = await db.runTransaction(async (transaction) => {
+    const [data, selections] = await Promise.all([
+      transaction.get(doc),
+      // 500件の書き込みに収まるよう、1回に割り当てる選択は古い方から99件まで
+      transaction.get(
+        db.collection("unchSelections").orderBy("selectedAt").limit(99)
+      ),
+    ]);
+    writeSessions(transaction, doc, data, selections, sessions);
+    return data;
+  });
+
+  const rollCounts = sessions
+    .map((session) => session.usedRollCount)
+    .filter((count) => count !== null);
+  if (!data.exists || rollCounts.length === 0) return;
+  const addedUsedRollCount = rollCounts.reduce((sum, count) => sum + count, 0);
+
+  // 新たな合計消費ロール数が閾値を上回っていて、subscriptionを渡されていたら通知
+  const newUsedRollCount = data.data()["usedRollCount"] + addedUsedRollCount;
+  const paperNotificationThreshold = data.data()["paperNotificationThreshold"];
+  if (newUsedRollCount >= paperNotificationThreshold && subscription !== null) {
+    const url = "https://bentech-web-app.vercel.app/api/sendNotification";
+    const body = {
+      message: "そろそろトイレットペーパーを準備しておきましょう",
+      subscription,
+    };
+    const headers = {
+      "Content-Type": "application/json",
+    };
+
+    await axios.post(url, body, { headers });
+  }
+};
+
+// saveSessionsのトランザクションの書き込み部分
+const writeSessions = (transaction, doc, data, selections, sessions) => {
+  const now = Date.now();
+  const ranges = sessions.map((session, i) => {
+    // hubが何秒前に終わったかを送ってきたらその時刻、分からなければ受け取った時刻にする
+    const endedAt =
+      session.endedSecondsAgo === null
+        ? now
+        : now - session.endedSecondsAgo * 1000;
+    // 同じ秒に終わったものも並び順が保たれるように1msずつずらす
+    const endMillis = endedAt - (sessions.length - 1 - i);
+    return { startMillis: endMillis - session.stayingTime * 1000, endMillis };
+  });
+
+  // 溜まっているunch_typeの選択を、選ばれた時刻で各利用に割り当てる
+  const types = assignUnchTypes(
+    ranges,
+    selections.docs.map((selection) => ({
+      type: selection.data()["type"],
+      selectedAtMillis: selection.data()["selectedAt"].toMillis(),
+    }))
+  );
+  // /dev/dataに今入っているunch_typeは最後の選択 recordUnchSelectionがまだ動いていなければ
+  // 記録されていないので、最後の利用にunch_typeがなければそれを使う
+  // (このトリガーを入れる前から入っていたunch_typeもここで拾う)
+  const currentType = data.exists ? data.data()["unch_type"] : null;
+  const lastSelection = selections.docs[selections.docs.length - 1];
+  const recorded =
+    lastSelection !== undefined && lastSelection.data()["type"] === currentType;
+  if (
+    types[types.length - 1] === null &&
+    currentType !== null &&
+    currentType !== undefined &&
+    !recorded
+  ) {
+    types[types.length - 1] = currentType;
+  }
+
+  sessions.forEach((session, i) => {
+    transaction.set(db.collection("histories").doc(), {
+      type: types[i],
+      stayingTime: session.stayingTime,
+      usedRollCount: session.usedRollCount,
+      createdAt: Timestamp.fromMillis(ranges[i].endMillis),
+    });
+  });
+  // 割り当てた選択は消す
+  selections.docs.forEach((selection) => transaction.delete(selection.ref));
+
+  const rollCounts = sessions
+    .map((session) => session.usedRollCount)
+    .filter((count) => count !== null);
+  const addedUsedRollCount = rollCounts.reduce((sum, count) => sum + count, 0);
+
+  // うんちタイプをリセットし、消費ロール数を加算
+  // ここまでに選ばれたunch_typeは割り当て済みなので、遅れて記録されないよう時刻を残す
+  const update = {
+    unch_type: null,
+    in_room: false,
+    unchConsumedAt: FieldValue.serverTimestamp(),
+  };
+  if (data.exists && rollCounts.length > 0) {
+    update.usedRollCount = FieldValue.increment(addedUsedRollCount);
+  }
+  transaction.set(doc, update, { merge: true });
+};
+
 exports.saveHistory = onRequest(async (request, response) => {
   response.set("Access-Control-Allow-Headers", "*");
   response.set("Access-Control-Allow-Origin", "*");
@@ -61,71 +216,63 @@ exports.saveHistory = onRequest(async (request, response) => {
     }
   );
 
-  const doc = db.doc("/dev/data");
-  const data = await doc.get();
-
-  const addHistory = async () => {
-    // 選択中のunch_typeを取得
-    let unch_type = null;
-    if (data.exists) {
-      unch_type = data.data()["unch_type"];
-    }
-
-    await db.collection("histories").add({
-      // 選択中のうんちタイプを適用
-      type: unch_type,
-      stayingTime,
-      usedRollCount,
-      createdAt: Timestamp.now(),
-    });
+  try {
+    await saveSessions(
+      [{ stayingTime, usedRollCount, endedSecondsAgo: null }],
+      subscription
+    );
+    response.status(200).send("complete");
+  } catch (error) {
+    logger.error(`error発生 ${error}`);
+    response.status(500).send(`failed ${error}`);
+  }
+});
 
-    // うんちタイプをリセット
-    await doc.update({ unch_type: null, in_room: false });
-  };
+// hubがオフラインの間に溜めた履歴をまとめて受け取る
+// body: { sessions: [{ stayingTime, usedRollCount, endedSecondsAgo }], subscription }
+// endedSecondsAgoは送信時点で何秒前に終わったか (hubが再起動をまたいで分からない時はnull)
+exports.saveHistoryBatch = onRequest(async (request, response) => {
+  response.set("Access-Control-Allow-Headers", "*");
+  response.set("Access-Control-Allow-Origin", "*");
+  response.set("Access-Control-Allow-Methods", "GET, HEAD, OPTIONS, POST");
 
-  const checkPaperRoll = async () => {
-    if (usedRollCount === null) return;
-
-    if (!data.exists) return;
-
-    // 現在の合計消費ロール数・閾値を取得
-    const currentUsedRollCount = data.data()["usedRollCount"];
-    const paperNotificationThreshold =
-      data.data()["paperNotificationThreshold"];
-
-    // 合計消費ロールに新たな消費ロール数を加算
-    const newUsedRollCount = currentUsedRollCount + usedRollCount;
-
-    // 新たな合計消費ロール数が閾値を上回っていて、subscriptionを渡されていたら通知
-    const sendNotification = async () => {
-      if (
-        newUsedRollCount >= paperNotificationThreshold &&
-        subscription !== null
-      ) {
-        const url = "https://bentech-web-app.vercel.app/api/sendNotification";
-        const data = {
-          message: "そろそろトイレットペーパーを準備しておきましょう",
-          subscription,
-        };
-        const headers = {
-          "Content-Type": "application/json",
-        };
-
-        return await axios.post(url, data, { headers });
-      }
-    };
+  const body = request.body;
+  const sessions = body["sessions"];
+  const subscription = body["subscription"] || null;
 
-    // 消費したトイレットペーパーロール数を更新
-    const updateUsedRollCount = async () => {
-      await doc.update({ usedRollCount: newUsedRollCount });
-    };
+  if (
+    !Array.isArray(sessions) ||
+    sessions.length === 0 ||
+    // 1回のトランザクションの書き込みは500件まで（/dev/dataの更新とunch_typeの選択の削除にも使う）
+    sessions.length > 400 ||
+    sessions.some((session) => session["stayingTime"] === undefined)
+  ) {
+    response
+      .status(400)
+      .send(`何か値が入ってないよ ${JSON.stringify({ sessions })}`);
+    return;
+  }
 
-    // 各タスクを並列で実行
-    await Promise.all([sendNotification(), updateUsedRollCount()]);
-  };
+  logger.info(`履歴${sessions.length}件の保存を要請されました`, request.body, {
+    structedData: true,
+  });
 
   try {
-    await Promise.all([addHistory(), checkPaperRoll()]);
+    await saveSessions(
+      sessions.map((session) => ({
+        stayingTime: session["stayingTime"],
+        usedRollCount:
+          session["usedRollCount"] === undefined
+            ? null
+            : session["usedRollCount"],
+        endedSecondsAgo:
+          Number.isFinite(session["endedSecondsAgo"]) &&
+          session["endedSecondsAgo"] >= 0
+            ? session["endedSecondsAgo"]
+            : null,
+      })),
+      subscription
+    );
     response.status(200).send("complete");
   } catch (error) {
     logger.error(`error発生 ${error}`);
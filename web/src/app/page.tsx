@@ -14,6 +14,7 @@ import {
   Link,
   RefreshCw,
   AlertCircle,
+  Activity,
   Settings,
 } from "lucide-react";
 import { Button } from "@/components/ui/button";
@@ -29,11 +30,18 @@ import { Input } from "@/components/ui/input";
 import { Label } from "@/components/ui/label";
 import { Alert, AlertDescription, AlertTitle } from "@/components/ui/alert";
 import {
-  arrayBufferToString,
   arrayBufferToUint32,
   concatArrayBuffers,
   uint8ToArrayBuffer,
 } from "@/lib/utils";
+import {
+  decodeDevices,
+  decodeInfo,
+  decodeTrace,
+  encodeSubscription,
+  encodeWifiData,
+  TraceEntry,
+} from "@/lib/streamCodec";
 import { db } from "@/repository/frontend/firebase";
 import {
   collection,
@@ -53,6 +61,14 @@ import BishaUnch from "../../public/bisha.png";
 import KorokoroUnch from "../../public/korokoro.png";
 import firebase from "firebase/compat/app";
 
+// hubとのstreamの形式 (edge/common.py と合わせる)
+const CAP_STREAM_V1 = 0x01;
+const CAP_BINARY = 0x02;
+const STREAM_VERSION = 1;
+const STREAM_FLAG_BINARY = 0x01;
+const STREAM_HEADER_SIZE = 11;
+const STREAM_ACK = 0xac;
+
 class HubController {
   private hubServiceId = "e295c051-7ac4-4d72-b7ea-3e71e47e15a9";
   private controlCharId = "4576af67-ecc6-434e-8ce7-52c6ab1d5f04";
@@ -61,6 +77,8 @@ class HubController {
   private controlChar: BluetoothRemoteGATTCharacteristic | undefined;
   private responseChar: BluetoothRemoteGATTCharacteristic | undefined;
   private streamChar: BluetoothRemoteGATTCharacteristic | undefined;
+  // Hubがバイナリ形式で返してきたら、こちらから送るデータもバイナリにする
+  private binarySupported = false;
 
   private async requestAndListenStream(command: number) {
     if (this.streamChar === undefined) {
@@ -68,74 +86,177 @@ class HubController {
     } else if (this.controlChar === undefined) {
       throw new Error("controlCharがありません");
     }
+    const streamChar = this.streamChar;
 
-    let count = 0;
-    let length: number | undefined = undefined;
+    // 旧形式: 4バイトのパケット数のあとに20バイトずつ
+    let legacyCount: number | undefined = undefined;
+    let legacyReceived = 0;
     let joinned_buffer = new ArrayBuffer(0);
 
+    // v1: ヘッダーのあとに連番付きのパケット (edge/common.py の _send_stream_v1)
+    let header:
+      | {
+          flags: number;
+          length: number;
+          payloadSize: number;
+          count: number;
+          window: number;
+        }
+      | undefined = undefined;
+    let buffer = new Uint8Array(0);
+    let receivedFlags: boolean[] = [];
+    let contiguous = -1; // 先頭から連続して受け取れた最後の連番
+    let lastAcked = -1;
+    let ackChain = Promise.resolve();
+
+    let resolveDone = () => {};
+    const done = new Promise<void>((resolve) => {
+      resolveDone = resolve;
+    });
+
+    const sendAck = (seq: number) => {
+      lastAcked = seq;
+      const ack = new Uint8Array([STREAM_ACK, seq >> 8, seq & 0xff]);
+      // GATTの操作は同時に1つしかできないので順番に書き込む
+      ackChain = ackChain
+        .then(() => streamChar.writeValueWithResponse(ack))
+        .catch((error) => console.error("ackの送信に失敗", error));
+    };
+
     const handleNotifications = (event: Event) => {
       // @ts-expect-error このような実装しか見つからなかった
-      const data = event.target.value.buffer;
-      if (count === 0) {
-        length = arrayBufferToUint32(data);
-        console.log(`これから ${length} 個のデータが送られてきます`);
-      } else {
-        console.log(`${count}個目`, data);
-        joinned_buffer = concatArrayBuffers(joinned_buffer, data);
+      const value: DataView = event.target.value;
+      const bytes = new Uint8Array(
+        value.buffer,
+        value.byteOffset,
+        value.byteLength
+      );
+
+      if (header === undefined && legacyCount === undefined) {
+        if (bytes.byteLength === 4) {
+          legacyCount = value.getUint32(0, false);
+          console.log(`これから ${legacyCount} 個のデータが送られてきます`);
+          if (legacyCount === 0) resolveDone();
+        } else if (
+          bytes.byteLength >= STREAM_HEADER_SIZE &&
+          bytes[0] === STREAM_VERSION
+        ) {
+          header = {
+            flags: value.getUint8(1),
+            length: value.getUint32(2, false),
+            payloadSize: value.getUint16(6, false),
+            count: value.getUint16(8, false),
+            window: value.getUint8(10),
+          };
+          console.log("streamのヘッダー", header);
+          buffer = new Uint8Array(header.length);
+          receivedFlags = new Array(header.count).fill(false);
+          if (header.count === 0) resolveDone();
+        }
+        return;
+      }
+
+      if (legacyCount !== undefined) {
+        legacyReceived += 1;
+        console.log(`${legacyReceived}個目`, bytes);
+        joinned_buffer = concatArrayBuffers(joinned_buffer, bytes.slice().buffer);
+        if (legacyReceived >= legacyCount) resolveDone();
+        return;
+      }
+
+      if (header === undefined) return;
+      const seq = value.getUint16(0, false);
+      if (seq >= header.count) return;
+      if (receivedFlags[seq]) {
+        // ackが届かず送り直されたので、もう一度ackを返す
+        sendAck(contiguous);
+        return;
+      }
+      buffer.set(bytes.subarray(2), seq * header.payloadSize);
+      receivedFlags[seq] = true;
+      while (contiguous + 1 < header.count && receivedFlags[contiguous + 1]) {
+        contiguous += 1;
+      }
+
+      if (contiguous + 1 === header.count) {
+        sendAck(contiguous);
+        resolveDone();
+      } else if (contiguous - lastAcked >= header.window) {
+        sendAck(contiguous);
       }
-      count += 1;
     };
 
-    this.streamChar.addEventListener(
+    streamChar.addEventListener(
       "characteristicvaluechanged",
       handleNotifications
     );
 
-    await this.streamChar.startNotifications();
-    await this.controlChar.writeValueWithResponse(uint8ToArrayBuffer(command));
+    await streamChar.startNotifications();
+    // 2バイト目で対応しているstreamの形式を伝える
+    await this.controlChar.writeValueWithResponse(
+      new Uint8Array([command, CAP_STREAM_V1 | CAP_BINARY])
+    );
 
-    await new Promise((resolve) => {
-      const intervalId = setInterval(() => {
-        if (length !== undefined && count >= length + 1) {
-          clearInterval(intervalId);
-          resolve(null);
-        }
-      }, 100);
-    });
+    await done;
+    streamChar.removeEventListener(
+      "characteristicvaluechanged",
+      handleNotifications
+    );
+    await ackChain;
 
-    return arrayBufferToString(joinned_buffer);
+    if (header !== undefined) {
+      return {
+        binary: (header.flags & STREAM_FLAG_BINARY) !== 0,
+        data: buffer,
+      };
+    }
+    return { binary: false, data: new Uint8Array(joinned_buffer) };
   }
 
   private async requestInfo() {
     const response = await this.requestAndListenStream(2);
-    const info = JSON.parse(response);
+    this.binarySupported = response.binary;
+    const info = response.binary
+      ? decodeInfo(response.data)
+      : JSON.parse(new TextDecoder().decode(response.data));
     console.log("info", info);
     return info;
   }
 
-  private async sendTextByStream(command: number, text: string) {
+  private async sendBytesByStream(
+    command: number,
+    msgArray: Uint8Array,
+    capabilities = 0
+  ) {
     if (this.controlChar === undefined) {
       throw Error("controlCharがありません");
     } else if (this.streamChar === undefined) {
       throw Error("streamCharがありません");
     }
 
-    const utf8Encoder = new TextEncoder();
-    const msgArray = utf8Encoder.encode(text);
-
-    await this.controlChar.writeValueWithResponse(uint8ToArrayBuffer(command));
+    await this.controlChar.writeValueWithResponse(
+      capabilities === 0
+        ? uint8ToArrayBuffer(command)
+        : new Uint8Array([command, capabilities])
+    );
 
-    const length = Number(msgArray.length / 20) + 1;
-    await this.streamChar.writeValueWithResponse(uint8ToArrayBuffer(length));
+    const length = Math.ceil(msgArray.length / 20);
+    const header = new DataView(new ArrayBuffer(4));
+    header.setUint32(0, length, false);
+    await this.streamChar.writeValueWithResponse(header.buffer);
 
     for (let i = 0; i < length; i++) {
       const start = i * 20;
-      const end = i == length - 1 ? -1 : start + 20;
-      const data = msgArray.slice(start, end);
+      const data = msgArray.slice(start, start + 20);
       await this.streamChar.writeValueWithResponse(data);
     }
   }
 
+  private async sendTextByStream(command: number, text: string) {
+    const utf8Encoder = new TextEncoder();
+    await this.sendBytesByStream(command, utf8Encoder.encode(text));
+  }
+
   async sendWifiData(ssid: string, password: string) {
     if (this.responseChar === undefined) {
       throw Error("responseCharがありません");
@@ -158,11 +279,19 @@ class HubController {
     await this.responseChar.startNotifications();
     this.responseChar.addEventListener("characteristicvaluechanged", handle);
 
-    const data = {
-      ssid,
-      password,
-    };
-    await this.sendTextByStream(1, JSON.stringify(data));
+    if (this.binarySupported) {
+      await this.sendBytesByStream(
+        1,
+        encodeWifiData(ssid, password),
+        CAP_BINARY
+      );
+    } else {
+      const data = {
+        ssid,
+        password,
+      };
+      await this.sendTextByStream(1, JSON.stringify(data));
+    }
 
     while (success === null) {
       await new Promise((resolve) => setTimeout(resolve, 100));
@@ -221,19 +350,35 @@ class HubController {
 
   async sendSubscription() {
     console.log("subscriptionを送信します");
-    await this.sendTextByStream(
-      4,
-      JSON.stringify(notificationManager.getSubscription())
-    );
+    const subscription = notificationManager.getSubscription();
+    if (this.binarySupported && subscription !== null) {
+      await this.sendBytesByStream(
+        4,
+        encodeSubscription(subscription.toJSON()),
+        CAP_BINARY
+      );
+    } else {
+      await this.sendTextByStream(4, JSON.stringify(subscription));
+    }
     console.log("subscription送信完了");
   }
 
   async reScan() {
     const response = await this.requestAndListenStream(5);
-    const devices = JSON.parse(response);
+    const devices = response.binary
+      ? decodeDevices(response.data)
+      : JSON.parse(new TextDecoder().decode(response.data));
     console.log("接続済みのデバイス", devices);
     return devices;
   }
+
+  async dumpTrace() {
+    // Hubの処理時間の記録 (edge/trace_ring.py) はバイナリでしか送られてこない
+    const response = await this.requestAndListenStream(6);
+    const entries = decodeTrace(response.data);
+    console.log("トレース", entries);
+    return entries;
+  }
 }
 
 class NotificationManager {
@@ -374,6 +519,8 @@ export default function Component() {
   const [isHubConnected, setIsHubConnected] = useState(false);
   const [isHubConnecting, setIsHubConnecting] = useState(false);
   const [isScanning, setIsScanning] = useState(false);
+  const [isTraceLoading, setIsTraceLoading] = useState(false);
+  const [trace, setTrace] = useState<TraceEntry[]>([]);
   const [connectedDevices, setConnectedDevices] = useState<BenTechDeviceType[]>(
     []
   );
@@ -462,6 +609,17 @@ export default function Component() {
     }
   }, []);
 
+  const handleDumpTrace = useCallback(async () => {
+    setIsTraceLoading(true);
+    try {
+      setTrace(await hubController.dumpTrace());
+    } catch (error) {
+      console.log("トレースの取得に失敗しました", error);
+    } finally {
+      setIsTraceLoading(false);
+    }
+  }, []);
+
   const handleEditHistory = useCallback(async () => {
     if (editTargetHistory === null) return;
     const docRef = doc(db, "histories", editTargetHistory.id);
@@ -671,6 +829,35 @@ export default function Component() {
                 </Card>
               );
             })}
+            <div className="flex justify-between items-center pt-4">
+              <h2 className="text-xl font-bold">処理時間の記録</h2>
+              <Button
+                variant="outline"
+                size="sm"
+                onClick={handleDumpTrace}
+                disabled={isTraceLoading || !isHubConnected}
+              >
+                {isTraceLoading ? (
+                  <Loader2 className="h-4 w-4 animate-spin mr-2" />
+                ) : (
+                  <Activity className="h-4 w-4 mr-2" />
+                )}
+                {isTraceLoading ? "取得中..." : "取得"}
+              </Button>
+            </div>
+            {trace.length > 0 && (
+              <Card>
+                <CardContent className="p-4 font-mono text-xs space-y-1">
+                  {trace.map((entry, i) => (
+                    <div key={i} className="flex justify-between">
+                      <span>+{entry.deltaMs.toFixed(1)}ms</span>
+                      <span>{entry.event}</span>
+                      <span>{entry.arg}</span>
+                    </div>
+                  ))}
+                </CardContent>
+              </Card>
+            )}
           </div>
         );
       default:
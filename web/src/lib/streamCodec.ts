@@ -0,0 +1,210 @@
+// Hubとstreamでやり取りするデータのバイナリ形式 (edge/hub/stream_codec.py と合わせる)
+// タグ(u8) + 長さ(u16) + 値 を並べる
+
+const TAG_WIFI_CONNECTED = 0x01;
+const TAG_SUBSCRIPTION = 0x02;
+const TAG_DEVICE = 0x03;
+
+const TAG_ENDPOINT = 0x10;
+const TAG_EXPIRATION_TIME = 0x11;
+const TAG_P256DH = 0x12;
+const TAG_AUTH = 0x13;
+
+const TAG_SSID = 0x20;
+const TAG_PASSWORD = 0x21;
+
+const TAG_TRACE_NOW = 0x30;
+const TAG_TRACE_ENTRIES = 0x31;
+const TRACE_ENTRY_SIZE = 9;
+// ticks_usが折り返す周期 (edge/trace_ring.py の TICKS_PERIOD)
+const TICKS_PERIOD = 2 ** 30;
+
+// edge/trace_ring.py の TR_* と合わせる
+const TRACE_EVENT_NAMES: { [event: number]: string } = {
+  1: "SESSION_START",
+  2: "SESSION_OPENED",
+  3: "SESSION_END",
+  4: "SESSION_CLOSED",
+  5: "SESSION_DISPATCHED",
+  6: "SESSION_SAVED",
+  16: "CONNECT_BEGIN",
+  17: "CONNECT_END",
+  18: "CONNECT_FAIL",
+  19: "CONTROL_BEGIN",
+  20: "CONTROL_END",
+  21: "CONTROL_FAIL",
+  22: "RESPONSE_BEGIN",
+  23: "RESPONSE_END",
+  32: "HTTP_BEGIN",
+  33: "HTTP_END",
+  48: "STREAM_RX_BEGIN",
+  49: "STREAM_RX_END",
+  50: "STREAM_ACK",
+};
+
+const DEVICE_NAMES: { [code: number]: string } = {
+  1: "lid-controller",
+  2: "paper-observer",
+  3: "auto-flusher",
+  4: "deodorant",
+};
+
+type Field = [tag: number, value: Uint8Array];
+
+function encodeFields(fields: Field[]) {
+  const length = fields.reduce((sum, [, value]) => sum + 3 + value.length, 0);
+  const buffer = new Uint8Array(length);
+  const view = new DataView(buffer.buffer);
+  let offset = 0;
+  for (const [tag, value] of fields) {
+    view.setUint8(offset, tag);
+    view.setUint16(offset + 1, value.length, false);
+    buffer.set(value, offset + 3);
+    offset += 3 + value.length;
+  }
+  return buffer;
+}
+
+function* decodeFields(data: Uint8Array): Generator<Field> {
+  const view = new DataView(data.buffer, data.byteOffset, data.byteLength);
+  let offset = 0;
+  while (offset + 3 <= data.length) {
+    const tag = view.getUint8(offset);
+    const length = view.getUint16(offset + 1, false);
+    offset += 3;
+    if (offset + length > data.length) {
+      throw Error("TLVが途中で切れています");
+    }
+    yield [tag, data.subarray(offset, offset + length)];
+    offset += length;
+  }
+}
+
+function base64UrlToBytes(text: string) {
+  const base64 = text.replace(/-/g, "+").replace(/_/g, "/");
+  const binary = atob(base64 + "=".repeat((4 - (base64.length % 4)) % 4));
+  return Uint8Array.from(binary, (c) => c.charCodeAt(0));
+}
+
+function bytesToBase64Url(bytes: Uint8Array) {
+  const binary = String.fromCharCode(...bytes);
+  return btoa(binary).replace(/\+/g, "-").replace(/\//g, "_").replace(/=+$/, "");
+}
+
+export function encodeWifiData(ssid: string, password: string) {
+  const encoder = new TextEncoder();
+  return encodeFields([
+    [TAG_SSID, encoder.encode(ssid)],
+    [TAG_PASSWORD, encoder.encode(password)],
+  ]);
+}
+
+export function encodeSubscription(subscription: PushSubscriptionJSON) {
+  const fields: Field[] = [
+    [TAG_ENDPOINT, new TextEncoder().encode(subscription.endpoint)],
+  ];
+  if (subscription.expirationTime != null) {
+    const expirationTime = new Uint8Array(8);
+    new DataView(expirationTime.buffer).setBigUint64(
+      0,
+      BigInt(subscription.expirationTime),
+      false
+    );
+    fields.push([TAG_EXPIRATION_TIME, expirationTime]);
+  }
+  fields.push([TAG_P256DH, base64UrlToBytes(subscription.keys!["p256dh"])]);
+  fields.push([TAG_AUTH, base64UrlToBytes(subscription.keys!["auth"])]);
+  return encodeFields(fields);
+}
+
+function decodeSubscription(data: Uint8Array) {
+  // PushSubscription.toJSON()と同じ形に戻す
+  const subscription = {
+    endpoint: "",
+    expirationTime: null as number | null,
+    keys: { p256dh: "", auth: "" },
+  };
+  for (const [tag, value] of decodeFields(data)) {
+    if (tag === TAG_ENDPOINT) {
+      subscription.endpoint = new TextDecoder().decode(value);
+    } else if (tag === TAG_EXPIRATION_TIME) {
+      const view = new DataView(value.buffer, value.byteOffset, value.length);
+      subscription.expirationTime = Number(view.getBigUint64(0, false));
+    } else if (tag === TAG_P256DH) {
+      subscription.keys.p256dh = bytesToBase64Url(value);
+    } else if (tag === TAG_AUTH) {
+      subscription.keys.auth = bytesToBase64Url(value);
+    }
+  }
+  return subscription;
+}
+
+export function decodeDevices(data: Uint8Array) {
+  const devices: string[] = [];
+  for (const [tag, value] of decodeFields(data)) {
+    if (tag === TAG_DEVICE) {
+      devices.push(DEVICE_NAMES[value[0]] ?? `unknown-${value[0]}`);
+    }
+  }
+  return devices;
+}
+
+export function decodeInfo(data: Uint8Array) {
+  // JSONで送られてくる場合と同じキーにそろえる
+  let wifiConnected = false;
+  let subscription: ReturnType<typeof decodeSubscription> | null = null;
+  for (const [tag, value] of decodeFields(data)) {
+    if (tag === TAG_WIFI_CONNECTED) {
+      wifiConnected = value[0] === 1;
+    } else if (tag === TAG_SUBSCRIPTION) {
+      subscription = decodeSubscription(value);
+    }
+  }
+  return {
+    WIFI_CONNECTED: wifiConnected,
+    SUBSCRIPTION: subscription,
+    CONNECTED_DEVICES: decodeDevices(data),
+  };
+}
+
+export type TraceEntry = {
+  // 送られてきた時点から何ms前か
+  agoMs: number;
+  // 1つ前の記録から何ms後か
+  deltaMs: number;
+  event: string;
+  arg: number;
+};
+
+export function decodeTrace(data: Uint8Array) {
+  let now = 0;
+  const raw: [ticks: number, event: number, arg: number][] = [];
+  for (const [tag, value] of decodeFields(data)) {
+    const view = new DataView(value.buffer, value.byteOffset, value.length);
+    if (tag === TAG_TRACE_NOW) {
+      now = view.getUint32(0, false);
+    } else if (tag === TAG_TRACE_ENTRIES) {
+      for (
+        let offset = 0;
+        offset + TRACE_ENTRY_SIZE <= value.length;
+        offset += TRACE_ENTRY_SIZE
+      ) {
+        raw.push([
+          view.getUint32(offset, false),
+          view.getUint8(offset + 4),
+          view.getInt32(offset + 5, false),
+        ]);
+      }
+    }
+  }
+  // ticksは折り返すので、隣どうしの差を積み上げて時刻を戻す (間隔は周期より短いとみなす)
+  const ticksDiff = (a: number, b: number) =>
+    (((a - b) % TICKS_PERIOD) + TICKS_PERIOD) % TICKS_PERIOD;
+  const entries: TraceEntry[] = raw.map(([ticks, event, arg], i) => ({
+    agoMs: ticksDiff(now, ticks) / 1000,
+    deltaMs: i === 0 ? 0 : ticksDiff(ticks, raw[i - 1][0]) / 1000,
+    event: TRACE_EVENT_NAMES[event] ?? `unknown-${event}`,
+    arg,
+  }));
+  return entries;
+}